@@ -8,6 +8,8 @@ import random
 import sys
 import time
 
+from multiprocessing import Pool, cpu_count
+
 sys.path.extend(os.path.abspath(os.path.join(os.getcwd(), d))
                 for d in ['pddlstream', 'ss-pybullet'])
 
@@ -15,43 +17,55 @@ from itertools import product
 
 from pybullet_tools.utils import wait_for_user, elapsed_time, multiply, \
     invert, get_link_pose, has_gui, write_json, get_body_name, get_link_name, \
-    RED, BLUE, LockRenderer, child_link_from_joint, get_date, SEPARATOR, dump_body, safe_remove
+    RED, BLUE, LockRenderer, child_link_from_joint, get_date, SEPARATOR, dump_body, safe_remove, \
+    set_random_seed, set_numpy_seed, BodySaver
 from src.utils import get_block_path, BLOCK_SIZES, BLOCK_COLORS, GRASP_TYPES, TOP_GRASP, \
     SIDE_GRASP, BASE_JOINTS, joint_from_name, ALL_SURFACES, FRANKA_CARTER, EVE, DRAWERS, \
     OPEN_SURFACES, ENV_SURFACES, CABINETS, ZED_LEFT_SURFACES
 from src.world import World
 from src.stream import get_stable_gen, get_grasp_gen, Z_EPSILON
 from src.streams.pick import get_pick_gen_fn
-from src.database import DATABASE_DIRECTORY, PLACE_IR_FILENAME, get_surface_reference_pose, get_place_path
+from src.database import DATABASE_DIRECTORY, PLACE_IR_FILENAME, get_surface_reference_pose, get_place_path, \
+    get_shard_path, append_shard, read_shard, merge_shard, split_samples
+from src.reachability import load_place_model
 
 # TODO: condition on the object type (but allow a default object)
 # TODO: generalize to any manipulation with a movable entity
 # TODO: extend to pouring
 
-def collect_place(world, object_name, surface_name, grasp_type, args):
-    date = get_date()
-    #set_seed(args.seed)
+def collect_place(world, object_name, surface_name, grasp_type, args, num_samples=None):
+    # Streams entries to the shard so that interrupted runs can resume
+    if num_samples is None:
+        num_samples = args.num_samples
 
     #dump_body(world.robot)
     surface_pose = get_surface_reference_pose(world.kitchen, surface_name) # TODO: assumes the drawer is open
     stable_gen_fn = get_stable_gen(world, z_offset=Z_EPSILON, visibility=False,
                                    learned=False, collisions=not args.cfree)
     grasp_gen_fn = get_grasp_gen(world)
-    ik_ir_gen = get_pick_gen_fn(world, learned=False, collisions=not args.cfree, teleport=args.teleport)
+    robot_name = get_body_name(world.robot)
+    path = get_place_path(robot_name, surface_name, grasp_type)
+    shard_path = get_shard_path(path)
+
+    def record_failure(bq, tool_pose):
+        # Base confs where the pick failed train the reachability model
+        with BodySaver(world.robot):
+            bq.assign()
+            base_pose = get_link_pose(world.robot, world.base_link)
+        append_shard(shard_path, failure={'tool_from_base': multiply(invert(tool_pose), base_pose)})
+    ik_ir_gen = get_pick_gen_fn(world, learned=False, collisions=not args.cfree, teleport=args.teleport,
+                                failure_fn=record_failure)
 
     stable_gen = stable_gen_fn(object_name, surface_name)
     grasps = list(grasp_gen_fn(object_name, grasp_type))
-
-    robot_name = get_body_name(world.robot)
-    path = get_place_path(robot_name, surface_name, grasp_type)
     print(SEPARATOR)
     print('Robot name: {} | Object name: {} | Surface name: {} | Grasp type: {} | Filename: {}'.format(
         robot_name, object_name, surface_name, grasp_type, path))
 
-    entries = []
+    successes = 0
     start_time = time.time()
     failures = 0
-    while (len(entries) < args.num_samples) and \
+    while (successes < num_samples) and \
             (elapsed_time(start_time) < args.max_time): #and (failures <= max_failures):
         (rel_pose,) = next(stable_gen)
         if rel_pose is None:
@@ -61,7 +75,8 @@ def collect_place(world, object_name, surface_name, grasp_type, args):
             result = next(ik_ir_gen(object_name, rel_pose, grasp), None)
         if result is None:
             print('Failure! | {} / {} [{:.3f}]'.format(
-                len(entries), args.num_samples, elapsed_time(start_time)))
+                successes, num_samples, elapsed_time(start_time)))
+            append_shard(shard_path)
             failures += 1
             continue
         # TODO: ensure an arm motion exists
@@ -72,23 +87,25 @@ def collect_place(world, object_name, surface_name, grasp_type, args):
         base_pose = get_link_pose(world.robot, world.base_link)
         object_pose = rel_pose.get_world_from_body()
         tool_pose = multiply(object_pose, invert(grasp.grasp_pose))
-        entries.append({
+        append_shard(shard_path, {
             'tool_from_base': multiply(invert(tool_pose), base_pose),
             'surface_from_object': multiply(invert(surface_pose), object_pose),
             'base_from_object': multiply(invert(base_pose), object_pose),
         })
+        successes += 1
         print('Success! | {} / {} [{:.3f}]'.format(
-            len(entries), args.num_samples, elapsed_time(start_time)))
+            successes, num_samples, elapsed_time(start_time)))
         if has_gui():
             wait_for_user()
     #visualize_database(tool_from_base_list)
-    if not entries:
-        safe_remove(path)
-        return None
+    return successes
 
+def merge_place(world, object_name, surface_name, grasp_type):
+    robot_name = get_body_name(world.robot)
+    path = get_place_path(robot_name, surface_name, grasp_type)
     # Assuming the kitchen is fixed but the objects might be open world
     data = {
-        'date': date,
+        'date': get_date(),
         'robot_name': robot_name, # get_name | get_body_name | get_base_name | world.robot_name
         'base_link': get_link_name(world.robot, world.base_link),
         'tool_link': get_link_name(world.robot, world.tool_link),
@@ -96,17 +113,44 @@ def collect_place(world, object_name, surface_name, grasp_type, args):
         'surface_name': surface_name,
         'object_name': object_name,
         'grasp_type': grasp_type,
-        'entries': entries,
-        'failures': failures,
-        'successes': len(entries),
     }
-
-    write_json(path, data)
-    print('Saved', path)
+    data = merge_shard(path, data)
+    if data is not None:
+        print('Saved {} | Successes: {} | Failures: {} | Failed entries: {}'.format(
+            path, data['successes'], data['failures'], len(data['failed_entries'])))
+        print('Reachability model:', load_place_model(robot_name, surface_name, grasp_type))
     return data
 
 ################################################################################
 
+def get_object_name():
+    # TODO: sample from set of objects?
+    return '{}_{}_block{}'.format(BLOCK_SIZES[-1], BLOCK_COLORS[0], 0)
+
+def create_world(args, use_gui=False):
+    world = World(use_gui=use_gui, robot_name=args.robot)
+    #dump_body(world.robot)
+    for joint in world.kitchen_joints:
+        world.open_door(joint) # open_door | close_door
+    world.open_gripper()
+    world.add_body(get_object_name())
+    # TODO: could constrain Eve to be within a torso cone
+    return world
+
+WORKER_WORLD = None
+
+def initialize_worker(args):
+    global WORKER_WORLD
+    WORKER_WORLD = create_world(args, use_gui=False)
+
+def collect_worker(inputs):
+    surface_name, grasp_type, num_samples, seed, args = inputs
+    set_random_seed(seed)
+    set_numpy_seed(seed)
+    return collect_place(WORKER_WORLD, get_object_name(), surface_name, grasp_type, args, num_samples=num_samples)
+
+################################################################################
+
 def main():
     parser = argparse.ArgumentParser()
     #parser.add_argument('-attempts', default=100, type=int,
@@ -121,6 +165,8 @@ def main():
                         help='The maximum runtime')
     parser.add_argument('-num_samples', default=1000, type=int,
                         help='The number of samples')
+    parser.add_argument('-num_workers', default=1, type=int,
+                        help='The number of collection processes (0 uses all cores)')
     parser.add_argument('-robot', default=FRANKA_CARTER, choices=[FRANKA_CARTER, EVE],
                         help='The robot to use.')
     parser.add_argument('-seed', default=None,
@@ -130,16 +176,13 @@ def main():
     parser.add_argument('-visualize', action='store_true',
                         help='When enabled, visualizes planning rather than the world (for debugging).')
     args = parser.parse_args()
+    num_workers = args.num_workers if args.num_workers > 0 else cpu_count()
+    # Forking before connecting to pybullet so each worker owns its own client
+    pool = Pool(processes=num_workers, initializer=initialize_worker, initargs=(args,)) \
+        if 1 < num_workers else None
 
-    world = World(use_gui=args.visualize, robot_name=args.robot)
-    #dump_body(world.robot)
-    for joint in world.kitchen_joints:
-        world.open_door(joint) # open_door | close_door
-    world.open_gripper()
-    # TODO: sample from set of objects?
-    object_name = '{}_{}_block{}'.format(BLOCK_SIZES[-1], BLOCK_COLORS[0], 0)
-    world.add_body(object_name)
-    # TODO: could constrain Eve to be within a torso cone
+    world = create_world(args, use_gui=args.visualize)
+    object_name = get_object_name()
 
     grasp_colors = {
         TOP_GRASP: RED,
@@ -155,12 +198,31 @@ def main():
         if surface_name in (OPEN_SURFACES + CABINETS):
             combinations.append((surface_name, SIDE_GRASP))
 
-    # TODO: parallelize
     print('Combinations:', combinations)
+    print('Workers:', num_workers)
     wait_for_user('Start?')
+    seed = int(args.seed) if args.seed is not None else random.randint(0, 2**31)
+    jobs = []
+    for surface_name, grasp_type in combinations:
+        path = get_place_path(get_body_name(world.robot), surface_name, grasp_type)
+        entries, failures, _ = read_shard(get_shard_path(path))
+        if entries or failures:
+            print('Resuming {} | Successes: {} | Failures: {}'.format(path, len(entries), failures))
+        remaining = max(0, args.num_samples - len(entries))
+        for num_samples in split_samples(remaining, num_workers):
+            if num_samples != 0:
+                jobs.append((surface_name, grasp_type, num_samples, seed + len(jobs), args))
+
+    if pool is None:
+        for surface_name, grasp_type, num_samples, _, _ in jobs:
+            #draw_picks(world, object_name, surface_name, grasp_type, color=grasp_colors[grasp_type])
+            collect_place(world, object_name, surface_name, grasp_type, args, num_samples=num_samples)
+    else:
+        pool.map(collect_worker, jobs, chunksize=1)
+        pool.close()
+        pool.join()
     for surface_name, grasp_type in combinations:
-        #draw_picks(world, object_name, surface_name, grasp_type, color=grasp_colors[grasp_type])
-        collect_place(world, object_name, surface_name, grasp_type, args)
+        merge_place(world, object_name, surface_name, grasp_type)
     world.destroy()
 
 if __name__ == '__main__':
@@ -4,46 +4,57 @@ from __future__ import print_function
 
 import argparse
 import os
+import random
 import sys
 import time
 
+from multiprocessing import Pool, cpu_count
+
 sys.path.extend(os.path.abspath(os.path.join(os.getcwd(), d))
                 for d in ['pddlstream', 'ss-pybullet'])
 
 from pybullet_tools.pr2_primitives import Conf
 from pybullet_tools.utils import wait_for_user, elapsed_time, multiply, \
     invert, get_link_pose, has_gui, write_json, get_body_name, get_link_name, \
-    get_joint_name, joint_from_name, get_date, SEPARATOR, safe_remove, link_from_name
+    get_joint_name, joint_from_name, get_date, SEPARATOR, safe_remove, link_from_name, \
+    set_random_seed, set_numpy_seed
 from src.utils import CABINET_JOINTS, DRAWER_JOINTS, KNOBS, ZED_LEFT_JOINTS
 from src.world import World
 from src.streams.press import get_press_gen_fn
 from src.streams.pull import get_pull_gen_fn
-from src.database import get_joint_reference_pose, get_pull_path, is_press
+from src.database import get_joint_reference_pose, get_pull_path, is_press, \
+    get_shard_path, append_shard, read_shard, merge_shard, split_samples
 
 # TODO: generalize to any manipulation with a fixed entity
 
-def collect_pull(world, joint_name, args):
-    date = get_date()
-    #set_seed(args.seed)
+def get_joint_confs(world, joint_name):
+    joint = joint_from_name(world.kitchen, joint_name)
+    open_conf = Conf(world.kitchen, [joint], [world.open_conf(joint)])
+    closed_conf = Conf(world.kitchen, [joint], [world.closed_conf(joint)])
+    return open_conf, closed_conf
+
+def collect_pull(world, joint_name, args, num_samples=None):
+    # Streams entries to the shard so that interrupted runs can resume
+    if num_samples is None:
+        num_samples = args.num_samples
 
     robot_name = get_body_name(world.robot)
     if is_press(joint_name):
         press_gen = get_press_gen_fn(world, collisions=not args.cfree, teleport=args.teleport, learned=False)
     else:
-        joint = joint_from_name(world.kitchen, joint_name)
-        open_conf = Conf(world.kitchen, [joint], [world.open_conf(joint)])
-        closed_conf = Conf(world.kitchen, [joint], [world.closed_conf(joint)])
+        open_conf, closed_conf = get_joint_confs(world, joint_name)
         pull_gen = get_pull_gen_fn(world, collisions=not args.cfree, teleport=args.teleport, learned=False)
         #handle_link, handle_grasp, _ = get_handle_grasp(world, joint)
 
     path = get_pull_path(robot_name, joint_name)
+    shard_path = get_shard_path(path)
     print(SEPARATOR)
     print('Robot name {} | Joint name: {} | Filename: {}'.format(robot_name, joint_name, path))
 
-    entries = []
+    successes = 0
     failures = 0
     start_time = time.time()
-    while (len(entries) < args.num_samples) and \
+    while (successes < num_samples) and \
             (elapsed_time(start_time) < args.max_time):
         if is_press(joint_name):
             result = next(press_gen(joint_name), None)
@@ -51,7 +62,8 @@ def collect_pull(world, joint_name, args):
             result = next(pull_gen(joint_name, open_conf, closed_conf), None) # Open to closed
         if result is None:
             print('Failure! | {} / {} [{:.3f}]'.format(
-                len(entries), args.num_samples, elapsed_time(start_time)))
+                successes, num_samples, elapsed_time(start_time)))
+            append_shard(shard_path)
             failures += 1
             continue
         if not is_press(joint_name):
@@ -63,43 +75,62 @@ def collect_pull(world, joint_name, args):
         #next(at.commands[2].iterate(None, None))
         base_pose = get_link_pose(world.robot, world.base_link)
         #handle_pose = get_link_pose(world.robot, base_link)
-        entries.append({
+        append_shard(shard_path, {
             'joint_from_base': multiply(invert(joint_pose), base_pose),
         })
+        successes += 1
         print('Success! | {} / {} [{:.3f}]'.format(
-            len(entries), args.num_samples, elapsed_time(start_time)))
+            successes, num_samples, elapsed_time(start_time)))
         if has_gui():
             wait_for_user()
-    if not entries:
-        safe_remove(path)
-        return None
     #visualize_database(joint_from_base_list)
+    return successes
 
+def merge_pull(world, joint_name):
+    robot_name = get_body_name(world.robot)
+    path = get_pull_path(robot_name, joint_name)
     # Assuming the kitchen is fixed but the objects might be open world
     # TODO: could store per data point
     data = {
-        'date': date,
+        'date': get_date(),
         'robot_name': robot_name, # get_name | get_body_name | get_base_name | world.robot_name
         'base_link': get_link_name(world.robot, world.base_link),
         'tool_link': get_link_name(world.robot, world.tool_link),
         'kitchen_name': get_body_name(world.kitchen),
         'joint_name': joint_name,
-        'entries': entries,
-        'failures': failures,
-        'successes': len(entries),
     }
     if not is_press(joint_name):
+        open_conf, closed_conf = get_joint_confs(world, joint_name)
         data.update({
             'open_conf': open_conf.values,
             'closed_conf': closed_conf.values,
         })
-
-    write_json(path, data)
-    print('Saved', path)
+    data = merge_shard(path, data)
+    if data is not None:
+        print('Saved {} | Successes: {} | Failures: {}'.format(path, data['successes'], data['failures']))
     return data
 
 ################################################################################
 
+def create_world(args, use_gui=False):
+    world = World(use_gui=use_gui)
+    world.open_gripper()
+    return world
+
+WORKER_WORLD = None
+
+def initialize_worker(args):
+    global WORKER_WORLD
+    WORKER_WORLD = create_world(args, use_gui=False)
+
+def collect_worker(inputs):
+    joint_name, num_samples, seed, args = inputs
+    set_random_seed(seed)
+    set_numpy_seed(seed)
+    return collect_pull(WORKER_WORLD, joint_name, args, num_samples=num_samples)
+
+################################################################################
+
 def main():
     parser = argparse.ArgumentParser()
     #parser.add_argument('-attempts', default=100, type=int,
@@ -110,6 +141,8 @@ def main():
                         help='The maximum runtime')
     parser.add_argument('-num_samples', default=1000, type=int,
                         help='The number of samples')
+    parser.add_argument('-num_workers', default=1, type=int,
+                        help='The number of collection processes (0 uses all cores)')
     parser.add_argument('-seed', default=None,
                         help='The random seed to use.')
     parser.add_argument('-teleport', action='store_true',
@@ -118,20 +151,40 @@ def main():
                         help='When enabled, visualizes planning rather than the world (for debugging).')
     args = parser.parse_args()
     # TODO: could record the full trajectories here
+    num_workers = args.num_workers if args.num_workers > 0 else cpu_count()
+    # Forking before connecting to pybullet so each worker owns its own client
+    pool = Pool(processes=num_workers, initializer=initialize_worker, initargs=(args,)) \
+        if 1 < num_workers else None
 
-    world = World(use_gui=args.visualize)
-    world.open_gripper()
+    world = create_world(args, use_gui=args.visualize)
 
     #joint_names = DRAWER_JOINTS + CABINET_JOINTS
     joint_names = ZED_LEFT_JOINTS
     print('Joints:', joint_names)
     print('Knobs:', KNOBS)
+    print('Workers:', num_workers)
     wait_for_user('Start?')
-    for joint_name in joint_names:
-        collect_pull(world, joint_name, args)
-    for knob_name in KNOBS:
-        collect_pull(world, knob_name, args)
-
+    seed = int(args.seed) if args.seed is not None else random.randint(0, 2**31)
+    jobs = []
+    for joint_name in joint_names + KNOBS:
+        path = get_pull_path(get_body_name(world.robot), joint_name)
+        entries, failures, _ = read_shard(get_shard_path(path))
+        if entries or failures:
+            print('Resuming {} | Successes: {} | Failures: {}'.format(path, len(entries), failures))
+        remaining = max(0, args.num_samples - len(entries))
+        for num_samples in split_samples(remaining, num_workers):
+            if num_samples != 0:
+                jobs.append((joint_name, num_samples, seed + len(jobs), args))
+
+    if pool is None:
+        for joint_name, num_samples, _, _ in jobs:
+            collect_pull(world, joint_name, args, num_samples=num_samples)
+    else:
+        pool.map(collect_worker, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+    for joint_name in joint_names + KNOBS:
+        merge_pull(world, joint_name)
     world.destroy()
 
 if __name__ == '__main__':
@@ -0,0 +1,36 @@
+#!/usr/bin/env python2
+
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.extend(os.path.abspath(os.path.join(os.getcwd(), d))
+                for d in ['pddlstream', 'ss-pybullet'])
+
+from pybullet_tools.utils import elapsed_time
+from src.database import DATABASE_DIRECTORY, convert_database, get_binary_path, has_binary_database
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-force', action='store_true',
+                        help='When enabled, converts databases that already have an up-to-date binary file.')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    paths = sorted(glob.glob(os.path.join(DATABASE_DIRECTORY, '*.json')))
+    for i, path in enumerate(paths):
+        if has_binary_database(path) and not args.force:
+            print('{}/{}) Skipping {}'.format(i + 1, len(paths), path))
+            continue
+        binary_path = convert_database(path)
+        print('{}/{}) Converted {} ({:.1f} kB) -> {} ({:.1f} kB)'.format(
+            i + 1, len(paths), path, os.path.getsize(path) / 1e3,
+            binary_path, os.path.getsize(get_binary_path(path)) / 1e3))
+    print('Converted {} databases in {:.3f} seconds'.format(len(paths), elapsed_time(start_time)))
+
+if __name__ == '__main__':
+    main()
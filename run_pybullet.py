@@ -20,6 +20,8 @@ from src.planner import VIDEO_TEMPLATE
 from src.world import World
 from src.task import TASKS_FNS
 from src.policy import run_policy
+from src.parallel import StreamPool
+from src.store import StreamStore
 #from src.debug import dump_link_cross_sections, test_rays
 
 def create_parser():
@@ -50,6 +52,10 @@ def create_parser():
                         help='When enabled, uses unit action costs.')
     parser.add_argument('-visualize', action='store_true',
                         help='When enabled, visualizes the planning world rather than the simulated world (for debugging).')
+    parser.add_argument('-store', action='store_true',
+                        help='When enabled, reuses the stream outputs stored by previous runs in the same world.')
+    parser.add_argument('-workers', default=0, type=int,
+                        help='The number of processes that speculatively evaluate the expensive streams (0 disables).')
     return parser
     # TODO: get rid of funky orientations by dropping them from some height
 
@@ -81,6 +87,11 @@ def main():
     wait_for_duration(0.1)
     world._update_initial()
     print('Objects:', task.objects)
+    if args.workers:
+        world.stream_pool = StreamPool(world, args.problem, task_kwargs={'num': args.num, 'fixed': args.fixed},
+                                       num_workers=args.workers)
+    if args.store:
+        world.stream_store = StreamStore(world)
     #target_point = get_point(world.get_body(task.objects[0]))
     #set_camera_pose(camera_point=target_point+np.array([-1, 0, 1]), target_point=target_point)
 
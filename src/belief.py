@@ -15,7 +15,8 @@ from pybullet_tools.utils import BodySaver, joint_from_name, LockRenderer, space
     pairwise_collision, elapsed_time, randomize, remove_handles, wait_for_duration, wait_for_user, \
     get_joint_positions, get_joint_name, get_joint_position, GREEN
 from src.command import State, TIN_OBJECTS
-from src.inference import NUM_PARTICLES, PoseDist
+from src.compatibility import JointSampler
+from src.inference import NUM_PARTICLES, PoseDist, update_pose_dists
 from src.observe import fix_detections, relative_detections, ELSEWHERE
 from src.stream import get_stable_gen
 from src.utils import create_relative_pose, RelPose, FConf, are_confs_close, type_from_name
@@ -42,6 +43,7 @@ from src.utils import create_relative_pose, RelPose, FConf, are_confs_close, typ
 MIN_GRASP_WIDTH = 0.005
 REPAIR_DETECTIONS = True
 STOCHASTIC_PLACE = False
+MAX_SAMPLE_ATTEMPTS = 100
 
 ################################################################################
 
@@ -62,6 +64,7 @@ class Belief(object):
         self.color_from_name = dict(zip(self.objects, colors))
         self.observations = []
         self.handles = []
+        self.sampler = JointSampler(world)
 
         # TODO: store state history
         self.base_conf = None
@@ -151,30 +154,52 @@ class Belief(object):
                 detections = relative_detections(self, detections)
                 order = [name for name in detections]  # Detected
                 order.extend(set(self.pose_dists) - set(order))  # Not detected
+                # Detections that do not need the observation model are applied first
+                # The rest share a single ray batch per sampled world
+                batched = []
                 for name in order:
-                    self.pose_dists[name] = self.pose_dists[name].update(
-                        self, detections, n_samples=n_samples)
+                    pose_dist = self.pose_dists[name]
+                    if pose_dist.requires_visibility(detections):
+                        batched.append(pose_dist)
+                    else:
+                        self.pose_dists[name] = pose_dist.update(self, detections, n_samples=n_samples)
+                for pose_dist in update_pose_dists(self, batched, detections, n_samples=n_samples):
+                    self.pose_dists[pose_dist.name] = pose_dist
         self.update_state()
         print('Update time: {:.3f} sec for {} objects and {} samples'.format(
             elapsed_time(start_time), len(order), n_samples))
         return self
 
-    def sample(self, discrete=True):
-        # TODO: timeout if unable to find
-        while True:
-            poses = {}
-            for name, pose_dist in randomize(self.pose_dists.items()):
-                body = self.world.get_body(name)
-                pose = pose_dist.sample_discrete() if discrete else pose_dist.sample()
-                pose.assign()
-                if any(pairwise_collision(body, self.world.get_body(other)) for other in poses):
-                    break
-                poses[name] = pose
-            else:
+    def sample(self, discrete=True, max_attempts=MAX_SAMPLE_ATTEMPTS):
+        # Returns None when no collision-free state is found within max_attempts
+        order = randomize(self.pose_dists)
+        if discrete:
+            indices = self.sampler.sample(self.pose_dists, order, max_attempts=max_attempts)
+            if indices is not None:
+                poses = {name: self.pose_dists[name].particles.get_pose(self.world, name, index)
+                         for name, index in indices.items()}
+                for pose in poses.values():
+                    pose.assign()
                 return poses
+        else:
+            for _ in range(max_attempts):
+                poses = {}
+                for name in order:
+                    body = self.world.get_body(name)
+                    pose = self.pose_dists[name].sample()
+                    pose.assign()
+                    if any(pairwise_collision(body, self.world.get_body(other)) for other in poses):
+                        break
+                    poses[name] = pose
+                else:
+                    return poses
+        print('Warning! Unable to sample a collision-free belief state after {} attempts'.format(max_attempts))
+        return None
 
     def sample_state(self, **kwargs):
         pose_from_name = self.sample(**kwargs)
+        if pose_from_name is None:
+            return None
         world_saver = WorldSaver()
         attachments = []
         for pose in pose_from_name.values():
@@ -0,0 +1,68 @@
+from __future__ import print_function
+
+import numpy as np
+
+# Bounding volume hierarchy over fixed AABBs, split at the median of the widest axis
+LEAF_SIZE = 4
+
+class AABBNode(object):
+    def __init__(self, lower, upper, indices=None, children=[]):
+        self.lower = lower
+        self.upper = upper
+        self.indices = indices # Only leaves store indices
+        self.children = tuple(children)
+
+def aabb_overlaps(lower1, upper1, lower2, upper2):
+    return np.all((lower1 <= upper2) & (lower2 <= upper1), axis=-1)
+
+class AABBTree(object):
+    def __init__(self, keys, aabbs, leaf_size=LEAF_SIZE):
+        self.keys = list(keys)
+        self.index_from_key = {key: index for index, key in enumerate(self.keys)}
+        self.lowers = np.array([lower for lower, _ in aabbs], dtype=np.float64).reshape(-1, 3)
+        self.uppers = np.array([upper for _, upper in aabbs], dtype=np.float64).reshape(-1, 3)
+        self.leaf_size = leaf_size
+        self.root = self.build(np.arange(len(self.keys))) if self.keys else None
+        self.num_queries = 0
+        self.num_culled = 0
+        self.num_narrow = 0
+    def build(self, indices):
+        lower = np.min(self.lowers[indices], axis=0)
+        upper = np.max(self.uppers[indices], axis=0)
+        if len(indices) <= self.leaf_size:
+            return AABBNode(lower, upper, indices=indices)
+        centers = (self.lowers[indices] + self.uppers[indices]) / 2.
+        axis = np.argmax(upper - lower)
+        order = indices[np.argsort(centers[:, axis], kind='mergesort')]
+        middle = len(order) // 2
+        return AABBNode(lower, upper, children=[self.build(order[:middle]), self.build(order[middle:])])
+    def __len__(self):
+        return len(self.keys)
+    def __contains__(self, key):
+        return key in self.index_from_key
+    def get_aabb(self, key):
+        index = self.index_from_key[key]
+        return self.lowers[index], self.uppers[index]
+    def query(self, aabb):
+        # Returns the keys whose AABBs overlap aabb
+        self.num_queries += 1
+        if self.root is None:
+            return set()
+        lower, upper = np.array(aabb[0]), np.array(aabb[1])
+        keys = set()
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if not aabb_overlaps(node.lower, node.upper, lower, upper):
+                continue
+            if node.indices is None:
+                stack.extend(node.children)
+                continue
+            mask = aabb_overlaps(self.lowers[node.indices], self.uppers[node.indices], lower, upper)
+            keys.update(self.keys[index] for index in node.indices[mask])
+        return keys
+    def reset_statistics(self):
+        self.num_queries = self.num_culled = self.num_narrow = 0
+    def __repr__(self):
+        return '{}(n={}, queries={}, culled={}, narrow={})'.format(
+            self.__class__.__name__, len(self), self.num_queries, self.num_culled, self.num_narrow)
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+
+INF = float('inf')
+
+def unit_size(value):
+    return 1
+
+class LRUCache(object):
+    # Bounded mapping that evicts the least recently used entries first
+    def __init__(self, max_size=INF, size_fn=unit_size):
+        self.max_size = max_size
+        self.size_fn = size_fn
+        self.entries = OrderedDict() # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    @property
+    def queries(self):
+        return self.hits + self.misses
+    @property
+    def hit_rate(self):
+        if not self.queries:
+            return 0.
+        return float(self.hits) / self.queries
+    def __len__(self):
+        return len(self.entries)
+    def __contains__(self, key):
+        return key in self.entries
+    def peek(self, key, default=None):
+        # Does not affect the statistics or the eviction order
+        if key not in self.entries:
+            return default
+        value, _ = self.entries[key]
+        return value
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value, size = self.entries.pop(key)
+        self.entries[key] = (value, size)
+        return value
+    def set(self, key, value):
+        self.pop(key)
+        size = self.size_fn(value)
+        self.entries[key] = (value, size)
+        self.size += size
+        while (self.max_size < self.size) and (1 < len(self.entries)):
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+        return value
+    def pop(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value, size = self.entries.pop(key)
+        self.size -= size
+        return value
+    def values(self):
+        return [value for value, _ in self.entries.values()]
+    def items(self):
+        # Least recently used first
+        return [(key, value) for key, (value, _) in self.entries.items()]
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+        self.reset_statistics()
+    def reset_statistics(self):
+        self.hits = self.misses = self.evictions = 0
+    def __repr__(self):
+        return '{}(entries={}, size={}, hits={}, misses={}, hit_rate={:.3f}, evictions={})'.format(
+            self.__class__.__name__, len(self), self.size, self.hits, self.misses, self.hit_rate, self.evictions)
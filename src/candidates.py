@@ -0,0 +1,147 @@
+from __future__ import print_function
+
+import numpy as np
+
+from pybullet_tools.utils import BodySaver, get_aabb, get_link_pose, get_custom_limits, set_joint_positions, \
+    point_from_pose
+from src.reachability import OccupancyGrid
+from src.utils import get_obstacle_aabb
+
+# Staged filtering of base conf candidates before the expensive test_base_conf, IK and motion planning
+# Stage one rejects a whole batch at once with vectorized limit, reach and footprint tests
+# Stage two ranks the survivors by a reachability score and only keeps the top-k
+TOP_K = 10
+FOOTPRINT_RESOLUTION = 0.05 # meters
+FOOTPRINT_SCALE = 0.5 # Fraction of the chassis AABB treated as solid around the base origin
+MAX_FOOTPRINT_CELLS = 50000
+MAX_ARM_REACH = 1.4 # meters between the arm base link and the tool (conservative for the Panda)
+PREFERRED_REACH = 0.6 # meters
+STAGES = ['limits', 'reach', 'footprint', 'ranking', 'collision', 'plan']
+
+class CandidateStatistics(object):
+    def __init__(self, name):
+        self.name = name
+        self.reset_statistics()
+    def reset_statistics(self):
+        self.num_candidates = 0
+        self.num_accepted = 0
+        self.rejections = {stage: 0 for stage in STAGES}
+    def reject(self, stage, count=1):
+        self.rejections[stage] += int(count)
+    def __repr__(self):
+        return '{}({}, candidates={}, {}, accepted={})'.format(
+            self.__class__.__name__, self.name, self.num_candidates,
+            ', '.join('{}={}'.format(stage, self.rejections[stage]) for stage in STAGES), self.num_accepted)
+
+def get_candidate_statistics(world, name):
+    if name not in world.candidate_statistics:
+        world.candidate_statistics[name] = CandidateStatistics(name)
+    return world.candidate_statistics[name]
+
+def reset_candidate_statistics(world):
+    for statistics in world.candidate_statistics.values():
+        statistics.reset_statistics()
+
+def report_candidate_statistics(world):
+    for name in sorted(world.candidate_statistics):
+        print('Candidates:', world.candidate_statistics[name])
+
+################################################################################
+
+def get_base_limits(world):
+    lower, upper = get_custom_limits(world.robot, world.base_joints, world.custom_limits)
+    return np.array(lower, dtype=np.float64), np.array(upper, dtype=np.float64)
+
+def get_robot_geometry(world):
+    # The arm base link and the chassis AABB in the base frame
+    if 'robot_geometry' not in world.scene_cache:
+        with BodySaver(world.robot):
+            set_joint_positions(world.robot, world.base_joints, np.zeros(len(world.base_joints)))
+            arm_point = np.array(point_from_pose(get_link_pose(world.robot, world.franka_link)))
+            chassis_aabb = tuple(map(np.array, get_aabb(world.robot, world.base_link)))
+        world.scene_cache['robot_geometry'] = (arm_point, chassis_aabb)
+    return world.scene_cache['robot_geometry']
+
+def get_arm_points(world, base_values):
+    arm_point, _ = get_robot_geometry(world)
+    x, y, theta = base_values.T
+    c, s = np.cos(theta), np.sin(theta)
+    return np.stack([x + c*arm_point[0] - s*arm_point[1],
+                     y + s*arm_point[0] + c*arm_point[1],
+                     np.full(len(base_values), arm_point[2])], axis=1)
+
+def build_footprint_grid(world, lower, upper, resolution=FOOTPRINT_RESOLUTION):
+    # Cells where a disc inside the chassis already overlaps a static obstacle AABB at the chassis height
+    # The disc is shrunk by half a cell diagonal so the test holds for any base position within the cell
+    # Rasterized from the AABBs, which are exact for the axis-aligned kitchen links, without any collision queries
+    _, (chassis_lower, chassis_upper) = get_robot_geometry(world)
+    while np.prod(np.ceil((upper - lower) / resolution)) > MAX_FOOTPRINT_CELLS:
+        resolution *= 2
+    inscribed = min(-chassis_lower[0], chassis_upper[0], -chassis_lower[1], chassis_upper[1])
+    radius = FOOTPRINT_SCALE*inscribed - resolution*np.sqrt(2)/2
+    shape = tuple(np.ceil((upper - lower) / resolution).astype(int))
+    mask = np.zeros(shape, dtype=bool)
+    if radius <= 0:
+        return OccupancyGrid(lower, resolution, mask)
+    z = (chassis_lower[2] + chassis_upper[2]) / 2
+    height = FOOTPRINT_SCALE*(chassis_upper[2] - chassis_lower[2])
+    xs = lower[0] + resolution*(np.arange(shape[0]) + 0.5)
+    ys = lower[1] + resolution*(np.arange(shape[1]) + 0.5)
+    for obstacle in world.static_obstacles:
+        obstacle_lower, obstacle_upper = map(np.array, get_obstacle_aabb(obstacle))
+        if (obstacle_upper[2] < z - height/2) or (z + height/2 < obstacle_lower[2]):
+            continue
+        dx = np.maximum(np.maximum(obstacle_lower[0] - xs, xs - obstacle_upper[0]), 0.)
+        dy = np.maximum(np.maximum(obstacle_lower[1] - ys, ys - obstacle_upper[1]), 0.)
+        mask |= (np.square(dx)[:, None] + np.square(dy)[None, :]) < radius**2
+    return OccupancyGrid(lower, resolution, mask)
+
+def get_footprint_grid(world):
+    # Rebuilt whenever the scene is invalidated
+    lower, upper = get_base_limits(world)
+    if not np.all(np.isfinite(lower[:2])) or not np.all(np.isfinite(upper[:2])):
+        return None
+    grids = world.scene_cache.setdefault('footprint_grids', {})
+    key = tuple(np.round(np.concatenate([lower[:2], upper[:2]]), 3).tolist())
+    if key not in grids:
+        grids[key] = build_footprint_grid(world, lower[:2], upper[:2])
+    return grids[key]
+
+def get_reach_scores(world, base_values, tool_pose):
+    # Prefers tool positions in the middle of the arm's workspace
+    distances = np.linalg.norm(get_arm_points(world, base_values) - np.array(point_from_pose(tool_pose)), axis=1)
+    return -np.abs(distances - PREFERRED_REACH)
+
+################################################################################
+
+def filter_base_candidates(world, base_values, obstacles=set(), tool_pose=None, score_fn=None, top_k=TOP_K,
+                           statistics=None):
+    # Returns the surviving base values, best first when tool_pose or score_fn is given
+    # score_fn (e.g. a learned reachability model) replaces the reach heuristic
+    base_values = np.array(base_values, dtype=np.float64).reshape(-1, len(world.base_joints))
+    if statistics is not None:
+        statistics.num_candidates += len(base_values)
+    def reject(stage, mask):
+        if statistics is not None:
+            statistics.reject(stage, np.count_nonzero(~mask))
+        return base_values[mask]
+
+    lower, upper = get_base_limits(world)
+    base_values = reject('limits', np.all((lower <= base_values) & (base_values <= upper), axis=1))
+    if tool_pose is not None:
+        distances = np.linalg.norm(get_arm_points(world, base_values) - np.array(point_from_pose(tool_pose)), axis=1)
+        base_values = reject('reach', distances <= MAX_ARM_REACH)
+    if world.static_obstacles <= set(obstacles):
+        grid = get_footprint_grid(world)
+        if grid is not None:
+            base_values = reject('footprint', ~grid.contains_points(base_values))
+    if score_fn is None:
+        if tool_pose is None:
+            return base_values
+        score_fn = lambda values: get_reach_scores(world, values, tool_pose)
+    if not len(base_values):
+        return base_values
+    order = np.argsort(-score_fn(base_values), kind='mergesort')[:top_k]
+    if statistics is not None:
+        statistics.reject('ranking', len(base_values) - len(order))
+    return base_values[order]
@@ -0,0 +1,201 @@
+from __future__ import print_function
+
+import numpy as np
+
+from pybullet_tools.pr2_primitives import Conf
+from pybullet_tools.utils import Attachment, get_joint_positions, get_aabb, get_all_links, get_moving_links, \
+    get_movable_joints, set_joint_positions, pairwise_collision, get_pose
+from src.cache import LRUCache
+from src.command import Sequence, State, Trajectory, DoorTrajectory, Attach, Detach
+from src.utils import RelPose, Grasp, get_obstacle_aabb
+
+# Memoized collision tests keyed on the values of their arguments
+# Keys are structural (rounded poses and confs) so equal values created by different stream calls share results
+DECIMALS = 6
+MAX_COLLISION_ENTRIES = 100000
+
+COLLISION_CACHE = LRUCache(max_size=MAX_COLLISION_ENTRIES)
+
+def round_values(values):
+    return tuple(np.round(np.array(values, dtype=np.float64).flatten(), DECIMALS).tolist())
+
+def pose_key(pose):
+    point, quat = pose
+    return round_values(point) + round_values(quat)
+
+def saver_key(saver):
+    # WorldSaver, BodySaver, PoseSaver and ConfSaver
+    if hasattr(saver, 'body_savers'):
+        keys = tuple(saver_key(body_saver) for body_saver in saver.body_savers)
+    elif hasattr(saver, 'savers'):
+        keys = tuple(saver_key(child) for child in saver.savers)
+    elif hasattr(saver, 'pose'):
+        return ('pose', saver.body, pose_key(saver.pose))
+    elif hasattr(saver, 'conf'):
+        return ('conf', saver.body, round_values(saver.conf))
+    else:
+        return None
+    if any(key is None for key in keys):
+        return None
+    return keys
+
+def command_key(world, command):
+    if isinstance(command, DoorTrajectory):
+        return (command.__class__.__name__, command.robot, command.robot_joints, round_values(command.robot_path),
+                command.door, command.door_joints, round_values(command.door_path))
+    if isinstance(command, Trajectory):
+        return (command.__class__.__name__, command.robot, command.joints, round_values(command.path))
+    if isinstance(command, (Attach, Detach)):
+        return (command.__class__.__name__, command.robot, command.link, command.body,
+                value_key(world, getattr(command, 'grasp', None)))
+    return None
+
+def value_key(world, value):
+    # Returns None when the value cannot be keyed safely
+    if (value is None) or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, Attachment):
+        if value.parent != world.kitchen:
+            return None # The parent might move
+        return ('Attachment', value.parent, value.parent_link, value.child, pose_key(value.grasp_pose))
+    if isinstance(value, Conf):
+        return ('Conf', value.body, tuple(value.joints), round_values(value.values))
+    if isinstance(value, RelPose):
+        return ('RelPose', value.body, value.support, value_key(world, value.confs)) if value.confs else None
+    if isinstance(value, Grasp):
+        return ('Grasp', value.body_name, value.grasp_type, pose_key(value.grasp_pose),
+                pose_key(value.pregrasp_pose), round_values([value.grasp_width]))
+    if isinstance(value, State):
+        keys = tuple(saver_key(saver) for saver in value.savers) + \
+               tuple(value_key(world, value.attachments[child]) for child in sorted(value.attachments))
+        return None if any(key is None for key in keys) else keys
+    if isinstance(value, Sequence):
+        keys = (value_key(world, value.context),) + tuple(command_key(world, command) for command in value.commands)
+        return None if any(key is None for key in keys) else ('Sequence',) + keys
+    if isinstance(value, tuple):
+        keys = tuple(value_key(world, element) for element in value)
+        return None if any((key is None) and (element is not None) for key, element in zip(keys, value)) else keys
+    return None
+
+def get_static_key(world):
+    # The tests assign the kitchen joints they depend on through the confs of their world poses, and the relative
+    # poses they compare on one surface move together, so the transient door state is left out of the key
+    return (world.kitchen, pose_key(get_pose(world.kitchen)))
+
+def cache_collision_test(world, name, test, cache=COLLISION_CACHE):
+    def cached_test(*args):
+        keys = tuple(value_key(world, arg) for arg in args)
+        if any(key is None for key in keys):
+            return test(*args)
+        key = (name, get_static_key(world), keys)
+        result = cache.get(key)
+        if result is None:
+            result = cache.set(key, bool(test(*args)))
+        return result
+    return cached_test
+
+################################################################################
+
+# Swept AABB hierarchies over the moving links of trajectories
+# Each level halves the number of waypoint AABBs so a query only descends into overlapping segments
+
+def aabbs_overlap(lowers, uppers, aabb):
+    lower, upper = aabb
+    return np.all((lowers <= upper) & (lower <= uppers), axis=-1)
+
+class SweptVolume(object):
+    def __init__(self, robot, links, lowers, uppers):
+        # lowers, uppers: (num_links, num_waypoints, 3)
+        self.robot = robot
+        self.links = tuple(links)
+        self.levels = [(np.array(lowers), np.array(uppers))]
+        while self.levels[-1][0].shape[1] > 1:
+            lowers, uppers = self.levels[-1]
+            if lowers.shape[1] % 2 == 1:
+                lowers = np.concatenate([lowers, lowers[:, -1:]], axis=1)
+                uppers = np.concatenate([uppers, uppers[:, -1:]], axis=1)
+            self.levels.append((np.minimum(lowers[:, 0::2], lowers[:, 1::2]),
+                                np.maximum(uppers[:, 0::2], uppers[:, 1::2])))
+        self.levels.reverse() # Root first
+        self.results = {}
+    @property
+    def num_waypoints(self):
+        return self.levels[-1][0].shape[1]
+    def candidates(self, aabb):
+        # Returns {link: waypoint indices whose link AABB overlaps aabb}
+        candidates = {}
+        for i, link in enumerate(self.links):
+            indices = np.array([0])
+            for depth, (lowers, uppers) in enumerate(self.levels):
+                indices = indices[indices < lowers.shape[1]]
+                indices = indices[aabbs_overlap(lowers[i, indices], uppers[i, indices], aabb)]
+                if not len(indices):
+                    break
+                if depth < len(self.levels) - 1:
+                    indices = np.concatenate([2*indices, 2*indices + 1])
+            if len(indices):
+                candidates[link] = np.sort(indices)
+        return candidates
+    def __repr__(self):
+        return '{}(links={}, waypoints={})'.format(self.__class__.__name__, len(self.links), self.num_waypoints)
+
+def get_command_path(command):
+    # Robot joints, robot path and the optional door joints and path that iterate assigns
+    if hasattr(command, 'door_path'):
+        return command.robot_joints, command.robot_path, command.door, command.door_joints, command.door_path
+    return command.joints, command.path, None, (), ()
+
+def set_command_waypoint(command, index):
+    joints, path, door, door_joints, door_path = get_command_path(command)
+    set_joint_positions(command.robot, joints, path[index])
+    if door is not None:
+        set_joint_positions(door, door_joints, door_path[index])
+
+def get_swept_volume(command):
+    # Cached on the command per configuration of the joints it does not move
+    joints, path, _, _, _ = get_command_path(command)
+    static_joints = [joint for joint in get_movable_joints(command.robot) if joint not in joints]
+    key = round_values(get_joint_positions(command.robot, static_joints))
+    if not hasattr(command, 'swept_volumes'):
+        command.swept_volumes = {}
+    if key not in command.swept_volumes:
+        links = sorted(get_moving_links(command.robot, joints))
+        lowers = np.zeros((len(links), len(path), 3))
+        uppers = np.zeros((len(links), len(path), 3))
+        for index in range(len(path)):
+            set_command_waypoint(command, index)
+            for i, link in enumerate(links):
+                lowers[i, index], uppers[i, index] = get_aabb(command.robot, link)
+        command.swept_volumes[key] = SweptVolume(command.robot, links, lowers, uppers)
+    return command.swept_volumes[key]
+
+def command_collision(command, obstacles):
+    # Equivalent to checking the whole robot against the obstacles at every waypoint
+    # Assumes the obstacles do not move during the command and leaves the robot at the final waypoint
+    _, path, _, _, _ = get_command_path(command)
+    if not path:
+        return False
+    swept_volume = get_swept_volume(command)
+    static_links = frozenset(get_all_links(command.robot)) - frozenset(swept_volume.links)
+    collision = False
+    for obstacle in obstacles:
+        aabb = get_obstacle_aabb(obstacle)
+        key = (obstacle, round_values(aabb))
+        if key not in swept_volume.results:
+            set_command_waypoint(command, 0)
+            result = bool(static_links) and pairwise_collision((command.robot, static_links), obstacle)
+            if not result:
+                for link, indices in swept_volume.candidates(aabb).items():
+                    for index in indices:
+                        set_command_waypoint(command, index)
+                        if pairwise_collision((command.robot, frozenset([link])), obstacle):
+                            result = True
+                            break
+                    if result:
+                        break
+            swept_volume.results[key] = result
+        if swept_volume.results[key]:
+            collision = True
+            break
+    set_command_waypoint(command, len(path) - 1)
+    return collision
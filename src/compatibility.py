@@ -0,0 +1,117 @@
+from __future__ import print_function
+
+import numpy as np
+
+from pybullet_tools.utils import get_aabb, get_aabb_vertices, get_pose, point_from_pose, set_pose, pairwise_collision
+from src.database import pose_from_row
+
+# Pairwise collision-freeness between the particles of two objects
+# Entries are only collision checked when the bounding spheres overlap and the entry is queried
+UNKNOWN, INCOMPATIBLE, COMPATIBLE = -1, 0, 1
+
+def get_body_radius(body):
+    # Bounds the body about its origin for any orientation
+    vertices = np.array(get_aabb_vertices(get_aabb(body)))
+    return np.max(np.linalg.norm(vertices - np.array(point_from_pose(get_pose(body))), axis=1))
+
+class CompatibilityTable(object):
+    def __init__(self, body1, ids1, rows1, body2, ids2, rows2, radius):
+        self.bodies = (body1, body2)
+        self.ids = (ids1, ids2)
+        self.rows = (rows1, rows2)
+        distances = np.linalg.norm(rows1[:, np.newaxis, :3] - rows2[np.newaxis, :, :3], axis=2)
+        self.table = np.full(distances.shape, COMPATIBLE, dtype=np.int8)
+        self.table[distances < radius] = UNKNOWN
+        self.num_checks = 0
+    def is_valid(self, ids1, rows1, ids2, rows2):
+        return np.array_equal(self.ids[0], ids1) and np.array_equal(self.ids[1], ids2) and \
+               np.array_equal(self.rows[0], rows1) and np.array_equal(self.rows[1], rows2)
+    def check(self, index1, index2):
+        if self.table[index1, index2] == UNKNOWN:
+            body1, body2 = self.bodies
+            set_pose(body1, pose_from_row(self.rows[0][index1]))
+            set_pose(body2, pose_from_row(self.rows[1][index2]))
+            self.table[index1, index2] = INCOMPATIBLE if pairwise_collision(body1, body2) else COMPATIBLE
+            self.num_checks += 1
+        return self.table[index1, index2] == COMPATIBLE
+    def compatible(self, side, index):
+        # Mask over the particles of one side that are compatible with particle index of the other
+        if side == 0:
+            values = self.table[:, index]
+            pairs = [(i, index) for i in np.flatnonzero(values == UNKNOWN)]
+        else:
+            values = self.table[index, :]
+            pairs = [(index, i) for i in np.flatnonzero(values == UNKNOWN)]
+        for index1, index2 in pairs:
+            self.check(index1, index2)
+        return values == COMPATIBLE
+    def __repr__(self):
+        return '{}(shape={}, unknown={}, checks={})'.format(
+            self.__class__.__name__, self.table.shape, np.count_nonzero(self.table == UNKNOWN), self.num_checks)
+
+################################################################################
+
+class JointSampler(object):
+    # Sequentially conditions each object's particles on the particles chosen for the previous objects
+    def __init__(self, world):
+        self.world = world
+        self.tables = {}
+        self.radii = {}
+        self.num_samples = 0
+        self.num_attempts = 0
+        self.num_failures = 0
+    @property
+    def acceptance_rate(self):
+        return float(self.num_samples) / self.num_attempts if self.num_attempts else 1.
+    @property
+    def num_checks(self):
+        return sum(table.num_checks for table in self.tables.values())
+    def get_radius(self, name):
+        if name not in self.radii:
+            self.radii[name] = get_body_radius(self.world.get_body(name))
+        return self.radii[name]
+    def get_table(self, name1, name2, ids, rows):
+        key = (name1, name2)
+        table = self.tables.get(key)
+        if (table is None) or not table.is_valid(ids[name1], rows[name1], ids[name2], rows[name2]):
+            table = CompatibilityTable(self.world.get_body(name1), ids[name1], rows[name1],
+                                       self.world.get_body(name2), ids[name2], rows[name2],
+                                       radius=self.get_radius(name1) + self.get_radius(name2))
+            self.tables[key] = table
+        return table
+    def compatible(self, name1, name2, index2, ids, rows):
+        # Mask over the particles of name1 compatible with particle index2 of name2
+        if name1 < name2:
+            return self.get_table(name1, name2, ids, rows).compatible(0, index2)
+        return self.get_table(name2, name1, ids, rows).compatible(1, index2)
+    def sample(self, pose_dists, order, max_attempts=100):
+        # Returns {name: particle index} or None after max_attempts dead ends
+        ids = {name: pose_dists[name].particles.ids for name in order}
+        rows = {name: pose_dists[name].particles.get_world_rows() for name in order}
+        for _ in range(max_attempts):
+            self.num_attempts += 1
+            indices = {}
+            for name in order:
+                weights = pose_dists[name].particles.weights.copy()
+                for other, index in indices.items():
+                    weights *= self.compatible(name, other, index, ids, rows)
+                    if not np.any(weights):
+                        break
+                total = np.sum(weights)
+                if total <= 0:
+                    break
+                cumulative = np.cumsum(weights)
+                index = np.searchsorted(cumulative, np.random.uniform(0, total), side='right')
+                indices[name] = min(index, len(weights) - 1)
+            else:
+                self.num_samples += 1
+                return indices
+        self.num_failures += 1
+        return None
+    def reset_statistics(self):
+        self.num_samples = self.num_attempts = self.num_failures = 0
+        for table in self.tables.values():
+            table.num_checks = 0
+    def __repr__(self):
+        return '{}(samples={}, acceptance={:.3f}, failures={}, checks={})'.format(
+            self.__class__.__name__, self.num_samples, self.acceptance_rate, self.num_failures, self.num_checks)
@@ -1,10 +1,16 @@
+import json
 import os
 import random
+import struct
+import numpy as np
 
 from pybullet_tools.utils import read_json, link_from_name, get_link_pose, multiply, \
     euler_from_quat, draw_point, wait_for_user, set_joint_positions, joints_from_names, parent_link_from_joint, has_gui, \
-    point_from_pose, RED, child_link_from_joint, get_pose, get_point, invert, base_values_from_pose
-from src.utils import GRASP_TYPES, surface_from_name, BASE_JOINTS, joint_from_name, unit_pose, ALL_SURFACES, KNOBS
+    point_from_pose, RED, child_link_from_joint, get_pose, get_point, invert, base_values_from_pose, write_json, \
+    safe_remove
+from src.utils import GRASP_TYPES, surface_from_name, BASE_JOINTS, joint_from_name, unit_pose, ALL_SURFACES, KNOBS, \
+    multiply_pose_rows, invert_pose_rows, base_values_from_pose_rows
+from src.cache import LRUCache
 
 DATABASE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'databases/')
 PLACE_IR_FILENAME = '{robot_name}-{surface_name}-{grasp_type}-place.json'
@@ -13,6 +19,19 @@ PLACE_IR_FILENAME = '{robot_name}-{surface_name}-{grasp_type}-place.json'
 PULL_IR_FILENAME = '{}-{}-pull.json'
 PRESS_IR_FILENAME = '{}-{}-press.json'
 
+# Binary databases mirror the json entries as contiguous float64 pose arrays
+BINARY_EXTENSION = '.bin'
+BINARY_MAGIC = b'SSIRDB\x00\x00'
+BINARY_VERSION = 1
+BINARY_HEADER = '<8sqqq' # magic, version, num_entries, num_fields
+FIELD_LENGTH = 32 # bytes per field name
+POSE_LENGTH = 7 # x, y, z, qx, qy, qz, qw
+
+# Collection workers append one json record per attempt to a shared shard
+SHARD_EXTENSION = '.shard'
+
+MAX_CACHE_BYTES = 256 * 1024**2 # memory-mapped arrays only count their mapped size
+
 def get_surface_reference_pose(kitchen, surface_name):
     surface = surface_from_name(surface_name)
     link = link_from_name(kitchen, surface.link)
@@ -28,29 +47,218 @@ def project_base_pose(base_pose):
 
 ################################################################################
 
+def row_from_pose(pose):
+    point, quat = pose
+    return np.concatenate([point, quat])
+
+def pose_from_row(row):
+    values = np.asarray(row).tolist()
+    return tuple(values[:3]), tuple(values[3:POSE_LENGTH])
+
+def get_binary_path(path):
+    return os.path.splitext(path)[0] + BINARY_EXTENSION
+
+def has_binary_database(path):
+    # Ignores binary databases that are older than their json source
+    binary_path = get_binary_path(path)
+    if not os.path.exists(binary_path):
+        return False
+    return not os.path.exists(path) or (os.path.getmtime(path) <= os.path.getmtime(binary_path))
+
+def write_binary_database(path, entries, fields):
+    data = np.array([[row_from_pose(entry[field]) for entry in entries] for field in fields],
+                    dtype=np.float64).reshape(len(fields), len(entries), POSE_LENGTH)
+    with open(path, 'wb') as f:
+        f.write(struct.pack(BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, len(entries), len(fields)))
+        for field in fields:
+            f.write(struct.pack('{}s'.format(FIELD_LENGTH), field.encode('ascii')))
+        data.tofile(f)
+    return path
+
+def read_binary_database(path):
+    with open(path, 'rb') as f:
+        header = f.read(struct.calcsize(BINARY_HEADER))
+        magic, version, num_entries, num_fields = struct.unpack(BINARY_HEADER, header)
+        if magic != BINARY_MAGIC:
+            raise ValueError('{} is not a binary database'.format(path))
+        if version != BINARY_VERSION:
+            raise ValueError('{} has version {} instead of {}'.format(path, version, BINARY_VERSION))
+        fields = [f.read(FIELD_LENGTH).rstrip(b'\x00').decode('ascii') for _ in range(num_fields)]
+        offset = f.tell()
+    if num_entries == 0:
+        return {field: np.zeros((0, POSE_LENGTH)) for field in fields}
+    data = np.memmap(path, dtype=np.float64, mode='r', offset=offset,
+                     shape=(num_fields, num_entries, POSE_LENGTH))
+    return {field: data[i] for i, field in enumerate(fields)}
+
+def convert_database(path):
+    entries = read_json(path).get('entries', [])
+    fields = sorted(entries[0]) if entries else []
+    return write_binary_database(get_binary_path(path), entries, fields)
+
+def load_database_array(path, field):
+    if has_binary_database(path):
+        arrays = read_binary_database(get_binary_path(path))
+        if field in arrays:
+            return arrays[field]
+    if not os.path.exists(path):
+        return np.zeros((0, POSE_LENGTH))
+    rows = [row_from_pose(entry[field]) for entry in read_json(path).get('entries', [])]
+    return np.array(rows, dtype=np.float64).reshape(len(rows), POSE_LENGTH)
+
+def randomize_indices(num):
+    # Shuffles a permutation rather than the (shared) cached rows
+    indices = list(range(num))
+    random.shuffle(indices)
+    return indices
+
+def sample_indices(weights):
+    # A permutation drawn without replacement in proportion to the weights (Gumbel top-k)
+    weights = np.asarray(weights, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        keys = np.log(weights) + np.random.gumbel(size=len(weights))
+    return np.argsort(-keys, kind='mergesort').tolist()
+
+def get_indices(num, weights=None):
+    if weights is None:
+        return randomize_indices(num)
+    assert len(weights) == num
+    return sample_indices(weights)
+
+################################################################################
+
+def get_cached_size(value):
+    _, array = value
+    return array.nbytes
+
+DATABASE_CACHE = LRUCache(max_size=MAX_CACHE_BYTES, size_fn=get_cached_size)
+
+def set_database_cache_size(max_size):
+    DATABASE_CACHE.max_size = max_size
+    return DATABASE_CACHE
+
+def get_database_mtimes(path):
+    return tuple(os.path.getmtime(p) if os.path.exists(p) else None
+                 for p in [path, get_binary_path(path)])
+
+def load_cached_array(key, path, field):
+    # key = (robot_name, surface/joint name, grasp_type, field)
+    mtimes = get_database_mtimes(path)
+    cached = DATABASE_CACHE.peek(key)
+    if (cached is not None) and (cached[0] != mtimes):
+        DATABASE_CACHE.pop(key)
+    cached = DATABASE_CACHE.get(key)
+    if cached is not None:
+        return cached[1]
+    array = load_database_array(path, field)
+    array.flags.writeable = False
+    DATABASE_CACHE.set(key, (mtimes, array))
+    return array
+
+################################################################################
+
+def get_shard_path(path):
+    return os.path.splitext(path)[0] + SHARD_EXTENSION
+
+def append_shard(shard_path, entry=None, failure=True):
+    # A single O_APPEND write per record keeps concurrent workers from interleaving
+    # The leading newline separates it from a record truncated by an interrupted run
+    # failure can be a failed entry (e.g. the tool_from_base of a base conf that failed)
+    record = {'failure': failure} if entry is None else {'entry': entry}
+    line = '\n' + json.dumps(record, sort_keys=True)
+    with open(shard_path, 'a') as f:
+        f.write(line)
+        f.flush()
+    return record
+
+def read_shard(shard_path):
+    # Returns the entries, the number of failed attempts and the failed entries
+    entries = []
+    failures = 0
+    failed_entries = []
+    if not os.path.exists(shard_path):
+        return entries, failures, failed_entries
+    with open(shard_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # Truncated by an interrupted worker
+            if 'entry' in record:
+                entries.append(record['entry'])
+            elif isinstance(record['failure'], dict):
+                failed_entries.append(record['failure'])
+            else:
+                failures += 1
+    return entries, failures, failed_entries
+
+def merge_shard(path, data):
+    shard_path = get_shard_path(path)
+    entries, failures, failed_entries = read_shard(shard_path)
+    if not entries:
+        safe_remove(path)
+        safe_remove(shard_path)
+        return None
+    data = dict(data)
+    data.update({
+        'entries': entries,
+        'failures': failures,
+        'successes': len(entries),
+        'failed_entries': failed_entries,
+    })
+    write_json(path, data)
+    safe_remove(shard_path)
+    return data
+
+def split_samples(num_samples, num_workers):
+    num_workers = max(1, num_workers)
+    return [num_samples // num_workers + int(i < (num_samples % num_workers)) for i in range(num_workers)]
+
+################################################################################
+
 def get_place_path(robot_name, surface_name, grasp_type):
     return os.path.abspath(os.path.join(DATABASE_DIRECTORY, PLACE_IR_FILENAME.format(
         robot_name=robot_name, surface_name=surface_name, grasp_type=grasp_type)))
 
 def has_place_database(robot_name, surface_name, grasp_type):
-    return os.path.exists(get_place_path(robot_name, surface_name, grasp_type))
+    path = get_place_path(robot_name, surface_name, grasp_type)
+    return os.path.exists(path) or has_binary_database(path)
 
 def load_place_entries(robot_name, surface_name, grasp_type):
-    if not has_place_database(robot_name, surface_name, grasp_type):
+    # Entries of a binary-only database only have their pose fields
+    path = get_place_path(robot_name, surface_name, grasp_type)
+    if os.path.exists(path):
+        return read_json(path).get('entries', [])
+    if not has_binary_database(path):
         return []
-    return read_json(get_place_path(robot_name, surface_name, grasp_type)).get('entries', [])
+    arrays = read_binary_database(get_binary_path(path))
+    num_entries = min(len(rows) for rows in arrays.values()) if arrays else 0
+    return [{field: pose_from_row(rows[i]) for field, rows in arrays.items()} for i in range(num_entries)]
+
+def load_place_array(robot_name, surface_name, grasp_type, field):
+    key = (robot_name, surface_name, grasp_type, field)
+    return load_cached_array(key, get_place_path(robot_name, surface_name, grasp_type), field)
+
+def load_place_failure_array(robot_name, surface_name, grasp_type, field='tool_from_base'):
+    # Only kept in the json database
+    path = get_place_path(robot_name, surface_name, grasp_type)
+    if not os.path.exists(path):
+        return np.zeros((0, POSE_LENGTH))
+    rows = [row_from_pose(entry[field]) for entry in read_json(path).get('failed_entries', [])]
+    return np.array(rows, dtype=np.float64).reshape(len(rows), POSE_LENGTH)
 
 def load_place_database(robot_name, surface_name, grasp_type, field):
-    return [entry[field] for entry in load_place_entries(robot_name, surface_name, grasp_type)]
+    return list(map(pose_from_row, load_place_array(robot_name, surface_name, grasp_type, field)))
 
-def load_placements(world, surface_name, grasp_types=GRASP_TYPES):
+def load_placement_array(world, surface_name, grasp_types=GRASP_TYPES):
     # TODO: could also annotate which grasp came with which placement
-    placements = []
-    for grasp_type in grasp_types:
-        placements.extend(load_place_database(world.robot_name, surface_name, grasp_type,
-                                              field='surface_from_object'))
-    random.shuffle(placements)
-    return placements
+    return np.concatenate([np.zeros((0, POSE_LENGTH))] + [
+        load_place_array(world.robot_name, surface_name, grasp_type, field='surface_from_object')
+        for grasp_type in grasp_types])
+
+def load_placements(world, surface_name, grasp_types=GRASP_TYPES):
+    rows = load_placement_array(world, surface_name, grasp_types=grasp_types)
+    return [pose_from_row(rows[index]) for index in randomize_indices(len(rows))]
 
 def load_forward_placements(world, surface_names=ALL_SURFACES, grasp_types=GRASP_TYPES):
     base_from_objects = []
@@ -60,16 +268,18 @@ def load_forward_placements(world, surface_names=ALL_SURFACES, grasp_types=GRASP
                                                          field='base_from_object'))
     return base_from_objects
 
-def load_place_base_poses(world, tool_pose, surface_name, grasp_type):
+def load_place_base_array(world, tool_pose, surface_name, grasp_type):
+    gripper_from_base_array = load_place_array(world.robot_name, surface_name, grasp_type,
+                                               field='tool_from_base')
+    #world_from_model = get_pose(world.robot)
+    return base_values_from_pose_rows(multiply_pose_rows(row_from_pose(tool_pose), gripper_from_base_array))
+
+def load_place_base_poses(world, tool_pose, surface_name, grasp_type, weights=None):
     # TODO: Gaussian perturbation
-    gripper_from_base_list = load_place_database(world.robot_name, surface_name, grasp_type,
-                                                 field='tool_from_base')
-    random.shuffle(gripper_from_base_list)
+    base_values_array = load_place_base_array(world, tool_pose, surface_name, grasp_type)
     handles = []
-    for gripper_from_base in gripper_from_base_list:
-        #world_from_model = get_pose(world.robot)
-        world_from_model = unit_pose()
-        base_values = project_base_pose(multiply(invert(world_from_model), tool_pose, gripper_from_base))
+    for index in get_indices(len(base_values_array), weights):
+        base_values = tuple(base_values_array[index].tolist())
         #x, y, _ = base_values
         #_, _, z = get_point(world.floor)
         #set_joint_positions(world.robot, joints_from_names(world.robot, BASE_JOINTS), base_values)
@@ -77,19 +287,27 @@ def load_place_base_poses(world, tool_pose, surface_name, grasp_type):
         #wait_for_user()
         yield base_values
 
-def load_inverse_placements(world, surface_name, grasp_types=GRASP_TYPES):
-    surface_from_bases = []
+def load_inverse_placement_array(world, surface_name, grasp_types=GRASP_TYPES):
+    surface_from_bases = [np.zeros((0, POSE_LENGTH))]
     for grasp_type in grasp_types:
-        for entry in load_place_entries(world.robot_name, surface_name, grasp_type):
-            surface_from_bases.append(multiply(entry['surface_from_object'],
-                                               invert(entry['base_from_object'])))
-    random.shuffle(surface_from_bases)
-    return surface_from_bases
+        surface_from_objects = load_place_array(world.robot_name, surface_name, grasp_type,
+                                                field='surface_from_object')
+        base_from_objects = load_place_array(world.robot_name, surface_name, grasp_type,
+                                             field='base_from_object')
+        surface_from_bases.append(multiply_pose_rows(surface_from_objects, invert_pose_rows(base_from_objects)))
+    return np.concatenate(surface_from_bases)
+
+def load_inverse_placements(world, surface_name, **kwargs):
+    surface_from_bases = load_inverse_placement_array(world, surface_name, **kwargs)
+    return [pose_from_row(surface_from_bases[index]) for index in randomize_indices(len(surface_from_bases))]
 
-def load_pour_base_poses(world, surface_name, **kwargs):
+def load_pour_base_poses(world, surface_name, weights=None, **kwargs):
     world_from_surface = get_surface_reference_pose(world.kitchen, surface_name)
-    for surface_from_base in load_inverse_placements(world, surface_name, **kwargs):
-        base_values = project_base_pose(multiply(world_from_surface, surface_from_base))
+    surface_from_bases = load_inverse_placement_array(world, surface_name, **kwargs)
+    base_values_array = base_values_from_pose_rows(multiply_pose_rows(
+        row_from_pose(world_from_surface), surface_from_bases))
+    for index in get_indices(len(base_values_array), weights):
+        base_values = tuple(base_values_array[index].tolist())
         #world.set_base_conf(base_values)
         #wait_for_user()
         yield base_values
@@ -110,22 +328,25 @@ def get_pull_path(robot_name, joint_name):
     ir_filename = PRESS_IR_FILENAME if is_press(joint_name) else PULL_IR_FILENAME
     return os.path.abspath(os.path.join(DATABASE_DIRECTORY, ir_filename.format(robot_name, joint_name)))
 
+def load_pull_array(robot_name, joint_name):
+    field = 'joint_from_base'
+    key = (robot_name, joint_name, None, field)
+    return load_cached_array(key, get_pull_path(robot_name, joint_name), field)
+
 def load_pull_database(robot_name, joint_name):
-    data = {}
-    path = get_pull_path(robot_name, joint_name)
-    if os.path.exists(path):
-        data = read_json(path)
-    return [entry['joint_from_base'] for entry in data.get('entries', [])]
+    return list(map(pose_from_row, load_pull_array(robot_name, joint_name)))
 
-def load_pull_base_poses(world, joint_name):
-    joint_from_base_list = load_pull_database(world.robot_name, joint_name)
+def load_pull_base_array(world, joint_name):
+    joint_from_base_array = load_pull_array(world.robot_name, joint_name)
     parent_pose = get_joint_reference_pose(world.kitchen, joint_name)
-    random.shuffle(joint_from_base_list)
+    #world_from_model = get_pose(world.robot)
+    return base_values_from_pose_rows(multiply_pose_rows(row_from_pose(parent_pose), joint_from_base_array))
+
+def load_pull_base_poses(world, joint_name):
+    base_values_array = load_pull_base_array(world, joint_name)
     handles = []
-    for joint_from_base in joint_from_base_list:
-        #world_from_model = get_pose(world.robot)
-        world_from_model = unit_pose()
-        base_values = project_base_pose(multiply(invert(world_from_model), parent_pose, joint_from_base))
+    for index in randomize_indices(len(base_values_array)):
+        base_values = tuple(base_values_array[index].tolist())
         #set_joint_positions(world.robot, joints_from_names(world.robot, BASE_JOINTS), base_values)
         #x, y, _ = base_values
         #handles.extend(draw_point(np.array([x, y, -0.1]), color=(1, 0, 0), size=0.05))
@@ -0,0 +1,124 @@
+from __future__ import print_function
+
+import numpy as np
+
+from src.cache import LRUCache
+
+# Weighted Gaussian kernel density that matches sklearn's KernelDensity with the wminkowski (p=2) metric
+# The support can be edited in place so belief updates that only move weights do not refit
+YAW_WEIGHT = 0.01*np.pi
+METRIC_WEIGHTS = np.array([1., 1., YAW_WEIGHT]) # TODO: wrap around and symmetry?
+MAX_DENSITIES = 1000
+
+def logsumexp(values, axis=None):
+    maximum = np.max(values, axis=axis, keepdims=True)
+    maximum = np.where(np.isfinite(maximum), maximum, 0.)
+    total = np.log(np.sum(np.exp(values - maximum), axis=axis, keepdims=True)) + maximum
+    return np.squeeze(total, axis=axis)
+
+class WeightedKDE(object):
+    def __init__(self, bandwidth, metric_weights):
+        self.bandwidth = bandwidth
+        self.metric_weights = np.array(metric_weights, dtype=np.float64)
+        self.points = np.zeros((0, self.dim))
+        self.weights = np.zeros(0)
+    @property
+    def dim(self):
+        return len(self.metric_weights)
+    def __len__(self):
+        return len(self.points)
+    def fit(self, points, weights=None):
+        self.points = np.zeros((0, self.dim))
+        self.weights = np.zeros(0)
+        self.insert(points, weights)
+        return self
+    def set_weights(self, weights):
+        weights = np.array(weights, dtype=np.float64)
+        assert weights.shape == self.weights.shape
+        self.weights = weights
+    def insert(self, points, weights=None):
+        points = np.array(points, dtype=np.float64).reshape(-1, self.dim)
+        weights = np.ones(len(points)) if weights is None else np.array(weights, dtype=np.float64)
+        start = len(self)
+        self.points = np.vstack([self.points, points])
+        self.weights = np.concatenate([self.weights, weights])
+        return list(range(start, len(self)))
+    def remove(self, indices):
+        # Later indices shift down to fill the gaps
+        keep = np.ones(len(self), dtype=bool)
+        keep[list(indices)] = False
+        self.points = self.points[keep]
+        self.weights = self.weights[keep]
+    def score_samples(self, samples):
+        # Log density for each sample
+        samples = np.array(samples, dtype=np.float64).reshape(-1, self.dim)
+        total_weight = np.sum(self.weights)
+        if total_weight <= 0:
+            return np.full(len(samples), -np.inf)
+        deltas = self.metric_weights * (samples[:, np.newaxis, :] - self.points[np.newaxis, :, :])
+        distances2 = np.sum(np.square(deltas), axis=-1)
+        with np.errstate(divide='ignore'):
+            log_weights = np.log(self.weights)
+        log_kernels = log_weights - distances2 / (2*self.bandwidth**2)
+        log_norm = -0.5*self.dim*np.log(2*np.pi) - self.dim*np.log(self.bandwidth)
+        return logsumexp(log_kernels, axis=1) - np.log(total_weight) + log_norm
+    def sample(self, n_samples=1):
+        cumulative = np.cumsum(self.weights)
+        indices = np.searchsorted(cumulative, np.random.uniform(0, cumulative[-1], size=n_samples), side='right')
+        indices = np.minimum(indices, len(self) - 1)
+        return self.points[indices] + self.bandwidth*np.random.normal(size=(n_samples, self.dim))
+    def __repr__(self):
+        return '{}(n={}, bandwidth={})'.format(self.__class__.__name__, len(self), self.bandwidth)
+
+################################################################################
+
+class SupportDensity(object):
+    # Aligns the kernel centers with a list of particles, compared by identity
+    def __init__(self, bandwidth, metric_weights):
+        self.density = WeightedKDE(bandwidth, metric_weights)
+        self.particles = []
+        self.owner = None
+        self.num_fits = 0
+        self.num_reuses = 0
+    def update(self, particles, weights, point_fn, owner=None):
+        # The owner (e.g. a PoseDist) is trusted not to change its particles or weights
+        if (owner is not None) and (owner is self.owner):
+            return self.density
+        self.owner = owner
+        current = set(particles)
+        removed = [index for index, particle in enumerate(self.particles) if particle not in current]
+        if removed and (len(self.particles) <= 2*len(removed)):
+            # Cheaper to start over than to patch most of the support
+            self.particles = []
+            self.density.fit(np.zeros((0, self.density.dim)))
+            removed = []
+        if not self.particles:
+            self.num_fits += 1
+        if removed:
+            self.density.remove(removed)
+            removed = set(removed)
+            self.particles = [particle for index, particle in enumerate(self.particles) if index not in removed]
+        existing = set(self.particles)
+        added = [particle for particle in particles if particle not in existing]
+        if added:
+            self.density.insert([point_fn(particle) for particle in added], np.zeros(len(added)))
+            self.particles.extend(added)
+        if not (removed or added):
+            self.num_reuses += 1
+        index_from_particle = {particle: index for index, particle in enumerate(self.particles)}
+        aligned_weights = np.zeros(len(self.particles))
+        for particle, weight in zip(particles, weights):
+            aligned_weights[index_from_particle[particle]] += weight
+        self.density.set_weights(aligned_weights)
+        return self.density
+
+DENSITY_CACHE = LRUCache(max_size=MAX_DENSITIES)
+
+def get_support_density(key, particles, weights, point_fn, bandwidth, metric_weights=METRIC_WEIGHTS, owner=None):
+    # key = (object name, surface name)
+    # DENSITY_CACHE is cleared at the start of each episode
+    support_density = DENSITY_CACHE.get(key)
+    if (support_density is None) or (support_density.density.bandwidth != bandwidth) or \
+            not np.array_equal(support_density.density.metric_weights, metric_weights):
+        support_density = DENSITY_CACHE.set(key, SupportDensity(bandwidth, metric_weights))
+    return support_density.update(particles, weights, point_fn, owner=owner)
@@ -0,0 +1,90 @@
+from __future__ import print_function
+
+import numpy as np
+
+from pybullet_tools.utils import get_link_pose, parent_link_from_joint, set_joint_positions, BodySaver
+from src.cache import LRUCache
+from src.collision import round_values, pose_key, aabbs_overlap
+from src.ik import get_pose_distance
+from src.utils import get_obstacle_aabb
+
+# Door motions are fixed for a given joint, pair of angles and handle grasp
+# Their handle and tool paths are stored with the gripper AABB at each waypoint, so collision tests only run the
+# narrow phase near obstacles
+# Workspace arm paths are stored per bucket of base confs and only reused while they still track the tool path
+MAX_DOOR_MOTIONS = 1000
+MAX_DOOR_ARM_PATHS = 1000
+BASE_RESOLUTION = np.array([0.02, 0.02, np.pi/64]) # meters, meters, radians
+MAX_TOOL_ERROR = 0.005 # get_pose_distance between the reused arm path and the tool path
+
+class DoorMotion(object):
+    def __init__(self, door_plan, lowers, uppers):
+        self.door_plan = door_plan
+        self.lowers = np.array(lowers)
+        self.uppers = np.array(uppers)
+    def candidates(self, aabb):
+        # Waypoints where the gripper AABB overlaps aabb
+        return np.flatnonzero(aabbs_overlap(self.lowers, self.uppers, aabb))
+
+class DoorCache(object):
+    def __init__(self, max_motions=MAX_DOOR_MOTIONS, max_arm_paths=MAX_DOOR_ARM_PATHS):
+        self.motions = LRUCache(max_size=max_motions)
+        self.arm_paths = LRUCache(max_size=max_arm_paths)
+        self.reset_statistics()
+    def reset_statistics(self):
+        self.num_tests = 0
+        self.num_skipped = 0
+        self.num_invalid = 0
+        self.motions.reset_statistics()
+        self.arm_paths.reset_statistics()
+    def __repr__(self):
+        return '{}(motions={}, motion_hits={}, arm_paths={}, arm_path_hits={}, invalid={}, tests={}, ' \
+               'skipped={})'.format(self.__class__.__name__, len(self.motions), self.motions.hits,
+                                    len(self.arm_paths), self.arm_paths.hits, self.num_invalid,
+                                    self.num_tests, self.num_skipped)
+
+def get_motion_key(world, door_joint, door_values1, door_values2, teleport=False):
+    # The parent link pose accounts for anything that moves the door itself
+    parent_pose = get_link_pose(world.kitchen, parent_link_from_joint(world.kitchen, door_joint))
+    return (door_joint, round_values(door_values1), round_values(door_values2), teleport, pose_key(parent_pose))
+
+def get_door_key(door_joint, door_plan):
+    door_path, _, handle_plan, _ = door_plan
+    link, handle_grasp, _ = handle_plan
+    return (door_joint, round_values(door_path[0]), round_values(door_path[-1]), len(door_path),
+            link, pose_key(handle_grasp))
+
+def get_base_bucket(base_values):
+    x, y, theta = base_values
+    values = np.array([x, y, np.mod(theta, 2*np.pi)])
+    return tuple(np.round(values / BASE_RESOLUTION).astype(int).tolist())
+
+def follows_tool_path(world, tool_path, arm_path, test_fn=lambda arm_path: True):
+    # Whether an arm path reaches every tool pose from the current base conf and passes test_fn at each waypoint
+    if len(arm_path) != len(tool_path):
+        return False
+    with BodySaver(world.robot):
+        for i, tool_pose in enumerate(tool_path):
+            set_joint_positions(world.robot, world.arm_joints, arm_path[i])
+            if MAX_TOOL_ERROR < get_pose_distance(get_link_pose(world.robot, world.tool_link), tool_pose):
+                return False
+            if not test_fn(arm_path[:i+1]):
+                return False
+    return True
+
+def is_moved_by(world, obstacle, door_joint):
+    body, links = obstacle if isinstance(obstacle, tuple) else (obstacle, None)
+    if body != world.kitchen:
+        return False
+    if links is None:
+        return True
+    return any(door_joint in world.get_link_joints(link) for link in links)
+
+def get_nearby_waypoints(world, door_motion, door_joint, obstacles):
+    # Returns the waypoints that need a narrow phase test, or None if the obstacles move with the door
+    indices = set()
+    for obstacle in obstacles:
+        if is_moved_by(world, obstacle, door_joint):
+            return None
+        indices.update(door_motion.candidates(tuple(map(np.array, get_obstacle_aabb(obstacle)))).tolist())
+    return sorted(indices)
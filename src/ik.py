@@ -0,0 +1,95 @@
+from __future__ import print_function
+
+import numpy as np
+
+from src.cache import LRUCache
+
+# Arm IK solutions keyed on the quantized tool pose in the arm base frame
+# The arm base moves with the robot base, so the solutions remain valid across base confs and episodes
+POSITION_RESOLUTION = 0.02 # meters
+QUAT_RESOLUTION = 0.1
+EXACT_TOLERANCE = 1e-6
+ORIENTATION_WEIGHT = 0.1 # meters per radian
+MAX_IK_CELLS = 10000
+MAX_CELL_SOLUTIONS = 4
+MIN_RANDOM_SOLUTIONS = 2 # Randomized queries only reuse poses with this many distinct solutions
+SEED_NOISE = 0.25 # radians added to the cached seed of randomized queries
+
+def canonical_quat(quat):
+    quat = np.array(quat, dtype=np.float64)
+    return -quat if quat[3] < 0 else quat
+
+def get_pose_distance(pose1, pose2):
+    # Position distance plus the weighted rotation angle
+    point1, quat1 = pose1
+    point2, quat2 = pose2
+    dot = min(1., abs(np.dot(quat1, quat2)))
+    return np.linalg.norm(np.array(point1) - np.array(point2)) + ORIENTATION_WEIGHT * 2 * np.arccos(dot)
+
+class IKCache(object):
+    def __init__(self, max_size=MAX_IK_CELLS, max_solutions=MAX_CELL_SOLUTIONS):
+        self.cells = LRUCache(max_size=max_size)
+        self.max_solutions = max_solutions
+        self.reset_statistics()
+    def reset_statistics(self):
+        self.num_calls = 0
+        self.num_hits = 0
+        self.num_seeded = 0
+        self.num_successes = 0
+        self.num_pruned = 0
+        self.total_time = 0.
+        self.cells.reset_statistics()
+    @property
+    def success_rate(self):
+        return float(self.num_successes) / self.num_calls if self.num_calls else 0.
+    @property
+    def average_time(self):
+        return self.total_time / self.num_calls if self.num_calls else 0.
+    def get_cell(self, base_from_tool):
+        point, quat = base_from_tool
+        cell = np.floor(np.array(point) / POSITION_RESOLUTION).astype(int)
+        orientation = np.round(canonical_quat(quat) / QUAT_RESOLUTION).astype(int)
+        return tuple(cell.tolist()), tuple(orientation.tolist())
+    def get_neighbors(self, base_from_tool):
+        # The cell containing the pose and the adjacent position cells with the same orientation
+        cell, orientation = self.get_cell(base_from_tool)
+        for offset in np.ndindex(3, 3, 3):
+            key = (tuple(c + o - 1 for c, o in zip(cell, offset)), orientation)
+            for entry in self.cells.peek(key, default=[]):
+                yield entry
+    def add(self, base_from_tool, conf):
+        point, quat = base_from_tool
+        pose = (np.array(point, dtype=np.float64), canonical_quat(quat))
+        key = self.get_cell(base_from_tool)
+        entries = [(pose, tuple(conf))] + [entry for entry in self.cells.peek(key, default=[])
+                                           if not np.allclose(entry[1], conf)]
+        self.cells.set(key, entries[:self.max_solutions])
+    def get_solutions(self, base_from_tool, current_conf, nearby_tolerance=np.inf):
+        # Solutions for this exact pose within nearby_tolerance of current_conf, closest first
+        point, quat = base_from_tool
+        pose = (np.array(point), canonical_quat(quat))
+        key = self.get_cell(base_from_tool)
+        solutions = []
+        for other_pose, conf in self.cells.get(key, default=[]):
+            if get_pose_distance(pose, other_pose) < EXACT_TOLERANCE:
+                distance = np.max(np.abs(np.array(conf) - current_conf))
+                if distance <= nearby_tolerance:
+                    solutions.append((distance, conf))
+        return [conf for _, conf in sorted(solutions)]
+    def get_seeds(self, base_from_tool, current_conf, nearby_tolerance=np.inf):
+        # Nearby solutions ordered by the distance between their tool poses
+        point, quat = base_from_tool
+        pose = (np.array(point), canonical_quat(quat))
+        seeds = [(get_pose_distance(pose, other_pose), conf) for other_pose, conf in self.get_neighbors(base_from_tool)
+                 if np.max(np.abs(np.array(conf) - current_conf)) <= nearby_tolerance]
+        return [conf for _, conf in sorted(seeds)]
+    def record(self, elapsed, success, hit=False, seeded=False):
+        self.num_calls += 1
+        self.num_successes += success
+        self.num_hits += hit
+        self.num_seeded += seeded
+        self.total_time += elapsed
+    def __repr__(self):
+        return '{}(cells={}, calls={}, hits={}, seeded={}, success_rate={:.3f}, average_time={:.5f}, ' \
+               'pruned={})'.format(self.__class__.__name__, len(self.cells), self.num_calls, self.num_hits,
+                                   self.num_seeded, self.success_rate, self.average_time, self.num_pruned)
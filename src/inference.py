@@ -5,16 +5,17 @@ import scipy
 
 from collections import namedtuple
 from scipy.stats import norm, truncnorm
-from sklearn.neighbors import KernelDensity
 
 from examples.discrete_belief.dist import UniformDist, DDist, DeltaDist, mixDDists, ProductDistribution, \
     GaussianDistribution, Distribution
-from pybullet_tools.pr2_utils import is_visible_point
 from pybullet_tools.utils import base_values_from_pose, CIRCULAR_LIMITS, stable_z_on_aabb, point_from_pose, Point, Pose, \
     Euler, set_pose, multiply, draw_circle, LockRenderer, BodySaver, Ray, batch_ray_collision, draw_ray, wrap_angle, \
     circular_difference, remove_handles, get_pose, pairwise_collision, GREEN
 from src.database import get_surface_reference_pose
-from src.utils import compute_surface_aabb, create_relative_pose, CAMERA_MATRIX, KINECT_DEPTH, Z_EPSILON, test_supported
+from src.density import get_support_density, METRIC_WEIGHTS
+from src.particles import ParticleSet, get_reference_from_body
+from src.utils import compute_surface_aabb, create_relative_pose, CAMERA_MATRIX, KINECT_DEPTH, Z_EPSILON, test_supported, \
+    chunked_ray_collision
 
 BAYESIAN = False
 RESAMPLE = False
@@ -36,35 +37,38 @@ class PoseDist(object):
     # TODO: maintain one of these for each surface instead?
     # It is nice to treat them all as one distribution though
     def __init__(self, world, name, dist, weight=1.0, bandwidth=0.01):
+        # dist is either a ParticleSet or a DDist over RelPoses
         self.world = world
         self.name = name
-        self.dist = dist
-        self.poses_from_surface = {}
-        for pose in self.dist.support():
-            self.poses_from_surface.setdefault(pose.support, []).append(pose)
-        self.surface_dist = self.dist.project(lambda p: p.support)
-        self.density_from_surface = {}
+        self.obj_name = name
+        self.particles = dist if isinstance(dist, ParticleSet) else ParticleSet.from_dist(dist)
+        self.surface_dist = DDist(self.particles.surface_weights())
         self.weight = weight
         self.bandwidth = bandwidth
         self.handles = []
+    @property
+    def dist(self):
+        # Creates a RelPose per particle
+        prob_from_pose = {}
+        for pose, weight in zip(self.particles.get_poses(self.world, self.name), self.particles.weights):
+            prob_from_pose[pose] = prob_from_pose.get(pose, 0.) + weight
+        return DDist(prob_from_pose)
     def is_localized(self):
-        return len(self.dist.support()) == 1
+        return len(self.particles) == 1
     def surface_prob(self, surface):
         return self.weight * self.surface_dist.prob(surface)
     def discrete_prob(self, pose):
-        return self.weight * self.dist.prob(pose)
+        return self.weight * self.particles.prob(pose)
     def prob(self, pose):
         support = pose.support
-        density = self.get_density(support)
-        pose2d = self.pose2d_from_pose(pose)
-        [score] = density.score_samples([pose2d])
+        [score] = self.score_poses([pose])
         prob = np.exp(-score)
         return self.surface_prob(support) * prob
     #def support(self):
     #    return self.dist.support()
 
     def pose2d_from_pose(self, pose):
-        return base_values_from_pose(pose.get_reference_from_body())[:DIM]
+        return base_values_from_pose(get_reference_from_body(pose))[:DIM]
     def pose_from_pose2d(self, pose2d, surface):
         #assert surface in self.poses_from_surface
         #reference_pose = self.poses_from_surface[surface][0]
@@ -83,129 +87,90 @@ class PoseDist(object):
         return create_relative_pose(self.world, self.name, surface)
 
     def get_density(self, surface):
-        if surface in self.density_from_surface:
-            return self.density_from_surface[surface]
-        if surface not in self.poses_from_surface:
+        # Shared across PoseDists with the same particles so that belief updates only reweight
+        mask = self.particles.surface_mask(surface)
+        if not np.any(mask):
             return None
-        points, weights = zip(*[(self.pose2d_from_pose(pose), self.dist.prob(pose))
-                                for pose in self.poses_from_surface[surface]])
-        #print(weights)
-        # from sklearn.mixture import GaussianMixture
-        # pip2 install -U --no-deps scikit-learn=0.20
+        ids = self.particles.ids[mask] # Sorted
+        values = self.particles.values[mask, :DIM]
+        point_fn = lambda particle_id: values[np.searchsorted(ids, particle_id)]
         # https://scikit-learn.org/stable/modules/density.html
-        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.gaussian_kde.html#scipy.stats.gaussian_kde
         # https://scikit-learn.org/stable/modules/generated/sklearn.neighbors.DistanceMetric.html#sklearn.neighbors.DistanceMetric
-        # KernelDensity kernel: ['gaussian', 'tophat', 'epanechnikov', 'exponential', 'linear', 'cosine']
-        # KDTree.valid_metrics: ['chebyshev', 'euclidean', 'cityblock', 'manhattan', 'infinity', 'minkowski', 'p', 'l2', 'l1']
-        # BallTree.valid_metrics: ['chebyshev', 'sokalmichener', 'canberra', 'haversine', 'rogerstanimoto', 'matching', 'dice', 'euclidean',
-        # 'braycurtis', 'russellrao', 'cityblock', 'manhattan', 'infinity', 'jaccard', 'seuclidean', 'sokalsneath',
-        # 'kulsinski', 'minkowski', 'mahalanobis', 'p', 'l2', 'hamming', 'l1', 'wminkowski', 'pyfunc']
-        yaw_weight = 0.01*np.pi
-        metric_weights = np.array([1., 1., yaw_weight]) # TODO: wrap around and symmetry?
-        density = KernelDensity(bandwidth=self.bandwidth, algorithm='auto',
-                                kernel='gaussian', metric="wminkowski", atol=0, rtol=0,
-                                breadth_first=True, leaf_size=40,
-                                metric_params={'p': 2, 'w': metric_weights[:DIM]})
-        density.fit(X=points, sample_weight=1 * np.array(weights)) # Scaling doesn't seem to affect
-        self.density_from_surface[surface] = density
-        #scores = density.score_samples(points)
-        #probabilities = np.exp(-scores)
-        #print('Individual:', probabilities)
-        #print(np.sum(probabilities))
-        #total_score = density.score(points)
-        #total_probability = np.exp(-total_score)
-        #print('Total:', total_probability) # total log probability density
-        #print(total_probability)
         # TODO: integrate to obtain a probability mass
-        # from scipy.stats.kde import gaussian_kde
-        # density = gaussian_kde(points, weights=weights) # No weights in my scipy version
-        return density
+        return get_support_density((self.obj_name, surface), ids, self.particles.weights[mask], point_fn,
+                                   bandwidth=self.bandwidth, metric_weights=METRIC_WEIGHTS[:DIM], owner=self)
+    def score_poses(self, poses):
+        # Batched log densities for poses on any surfaces
+        scores = np.full(len(poses), -np.inf)
+        indices_from_surface = {}
+        for index, pose in enumerate(poses):
+            indices_from_surface.setdefault(pose.support, []).append(index)
+        for surface, indices in indices_from_surface.items():
+            density = self.get_density(surface)
+            if density is not None:
+                scores[indices] = density.score_samples([self.pose2d_from_pose(poses[index]) for index in indices])
+        return scores
     def get_nearby(self, target_pose, radius=NEARBY_RADIUS):
         # TODO: could instead use the probability density
-        target_point = np.array(point_from_pose(target_pose.get_reference_from_body()))
+        target_point = np.array(point_from_pose(get_reference_from_body(target_pose)))
         draw_circle(target_point, radius, parent=target_pose.reference_body,
                     parent_link=target_pose.reference_link)
-        poses = set()
-        for pose in self.dist.support():
-            if target_pose.support != pose.support:
-                continue
-            point = point_from_pose(pose.get_reference_from_body())
-            delta = target_point - point
-            if np.linalg.norm(delta[:2]) < radius:
-                poses.add(pose)
-        prob = sum(map(self.discrete_prob, poses))
+        indices = self.particles.nearby(target_point, target_pose.support, radius)
+        poses = set(self.particles.get_poses(self.world, self.name, indices))
+        prob = self.weight * np.sum(self.particles.weights[indices])
         #poses = {target_pose}
         return Neighborhood(poses, prob)
 
-    def sample_surface_pose(self, surface): # TODO: timeout
+    def sample_surface_pose(self, surface, batch_size=10): # TODO: timeout
         density = self.get_density(surface)
         if density is None:
             return None
         assert surface is not None
         body = self.world.get_body(self.name)
         while True:
-            [sample] = density.sample(n_samples=1)
-            #[score] = density.score_samples([sample])
-            #prob = np.exp(-score)
-            pose = self.pose_from_pose2d(sample, surface)
-            pose.assign()
-            # TODO: additional obstacles
-            if test_supported(self.world, body, surface):
-                return pose # TODO: return prob?
+            for sample in density.sample(n_samples=batch_size):
+                #[score] = density.score_samples([sample])
+                #prob = np.exp(-score)
+                pose = self.pose_from_pose2d(sample, surface)
+                pose.assign()
+                # TODO: additional obstacles
+                if test_supported(self.world, body, surface):
+                    return pose # TODO: return prob?
     def sample_surface(self):
         return self.surface_dist.sample()
     def sample_discrete(self):
-        return self.dist.sample()
+        return self.particles.get_pose(self.world, self.name, self.particles.sample_index())
     def sample(self):
         return self.sample_surface_pose(self.sample_surface())
     def resample(self, n=NUM_PARTICLES):
-        if len(self.dist.support()) <= 1:
+        if len(self.particles) <= 1:
             return self
         with LockRenderer():
             poses = [self.sample() for _ in range(n)]
         new_dist = UniformDist(poses)
         return self.__class__(self.world, self.name, new_dist)
+    def resample_particles(self, n=NUM_PARTICLES):
+        # Systematic resampling of the existing particles
+        return self.__class__(self.world, self.name, self.particles.resample(n))
     def copy(self):
-        return self.__class__(self.world, self.name, self.dist.copy())
+        return self.__class__(self.world, self.name, self.particles.with_weights(self.particles.weights.copy()))
 
     def decompose(self):
-        if len(self.dist.support()) == 1:
-            return self.dist.support()
+        if self.is_localized():
+            return self.particles.get_poses(self.world, self.name)
         pose_dists = []
         for surface_name in self.surface_dist.support():
-            dist = DDist({pose: self.discrete_prob(pose) for pose in self.poses_from_surface[surface_name]})
+            indices = np.flatnonzero(self.particles.surface_mask(surface_name))
             weight = self.surface_prob(surface_name)
-            pose_dists.append(SurfaceDist(self, weight, dist))
+            pose_dists.append(SurfaceDist(self, weight, self.particles.subset(indices)))
         return pose_dists
     def update_dist(self, observation, obstacles=[], verbose=False):
-        # cfree_dist.conditionOnVar(index=1, has_detection=True)
-        if not BAYESIAN and (self.name in observation):
-            # TODO: convert into a Multivariate Gaussian
-            [detected_pose] = observation[self.name]
-            return DeltaDist(detected_pose)
+        # Returns the posterior weights of the current particles
         if not self.world.cameras:
-            return self.dist.copy()
-        body = self.world.get_body(self.name)
-        all_poses = self.dist.support()
-        cfree_poses = all_poses
-        #cfree_poses = compute_cfree(body, all_poses, obstacles)
-        #cfree_dist = self.cfree_dist
-        cfree_dist = DDist({pose: self.dist.prob(pose) for pose in cfree_poses})
-        # TODO: do these updates simultaneously for each object
-        # TODO: check all camera poses
-        [camera] = self.world.cameras.keys()
-        info = self.world.cameras[camera]
-        camera_pose = get_pose(info.body)
-        detectable_poses = compute_detectable(cfree_poses, camera_pose)
-        visible_poses = compute_visible(body, detectable_poses, camera_pose, draw=False)
-        if verbose:
-            print('Total: {} | CFree: {} | Detectable: {} | Visible: {}'.format(
-                len(all_poses), len(cfree_poses), len(detectable_poses), len(visible_poses)))
-        assert set(visible_poses) <= set(detectable_poses)
-        # obs_fn = get_observation_fn(surface)
-        #wait_for_user()
-        return self.bayesian_belief_update(cfree_dist, visible_poses, observation, verbose=verbose)
-    def bayesian_belief_update(self, prior_dist, visible_poses, observation, verbose=False):
+            return self.particles.weights.copy()
+        [visible] = compute_visible_particles(self.world, [self], verbose=verbose)
+        return self.bayesian_belief_update(self.particles.weights, visible, observation, verbose=verbose)
+    def bayesian_belief_update(self, prior_weights, visible, observation, verbose=False):
         has_detection = self.name in observation
         detected_surface = None
         pose_estimate_2d = None
@@ -214,51 +179,44 @@ class PoseDist(object):
             detected_surface = detected_pose.support
             pose_estimate_2d = self.pose2d_from_pose(detected_pose)
         else:
-            for pose in visible_poses:
-                pose.observations += 1
+            self.particles.add_observations(visible)
         if verbose:
             print('Detection: {} | Pose: {}'.format(has_detection, pose_estimate_2d))
         # TODO: could use an UKF to propagate a GMM
-        new_dist = prior_dist.copy()
-        # cfree_dist.obsUpdate(detection_fn, has_detection)
-        new_dist.obsUpdates([
-            get_detection_fn(visible_poses),
-            get_registration_fn(visible_poses),
-            # ], [has_detection, pose_estimate_2d])
-        ], [detected_surface, pose_estimate_2d])
-        # cfree_dist = bayesEvidence(cfree_dist, detection_fn, has_detection) # projects out b and computes joint
-        # joint_dist = JDist(cfree_dist, detection_fn, registration_fn)
-        return new_dist
+        likelihoods = compute_detection_likelihoods(self.particles, visible, detected_surface) * \
+                      compute_registration_likelihoods(self.particles, detected_surface, pose_estimate_2d)
+        posterior_weights = prior_weights * likelihoods
+        total = np.sum(posterior_weights)
+        if total <= 0:
+            raise ValueError('Updating with impossible observation')
+        return posterior_weights / total
+    def requires_visibility(self, observation):
+        return BAYESIAN or (self.name not in observation)
     def update(self, belief, observation, n_samples=25, verbose=False, **kwargs):
         if verbose:
-            print('Prior:', self.dist)
-        body = self.world.get_body(self.name)
-        obstacles = [self.world.get_body(name) for name in belief.pose_dists if name != self.name]
-        dists = []
-        for _ in range(n_samples):
-            belief.sample(discrete=True)  # Trouble if no support
-            with BodySaver(body):
-                new_dist = self.update_dist(observation, obstacles, **kwargs)
-                #new_pose_dist = self.__class__(self.world, self.name, new_dist).resample()
-            dists.append(new_dist)
-            #remove_all_debug()
-            #new_pose_dist.draw(color=belief.color_from_name[self.name])
-            #wait_for_user()
-        posterior = mixDDists({dist: 1./len(dists) for dist in dists})
+            print('Prior:', self)
+        if not self.requires_visibility(observation):
+            # TODO: convert into a Multivariate Gaussian
+            [detected_pose] = observation[self.name]
+            return self.__class__(self.world, self.name, DeltaDist(detected_pose))
+        [pose_dist] = update_pose_dists(belief, [self], observation, n_samples=n_samples, verbose=verbose)
+        return pose_dist
+    def posterior(self, weights, verbose=False):
+        pose_dist = self.__class__(self.world, self.name, self.particles.with_weights(weights))
         if verbose:
-            print('Posterior:', posterior)
-        pose_dist = self.__class__(self.world, self.name, posterior)
+            print('Posterior:', pose_dist)
         if RESAMPLE:
             pose_dist = pose_dist.resample()
         return pose_dist
 
     def dump(self):
-        print(self.name, self.dist)
+        print(self.name, self.particles)
     def draw(self, color=GREEN, **kwargs):
         #if self.handles:
         #    return
-        poses = list(self.dist.support())
-        probs = list(map(self.discrete_prob, poses))
+        dist = self.dist
+        poses = list(dist.support())
+        probs = [self.weight * dist.prob(pose) for pose in poses]
         alphas = np.linspace(0.0, 1.0, num=11, endpoint=True)
         percentiles = np.array([scipy.stats.scoreatpercentile(
             probs, 100 * p, interpolation_method='lower') for p in alphas])  # numpy.percentile
@@ -276,15 +234,16 @@ class PoseDist(object):
         return self.handles
     def __repr__(self):
         return '{}({}, {}, {})'.format(self.__class__.__name__, self.name,
-                                       self.surface_dist, len(self.dist.support()))
+                                       self.surface_dist, len(self.particles))
 
 ################################################################################
 
 class SurfaceDist(PoseDist):
     def __init__(self, parent, weight, dist):
         super(SurfaceDist, self).__init__(parent.world, parent.world, dist, weight=weight)
+        self.obj_name = parent.obj_name
         #self.parent = parent # No point if it evolves
-        self.surface_name = self.dist.support()[0].support
+        [self.surface_name] = self.particles.surface_weights()
     @property
     def support(self):
         return self.surface_name
@@ -296,23 +255,26 @@ class SurfaceDist(PoseDist):
 
 ################################################################################
 
-def compute_detectable(poses, camera_pose):
-    detectable_poses = set()
-    for pose in poses:
-        point = point_from_pose(pose.get_world_from_body())
-        if is_visible_point(CAMERA_MATRIX, KINECT_DEPTH, point, camera_pose=camera_pose):
-            detectable_poses.add(pose)
-    return detectable_poses
+def compute_detectable(points, frustum):
+    return frustum.contains(points)
 
 
-def compute_visible(body, poses, camera_pose, draw=True):
-    ordered_poses = list(poses)
+def compute_visible_particles(world, pose_dists, draw=False, verbose=False):
+    # One ray batch for every object, particle and camera in the current world
+    # A particle is visible if some camera detects it and its ray is unobstructed
+    bodies = [world.get_body(pose_dist.name) for pose_dist in pose_dists]
+    points_list = [pose_dist.particles.get_world_rows()[:, :3] for pose_dist in pose_dists]
+    visible_list = [np.zeros(len(points), dtype=bool) for points in points_list]
     rays = []
-    camera_point = point_from_pose(camera_pose)
-    for pose in ordered_poses:
-        point = point_from_pose(pose.get_world_from_body())
-        rays.append(Ray(camera_point, point))
-    ray_results = batch_ray_collision(rays)
+    ray_indices = []
+    for camera in sorted(world.cameras):
+        frustum = world.camera_frustums[camera]
+        camera_point = point_from_pose(frustum.camera_pose)
+        for i, points in enumerate(points_list):
+            indices = np.flatnonzero(compute_detectable(points, frustum))
+            rays.extend(Ray(camera_point, points[index]) for index in indices)
+            ray_indices.extend((i, index) for index in indices)
+    ray_results = chunked_ray_collision(rays)
     if draw:
         with LockRenderer():
             handles = []
@@ -320,8 +282,37 @@ def compute_visible(body, poses, camera_pose, draw=True):
                 handles.extend(draw_ray(ray, result))
     # Blocking objects will likely be known with high probability
     # TODO: move objects out of the way?
-    return {pose for pose, result in zip(ordered_poses, ray_results)
-            if result.objectUniqueId in (body, -1)}
+    for (i, index), result in zip(ray_indices, ray_results):
+        if result.objectUniqueId in (bodies[i], -1):
+            visible_list[i][index] = True
+    if verbose:
+        for pose_dist, visible in zip(pose_dists, visible_list):
+            print('{}) Total: {} | Visible: {} | Rays: {}'.format(
+                pose_dist.name, len(visible), np.count_nonzero(visible), len(rays)))
+    return visible_list
+
+
+def update_pose_dists(belief, pose_dists, observation, n_samples=25, verbose=False):
+    # Each sampled world costs a single (chunked) rayTestBatch regardless of the number of objects and cameras
+    posterior_weights = [np.zeros(len(pose_dist.particles)) for pose_dist in pose_dists]
+    if not belief.world.cameras:
+        return [pose_dist.posterior(pose_dist.particles.weights.copy(), verbose=verbose)
+                for pose_dist in pose_dists]
+    num_sampled = 0
+    for _ in range(n_samples):
+        if belief.sample(discrete=True) is None:  # Trouble if no support
+            continue
+        num_sampled += 1
+        visible_list = compute_visible_particles(belief.world, pose_dists, verbose=verbose)
+        for i, (pose_dist, visible) in enumerate(zip(pose_dists, visible_list)):
+            posterior_weights[i] += pose_dist.bayesian_belief_update(
+                pose_dist.particles.weights, visible, observation, verbose=verbose)
+    if not num_sampled:
+        print('Warning! Skipping the observation update without any collision-free belief states')
+        return [pose_dist.posterior(pose_dist.particles.weights.copy(), verbose=verbose)
+                for pose_dist in pose_dists]
+    return [pose_dist.posterior(weights / num_sampled, verbose=verbose)
+            for pose_dist, weights in zip(pose_dists, posterior_weights)]
 
 
 def compute_cfree(body, poses, obstacles=[]):
@@ -359,40 +350,30 @@ class SE2Distribution(Distribution):
 # no detection, detection at point, detection elsewhere
 # The two observation functions mimic how the examples are generated
 
-def get_detection_fn(visible, p_fp=MODEL_P_FP, p_fn=MODEL_P_FN):
-    # TODO: precompute visible here
+def compute_detection_likelihoods(particles, visible, detected_surface, p_fp=MODEL_P_FP, p_fn=MODEL_P_FN):
+    # P(detected surface | particle) for every particle
     # TODO: mixture over ALL_SURFACES
     # Checking surfaces is important because incorrect surfaces may have similar relative poses
     assert p_fp == 0
+    # This could depend on the position as well
+    if detected_surface is None:
+        return np.where(visible, p_fn, 1.)
+    return np.where(visible & particles.surface_mask(detected_surface), 1. - p_fn, 0.)
 
-    def fn(pose):
-        # P(detect | s in visible)
-        # This could depend on the position as well
-        if pose in visible:
-            return DDist({pose.support: 1. - p_fn, None: p_fn})
-        return DeltaDist(None)
-    return fn
 
-
-def get_registration_fn(visible):
+def compute_registration_likelihoods(particles, detected_surface, pose_estimate_2d):
+    # P(obs point | particle, detected surface) for every particle
     # TODO: clip probabilities so doesn't become zero
     # TODO: nearby objects that might cause miss detections
     # TODO: add the observation as a particle
-
-    def fn(pose, surface):
-        # P(obs point | state detect)
-        if surface is None:
-            return DeltaDist(None)
-        # Weight can be proportional weight in the event that the distribution can't be normalized
-        x, y, yaw = base_values_from_pose(pose.get_reference_from_body())
-        if DIM == 2:
-            return ProductDistribution([
-               GaussianDistribution(gmean=x, stdev=MODEL_POS_STD),
-               GaussianDistribution(gmean=y, stdev=MODEL_POS_STD),
-               #CUniformDist(-np.pi, +np.pi),
-            ])
-        else:
-            return SE2Distribution(x, y, yaw, pos_std=MODEL_POS_STD, ori_std=MODEL_ORI_STD)
-        # Could also mix with a uniform distribution over the space
-        #if not visible[index]: uniform over the space
-    return fn
+    if detected_surface is None:
+        return np.ones(len(particles))
+    values = particles.values
+    likelihoods = norm.pdf(pose_estimate_2d[0] - values[:, 0], scale=MODEL_POS_STD) * \
+                  norm.pdf(pose_estimate_2d[1] - values[:, 1], scale=MODEL_POS_STD)
+    if DIM == 3:
+        yaw_differences = (pose_estimate_2d[2] - values[:, 2] + np.pi) % (2*np.pi) - np.pi # circular_difference
+        likelihoods *= truncnorm.pdf(yaw_differences, a=-np.pi, b=np.pi, scale=MODEL_ORI_STD)
+    # Could also mix with a uniform distribution over the space
+    #if not visible[index]: uniform over the space
+    return likelihoods
@@ -4,7 +4,6 @@ import math
 import numpy as np
 import random
 
-from pybullet_tools.pr2_utils import is_visible_point
 from pybullet_tools.utils import get_pose, point_from_pose, Ray, batch_ray_collision, has_gui, add_line, BLUE, \
     wait_for_duration, remove_handles, Pose, Point, Euler, multiply, set_pose, aabb_contains_point, tform_point, angle_between
 from src.utils import CAMERA_MATRIX, KINECT_DEPTH, create_relative_pose, create_world_pose
@@ -20,14 +19,14 @@ ELSEWHERE = None # symbol for elsewhere pose
 def are_visible(world):
     ray_names = []
     rays = []
-    for name in world.movable:
-        for camera, info in world.cameras.items():
-            camera_pose = get_pose(info.body)
-            camera_point = point_from_pose(camera_pose)
-            point = point_from_pose(get_pose(world.get_body(name)))
-            if is_visible_point(CAMERA_MATRIX, KINECT_DEPTH, point, camera_pose=camera_pose):
-                ray_names.append(name)
-                rays.append(Ray(camera_point, point))
+    names = list(world.movable)
+    points = [point_from_pose(get_pose(world.get_body(name))) for name in names]
+    for camera in world.cameras:
+        camera_point = point_from_pose(world.get_camera_pose(camera))
+        detectable = world.are_visible(points, camera_names=[camera])
+        for index in np.flatnonzero(detectable):
+            ray_names.append(names[index])
+            rays.append(Ray(camera_point, points[index]))
     ray_results = batch_ray_collision(rays)
     visible_indices = [idx for idx, (name, result) in enumerate(zip(ray_names, ray_results))
                        if result.objectUniqueId == world.get_body(name)]
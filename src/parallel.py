@@ -0,0 +1,242 @@
+from __future__ import print_function
+
+import multiprocessing
+import random
+import threading
+import traceback
+import numpy as np
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from pddlstream.language.generator import from_gen_fn, from_fn
+from src.serialize import serialize, deserialize, snapshot_bodies, restore_snapshot
+from src.streams.move import get_base_motion_fn, get_arm_motion_gen
+from src.streams.pick import get_pick_gen_fn
+from src.streams.press import get_press_gen_fn
+from src.streams.pour import get_pour_gen_fn
+from src.streams.pull import get_pull_gen_fn
+
+# Speculative stream evaluation on a pool of processes that each own a replica of the World
+# A job restores a snapshot of the main world, draws one output from a fresh stream instance and returns it as plain data
+# Several jobs with different seeds race per stream call, and outputs are consumed in completion order
+# Jobs are only submitted when an output is requested, at most num_workers are unfinished at once, and the queued jobs
+# of an abandoned call are skipped by the workers
+# Requires python3, whose spawn context keeps the workers from inheriting the main PyBullet client through fork
+GENERATOR_STREAMS = ['plan-pick', 'plan-pull', 'plan-press', 'plan-pour']
+FUNCTION_STREAMS = ['plan-base-motion', 'plan-arm-motion']
+
+WORKER_WORLD = None
+WORKER_STREAMS = {}
+CANCELLED_CALLS = None # Shared {call_id: True} of abandoned stream calls
+
+def get_stream_fns(world, teleport_base=False, **kwargs):
+    return {
+        'plan-pick': get_pick_gen_fn(world, **kwargs),
+        'plan-pull': get_pull_gen_fn(world, **kwargs),
+        'plan-press': get_press_gen_fn(world, **kwargs),
+        'plan-pour': get_pour_gen_fn(world, **kwargs),
+        'plan-base-motion': get_base_motion_fn(world, teleport_base=teleport_base, **kwargs),
+        'plan-arm-motion': get_arm_motion_gen(world, **kwargs),
+    }
+
+def get_stream_map(stream_fns):
+    stream_map = {}
+    for name in GENERATOR_STREAMS:
+        stream_map[name] = from_gen_fn(stream_fns[name])
+    for name in FUNCTION_STREAMS:
+        stream_map[name] = from_fn(stream_fns[name])
+    return stream_map
+
+def init_worker(task_name, task_kwargs, body_from_name, cancelled_calls):
+    from src.task import TASKS_FNS
+    from src.world import World
+    global WORKER_WORLD, CANCELLED_CALLS
+    CANCELLED_CALLS = cancelled_calls
+    world = World(use_gui=False)
+    task_fn_from_name = {fn.__name__: fn for fn in TASKS_FNS}
+    task_fn_from_name[task_name](world, **task_kwargs)
+    world._update_initial()
+    if world.body_from_name != body_from_name:
+        raise RuntimeError('The replica bodies do not match the main world')
+    WORKER_WORLD = world
+
+def evaluate_stream(job):
+    # Returns (status, data) where status is 'output', 'exhausted', 'cancelled' or 'error'
+    call_id, name, stream_kwargs, snapshot, inputs, seed = job
+    world = WORKER_WORLD
+    try:
+        if call_id in CANCELLED_CALLS:
+            return 'cancelled', None
+        key = (name,) + tuple(sorted(stream_kwargs.items()))
+        if key not in WORKER_STREAMS:
+            WORKER_STREAMS[key] = get_stream_fns(world, **stream_kwargs)[name]
+        stream_fn = WORKER_STREAMS[key]
+        random.seed(seed)
+        np.random.seed(seed % 2**32)
+        restore_snapshot(snapshot)
+        args, kwargs = deserialize(world, inputs)
+        if name in FUNCTION_STREAMS:
+            outputs = stream_fn(*args, **kwargs)
+        else:
+            generator = iter(stream_fn(*args, **kwargs))
+            try:
+                outputs = next(generator)
+            except StopIteration:
+                return 'exhausted', None
+        return 'output', None if outputs is None else serialize(world, outputs)
+    except Exception:
+        return 'error', traceback.format_exc()
+
+################################################################################
+
+class StreamPool(object):
+    def __init__(self, world, task_name, task_kwargs={}, num_workers=None, num_speculative=None):
+        # Processes are spawned rather than forked so they don't inherit the main PyBullet client
+        if not hasattr(multiprocessing, 'get_context'):
+            raise RuntimeError('{} requires python3 to spawn its workers'.format(self.__class__.__name__))
+        context = multiprocessing.get_context('spawn')
+        self.world = world
+        self.num_workers = multiprocessing.cpu_count() if num_workers is None else num_workers
+        self.num_speculative = min(self.num_workers, self.num_workers if num_speculative is None else num_speculative)
+        self.manager = context.Manager()
+        self.cancelled_calls = self.manager.dict()
+        self.pool = context.Pool(self.num_workers, initializer=init_worker,
+                                 initargs=(task_name, task_kwargs, dict(world.body_from_name), self.cancelled_calls))
+        # Completion callbacks run on the pool's result thread
+        self.slots = threading.Semaphore(self.num_workers) # Unfinished jobs, including abandoned ones
+        self.lock = threading.Lock()
+        self.live_jobs = {} # call_id -> number of unfinished jobs
+        self.cancelled = set() # Local copy of the keys of cancelled_calls
+        self.num_calls = 0
+        self.num_jobs = 0
+        self.num_outputs = 0
+        self.num_cancelled = 0
+        self.num_fallbacks = 0
+    def new_call(self):
+        self.num_calls += 1
+        return self.num_calls, Queue()
+    def finish(self, call_id):
+        # Forgets cancelled calls once they have no unfinished jobs
+        with self.lock:
+            self.live_jobs[call_id] -= 1
+            if not self.live_jobs[call_id]:
+                del self.live_jobs[call_id]
+                if call_id in self.cancelled:
+                    self.cancelled.remove(call_id)
+                    del self.cancelled_calls[call_id]
+        self.slots.release()
+    def submit(self, call_id, done, name, stream_kwargs, snapshot, inputs, blocking=True):
+        # Returns the job id, or None without a free slot when not blocking
+        if not self.slots.acquire(blocking):
+            return None
+        self.num_jobs += 1
+        job_id = self.num_jobs
+        with self.lock:
+            self.live_jobs[call_id] = self.live_jobs.get(call_id, 0) + 1
+        def callback(output):
+            self.finish(call_id)
+            done.put((job_id, output))
+        def error_callback(error):
+            callback(('error', repr(error)))
+        job = (call_id, name, stream_kwargs, snapshot, inputs, random.randint(0, 2**31))
+        self.pool.apply_async(evaluate_stream, (job,), callback=callback, error_callback=error_callback)
+        return job_id
+    def fill(self, call_id, done, pending, name, stream_kwargs, snapshot, inputs):
+        # Tops up the jobs of a call to num_speculative without waiting on other calls unless it has none
+        while len(pending) < self.num_speculative:
+            job_id = self.submit(call_id, done, name, stream_kwargs, snapshot, inputs, blocking=not pending)
+            if job_id is None:
+                break
+            pending.append(job_id)
+    def cancel(self, call_id, pending):
+        with self.lock:
+            if call_id in self.live_jobs:
+                self.num_cancelled += 1
+                self.cancelled.add(call_id)
+                self.cancelled_calls[call_id] = True
+        del pending[:]
+    def wait_any(self, done, pending):
+        # Blocks until one of the pending jobs completes
+        job_id, output = done.get()
+        pending.remove(job_id)
+        return output
+    def serialize_inputs(self, name, args, kwargs):
+        try:
+            return serialize(self.world, (args, kwargs))
+        except ValueError as e:
+            # e.g. SurfaceDist fluents
+            print('Evaluating {} locally: {}'.format(name, e))
+            self.num_fallbacks += 1
+            return None
+    def speculative_gen_fn(self, name, gen_fn, stream_kwargs):
+        def gen(*args, **kwargs):
+            inputs = self.serialize_inputs(name, args, kwargs)
+            if inputs is not None:
+                call_id, done = self.new_call()
+                snapshot = snapshot_bodies()
+                pending = []
+                try:
+                    while True:
+                        # Unfinished jobs from the previous request carry over
+                        self.fill(call_id, done, pending, name, stream_kwargs, snapshot, inputs)
+                        status, data = self.wait_any(done, pending)
+                        if status == 'exhausted':
+                            return
+                        if status == 'error':
+                            print('Worker failed to evaluate {}:\n{}'.format(name, data))
+                            self.num_fallbacks += 1
+                            break
+                        if data is not None:
+                            self.num_outputs += 1
+                        yield None if data is None else deserialize(self.world, data)
+                finally:
+                    # Also runs when the generator is closed or garbage collected
+                    self.cancel(call_id, pending)
+            for outputs in gen_fn(*args, **kwargs):
+                yield outputs
+        return gen
+    def speculative_fn(self, name, fn, stream_kwargs):
+        def race(*args, **kwargs):
+            # Returns the first successful output among the racing jobs and cancels the rest
+            inputs = self.serialize_inputs(name, args, kwargs)
+            if inputs is None:
+                return fn(*args, **kwargs)
+            call_id, done = self.new_call()
+            snapshot = snapshot_bodies()
+            pending = []
+            try:
+                self.fill(call_id, done, pending, name, stream_kwargs, snapshot, inputs)
+                while pending:
+                    status, data = self.wait_any(done, pending)
+                    if status == 'error':
+                        print('Worker failed to evaluate {}:\n{}'.format(name, data))
+                        self.num_fallbacks += 1
+                        break
+                    if data is not None:
+                        self.num_outputs += 1
+                        return deserialize(self.world, data)
+                else:
+                    return None
+            finally:
+                self.cancel(call_id, pending)
+            return fn(*args, **kwargs)
+        return race
+    def wrap_stream_fns(self, stream_fns, stream_kwargs):
+        # The local streams remain as fallbacks for inputs that cannot be serialized
+        wrapped_fns = dict(stream_fns)
+        for name in GENERATOR_STREAMS:
+            wrapped_fns[name] = self.speculative_gen_fn(name, stream_fns[name], stream_kwargs)
+        for name in FUNCTION_STREAMS:
+            wrapped_fns[name] = self.speculative_fn(name, stream_fns[name], stream_kwargs)
+        return wrapped_fns
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.manager.shutdown()
+    def __repr__(self):
+        return '{}(workers={}, calls={}, jobs={}, outputs={}, cancelled={}, fallbacks={})'.format(
+            self.__class__.__name__, self.num_workers, self.num_calls, self.num_jobs, self.num_outputs,
+            self.num_cancelled, self.num_fallbacks)
@@ -0,0 +1,152 @@
+from __future__ import print_function
+
+import random
+import numpy as np
+
+from itertools import count
+
+from pybullet_tools.utils import Attachment, get_link_pose, unit_pose
+from src.database import POSE_LENGTH, row_from_pose, pose_from_row
+from src.utils import pose_from_attachment, multiply_pose_rows, base_values_from_pose_rows
+
+# Array-backed particles: reference_from_body rows, weights, surfaces and lazily created RelPoses
+PARTICLE_IDS = count()
+
+def get_reference_from_body(pose):
+    # Reads the attachment instead of assigning and querying pybullet when possible
+    if len(pose.confs) == 1:
+        [attachment] = pose.confs
+        if isinstance(attachment, Attachment) and (attachment.child == pose.body) and \
+                (attachment.parent == pose.reference_body) and (attachment.parent_link == pose.reference_link):
+            return attachment.grasp_pose
+    return pose.get_reference_from_body()
+
+class ParticleSet(object):
+    def __init__(self, rows, weights, surfaces, surface_ids, references, reference_ids,
+                 bodies=None, ids=None, observations=None, poses=None):
+        self.rows = np.array(rows, dtype=np.float64).reshape(-1, POSE_LENGTH)
+        self.weights = np.array(weights, dtype=np.float64)
+        self.surfaces = list(surfaces) # Unique surface names (None for world poses)
+        self.surface_ids = np.array(surface_ids, dtype=int)
+        self.references = list(references) # Unique (reference_body, reference_link) pairs
+        self.reference_ids = np.array(reference_ids, dtype=int)
+        self.bodies = bodies
+        self.ids = np.array([next(PARTICLE_IDS) for _ in range(len(self.rows))] if ids is None else ids, dtype=int)
+        # The following are shared with copies that only differ in weights
+        self.observations = np.zeros(len(self.rows), dtype=int) if observations is None else observations
+        self.poses = [None]*len(self.rows) if poses is None else poses
+        self.indices_from_pose = {}
+        for index, pose in enumerate(self.poses):
+            if pose is not None:
+                self.indices_from_pose.setdefault(pose, []).append(index)
+        self.values_cache = None
+    @staticmethod
+    def from_poses(poses, weights=None):
+        poses = list(poses)
+        if weights is None:
+            weights = np.ones(len(poses)) / max(1, len(poses))
+        surfaces, surface_ids = [], []
+        references, reference_ids = [], []
+        for pose in poses:
+            if pose.support not in surfaces:
+                surfaces.append(pose.support)
+            surface_ids.append(surfaces.index(pose.support))
+            reference = (pose.reference_body, pose.reference_link)
+            if reference not in references:
+                references.append(reference)
+            reference_ids.append(references.index(reference))
+        rows = [row_from_pose(get_reference_from_body(pose)) for pose in poses]
+        observations = np.array([pose.observations for pose in poses], dtype=int)
+        return ParticleSet(rows, weights, surfaces, surface_ids, references, reference_ids,
+                           bodies=[pose.body for pose in poses], observations=observations, poses=poses)
+    @staticmethod
+    def from_dist(dist):
+        poses = list(dist.support())
+        return ParticleSet.from_poses(poses, [dist.prob(pose) for pose in poses])
+    def __len__(self):
+        return len(self.rows)
+    @property
+    def values(self):
+        # (x, y, yaw) in the reference frame
+        if self.values_cache is None:
+            self.values_cache = base_values_from_pose_rows(self.rows)
+        return self.values_cache
+    def with_weights(self, weights):
+        particles = ParticleSet(self.rows, weights, self.surfaces, self.surface_ids, self.references,
+                                self.reference_ids, bodies=self.bodies, ids=self.ids,
+                                observations=self.observations, poses=self.poses)
+        particles.indices_from_pose = self.indices_from_pose
+        particles.values_cache = self.values_cache
+        return particles
+    def normalize(self):
+        total = np.sum(self.weights)
+        if total <= 0:
+            raise ValueError('Normalizing a particle set without any weight')
+        return self.with_weights(self.weights / total)
+    def subset(self, indices):
+        # Keeps the (unnormalized) weights
+        indices = np.array(indices, dtype=int)
+        return ParticleSet(self.rows[indices], self.weights[indices], self.surfaces,
+                           self.surface_ids[indices], self.references, self.reference_ids[indices],
+                           bodies=None if self.bodies is None else [self.bodies[i] for i in indices],
+                           ids=self.ids[indices], observations=self.observations[indices].copy(),
+                           poses=[self.poses[i] for i in indices])
+    def resample(self, n):
+        # Systematic resampling to n equally-weighted particles
+        cumulative = np.cumsum(self.weights)
+        positions = (random.random() + np.arange(n)) / n * cumulative[-1]
+        indices = np.minimum(np.searchsorted(cumulative, positions, side='right'), len(self) - 1)
+        particles = self.subset(indices)
+        return particles.with_weights(np.ones(n) / n)
+    def sample_index(self):
+        cumulative = np.cumsum(self.weights)
+        index = np.searchsorted(cumulative, random.random() * cumulative[-1], side='right')
+        return min(index, len(self) - 1)
+
+    def surface_mask(self, surface):
+        if surface not in self.surfaces:
+            return np.zeros(len(self), dtype=bool)
+        return self.surface_ids == self.surfaces.index(surface)
+    def surface_weights(self):
+        totals = np.bincount(self.surface_ids, weights=self.weights, minlength=len(self.surfaces))
+        return {surface: float(totals[i]) for i, surface in enumerate(self.surfaces) if np.any(self.surface_ids == i)}
+    def get_world_rows(self):
+        # Composes with the current reference link poses rather than assigning each particle
+        world_rows = np.zeros(self.rows.shape)
+        for i, (reference_body, reference_link) in enumerate(self.references):
+            mask = self.reference_ids == i
+            if not np.any(mask):
+                continue
+            world_from_reference = unit_pose() if reference_body is None else \
+                get_link_pose(reference_body, reference_link)
+            world_rows[mask] = multiply_pose_rows(row_from_pose(world_from_reference), self.rows[mask])
+        return world_rows
+    def nearby(self, point, surface, radius):
+        deltas = self.rows[:, :2] - np.array(point[:2])
+        return np.flatnonzero(self.surface_mask(surface) & (np.linalg.norm(deltas, axis=1) < radius))
+    def add_observations(self, mask):
+        self.observations[mask] += 1
+        for index in np.flatnonzero(mask):
+            if self.poses[index] is not None:
+                self.poses[index].observations += 1
+
+    def get_pose(self, world, name, index):
+        pose = self.poses[index]
+        if pose is None:
+            reference_body, reference_link = self.references[self.reference_ids[index]]
+            assert reference_body is not None
+            body = world.get_body(name) if self.bodies is None else self.bodies[index]
+            attachment = Attachment(reference_body, reference_link, pose_from_row(self.rows[index]), body)
+            pose = pose_from_attachment(attachment, support=self.surfaces[self.surface_ids[index]])
+            pose.observations = int(self.observations[index])
+            self.poses[index] = pose
+            self.indices_from_pose.setdefault(pose, []).append(index)
+        return pose
+    def get_poses(self, world, name, indices=None):
+        if indices is None:
+            indices = range(len(self))
+        return [self.get_pose(world, name, index) for index in indices]
+    def prob(self, pose):
+        return sum(self.weights[index] for index in self.indices_from_pose.get(pose, []))
+    def __repr__(self):
+        return '{}(n={}, surfaces={})'.format(self.__class__.__name__, len(self), self.surfaces)
@@ -0,0 +1,183 @@
+from __future__ import print_function
+
+import random
+import numpy as np
+
+from pybullet_tools.utils import Euler, BodySaver, set_pose, stable_z_on_aabb, quat_from_euler, get_aabb, \
+    unit_pose, CIRCULAR_LIMITS
+from src.utils import test_supported
+
+# Stratified placement sampling over a grid on each surface AABB
+# Cells start weighted by whether the object fits among the static obstacles and lose weight as samples fail
+# Whether a cell fits is only tested when the cell is first drawn
+PLACEMENT_RESOLUTION = 8 # Cells per side
+MASK_YAWS = [0., np.pi/2]
+MIN_CELL_WEIGHT = 0.05 # Never rule out a cell entirely
+FAILURE_DECAY = 0.5
+MAX_CELL_DRAWS = 4 # Cells drawn per sample until one that fits
+HALTON_BASES = [2, 3, 5, 7, 11, 13]
+PLACEMENT_PERCENT = 2.0 # Fraction of the object half extent removed from each side (as in sample_placement_on_aabb)
+
+def radical_inverse(index, base):
+    result = 0.
+    fraction = 1. / base
+    while index > 0:
+        index, digit = divmod(index, base)
+        result += digit * fraction
+        fraction /= base
+    return result
+
+class HaltonSequence(object):
+    def __init__(self, dim, start=None):
+        assert dim <= len(HALTON_BASES)
+        self.bases = HALTON_BASES[:dim]
+        # A random start decorrelates generators for different objects
+        self.index = random.randint(0, 2**16) if start is None else start
+    def __iter__(self):
+        return self
+    def next(self):
+        self.index += 1
+        return np.array([radical_inverse(self.index, base) for base in self.bases])
+    __next__ = next
+
+def get_aabb_key(aabb, decimals=3):
+    return tuple(np.round(np.concatenate(aabb), decimals).tolist())
+
+class PlacementSampler(object):
+    def __init__(self, world, obj_name, surface_name, resolution=PLACEMENT_RESOLUTION):
+        self.world = world
+        self.obj_name = obj_name
+        self.surface_name = surface_name
+        self.shape = (resolution, resolution)
+        self.halton = HaltonSequence(4)
+        self.free_masks = {} # Keyed on the surface AABB, which moves with the doors (-1 untested, 0 blocked, 1 free)
+        self.point_cells = {} # Keyed on the surface AABB and the number of points
+        self.failures = np.zeros(self.shape)
+        self.extent = None
+        self.num_samples = 0
+        self.num_accepted = 0
+    @property
+    def acceptance_rate(self):
+        return float(self.num_accepted) / self.num_samples if self.num_samples else 0.
+    def get_extent(self):
+        # Largest horizontal extent of the object, which bounds both mask yaws
+        if self.extent is None:
+            body = self.world.get_body(self.obj_name)
+            with BodySaver(body):
+                set_pose(body, unit_pose())
+                lower, upper = get_aabb(body)
+            self.extent = np.max(np.array(upper[:2]) - np.array(lower[:2]))
+        return self.extent
+    def get_region(self, surface_aabb):
+        # Object positions within the surface AABB, collapsing to its center when the object is too large
+        lower, upper = np.array(surface_aabb[0][:2]), np.array(surface_aabb[1][:2])
+        margin = np.minimum(PLACEMENT_PERCENT * self.get_extent() / 2, (upper - lower) / 2)
+        return lower + margin, upper - margin
+    def get_cell_center(self, surface_aabb, cell):
+        lower, upper = self.get_region(surface_aabb)
+        return lower + (np.array(cell) + 0.5) / self.shape * (upper - lower)
+    def get_cells(self, surface_aabb, points):
+        # (N, 2) cell indices of the points
+        lower, upper = self.get_region(surface_aabb)
+        fraction = (np.array(points)[:, :2] - lower) / np.maximum(upper - lower, 1e-6)
+        return np.clip(np.floor(fraction * self.shape).astype(int), 0, np.array(self.shape) - 1)
+    def get_cell(self, surface_aabb, point):
+        return tuple(self.get_cells(surface_aabb, [point])[0].tolist())
+    def get_pose(self, surface_aabb, x, y, yaw, z_offset=0.):
+        body = self.world.get_body(self.obj_name)
+        quat = quat_from_euler(Euler(yaw=yaw))
+        set_pose(body, ((x, y, 0.), quat))
+        z = stable_z_on_aabb(body, surface_aabb)
+        return ([x, y, z + z_offset], quat)
+    def get_free_mask(self, surface_aabb):
+        key = get_aabb_key(surface_aabb)
+        if key not in self.free_masks:
+            self.free_masks[key] = -np.ones(self.shape, dtype=int)
+        return self.free_masks[key]
+    def is_free(self, surface_aabb, cell):
+        # Whether the object is supported at the cell center without colliding with the static obstacles
+        mask = self.get_free_mask(surface_aabb)
+        if mask[cell] < 0:
+            body = self.world.get_body(self.obj_name)
+            x, y = self.get_cell_center(surface_aabb, cell)
+            mask[cell] = 0
+            with BodySaver(body):
+                for yaw in MASK_YAWS:
+                    set_pose(body, self.get_pose(surface_aabb, x, y, yaw))
+                    if test_supported(self.world, body, self.surface_name):
+                        mask[cell] = 1
+                        break
+        return bool(mask[cell])
+    def get_weights(self, surface_aabb):
+        # Untested cells are weighted as free
+        weights = np.where(self.get_free_mask(surface_aabb) != 0, 1., MIN_CELL_WEIGHT)
+        return np.maximum(weights * np.power(FAILURE_DECAY, self.failures), MIN_CELL_WEIGHT**2)
+    def sample_cell(self, weights, u):
+        cumulative = np.cumsum(weights.flatten())
+        index = min(np.searchsorted(cumulative, u * cumulative[-1], side='right'), cumulative.size - 1)
+        return np.unravel_index(index, self.shape)
+    def sample(self, surface_aabb, z_offset=0., yaw_range=CIRCULAR_LIMITS):
+        # Inverse CDF over the cell weights followed by a position within the cell
+        for _ in range(MAX_CELL_DRAWS):
+            u = next(self.halton)
+            cell = self.sample_cell(self.get_weights(surface_aabb), u[0])
+            if self.is_free(surface_aabb, cell):
+                break
+        lower, upper = self.get_region(surface_aabb)
+        x, y = lower + (np.array(cell) + u[1:3]) / self.shape * (upper - lower)
+        return self.get_pose(surface_aabb, x, y, self.sample_yaw(u[3], yaw_range), z_offset=z_offset)
+    def sample_yaw(self, u=None, yaw_range=CIRCULAR_LIMITS):
+        if u is None:
+            u = next(self.halton)[3]
+        lower, upper = yaw_range
+        return lower + u * (upper - lower)
+    def get_point_cells(self, surface_aabb, points):
+        # The number of points per cell and the points grouped by cell, computed once per surface AABB
+        key = (get_aabb_key(surface_aabb), len(points))
+        if key not in self.point_cells:
+            cells = np.ravel_multi_index(self.get_cells(surface_aabb, points).T, self.shape)
+            order = np.argsort(cells, kind='mergesort')
+            counts = np.bincount(cells, minlength=np.prod(self.shape))
+            self.point_cells[key] = (counts, np.split(order, np.cumsum(counts)[:-1]))
+        return self.point_cells[key]
+    def sample_index(self, surface_aabb, points):
+        # Chooses among candidate points (e.g. learned placements) according to their cell weights
+        # A cell is drawn by its weight times its number of points and then a point uniformly within it
+        counts, groups = self.get_point_cells(surface_aabb, points)
+        cumulative = np.cumsum(self.get_failure_weights().flatten() * counts)
+        cell = min(np.searchsorted(cumulative, random.random() * cumulative[-1], side='right'), len(counts) - 1)
+        return random.choice(groups[cell])
+    def get_failure_weights(self):
+        return np.maximum(np.power(FAILURE_DECAY, self.failures), MIN_CELL_WEIGHT**2)
+    def record(self, surface_aabb, point, success):
+        cell = self.get_cell(surface_aabb, point)
+        self.num_samples += 1
+        if success:
+            self.num_accepted += 1
+            self.failures[cell] = max(0., self.failures[cell] - 1)
+        else:
+            self.failures[cell] += 1
+    def __repr__(self):
+        return '{}({}, {}, samples={}, acceptance={:.3f})'.format(
+            self.__class__.__name__, self.obj_name, self.surface_name, self.num_samples, self.acceptance_rate)
+
+################################################################################
+
+def get_placement_sampler(world, obj_name, surface_name):
+    key = (obj_name, surface_name)
+    if key not in world.placement_samplers:
+        world.placement_samplers[key] = PlacementSampler(world, obj_name, surface_name)
+    return world.placement_samplers[key]
+
+def get_placement_statistics(world):
+    # {surface_name: (samples, accepted)}
+    statistics = {}
+    for sampler in world.placement_samplers.values():
+        samples, accepted = statistics.get(sampler.surface_name, (0, 0))
+        statistics[sampler.surface_name] = (samples + sampler.num_samples, accepted + sampler.num_accepted)
+    return statistics
+
+def report_placement_statistics(world):
+    for surface_name, (samples, accepted) in sorted(get_placement_statistics(world).items()):
+        print('Placements on {}: {} / {} ({:.3f})'.format(
+            surface_name, accepted, samples, float(accepted) / samples if samples else 0.))
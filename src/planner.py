@@ -153,7 +153,8 @@ def solve_pddlstream(belief, problem, args, skeleton=None, replan_actions=set(),
     pr.enable()
     saver = WorldSaver()
     sim_state = belief.sample_state()
-    sim_state.assign()
+    if sim_state is not None:
+        sim_state.assign()
     wait_for_duration(0.1)
     with LockRenderer(lock=not args.visualize):
         # TODO: option to only consider costs during local optimization
@@ -7,6 +7,12 @@ from pybullet_tools.utils import wait_for_duration, wait_for_user, \
     print_separator, INF, elapsed_time
 from pddlstream.utils import get_peak_memory_in_kb, str_from_object
 from pddlstream.language.constants import Certificate, PDDLProblem
+from src.database import DATABASE_CACHE
+from src.collision import COLLISION_CACHE
+from src.density import DENSITY_CACHE
+from src.candidates import reset_candidate_statistics, report_candidate_statistics
+from src.placement import report_placement_statistics
+from src.roadmap import report_roadmaps, reset_roadmap_statistics
 from src.belief import create_observable_belief, transition_belief_update, create_observable_pose_dist
 from src.planner import solve_pddlstream, extract_plan_prefix, commands_from_plan
 from src.problem import pdddlstream_from_problem, get_streams
@@ -58,6 +64,18 @@ def run_policy(task, args, observation_fn, transition_fn, constrain=True, defer=
     replan_actions = OBSERVATION_ACTIONS if args.deterministic else STOCHASTIC_ACTIONS
     defer_actions = replan_actions if defer else set()
     world = task.world
+    # Collision results persist across the planner calls of one episode
+    COLLISION_CACHE.clear()
+    COLLISION_CACHE.reset_statistics()
+    DENSITY_CACHE.clear()
+    DENSITY_CACHE.reset_statistics()
+    world.get_obstacle_tree().reset_statistics()
+    world.ik_cache.reset_statistics()
+    world.door_cache.reset_statistics()
+    if world.stream_store is not None:
+        world.stream_store.reset_statistics()
+    reset_roadmap_statistics(world)
+    reset_candidate_statistics(world)
     if args.observable:
         # TODO: problematic if not observable
         belief = create_observable_belief(world)  # Fast
@@ -172,6 +190,21 @@ def run_policy(task, args, observation_fn, transition_fn, constrain=True, defer=
         print('Success!')
     else:
         print('Failure!')
+    print('Database cache:', DATABASE_CACHE)
+    print('Collision cache:', COLLISION_CACHE)
+    print('Density cache:', DENSITY_CACHE)
+    print('Obstacle tree:', world.get_obstacle_tree())
+    print('IK cache:', world.ik_cache)
+    print('Door cache:', world.door_cache)
+    print('Belief sampler:', belief.sampler)
+    report_roadmaps(world)
+    if world.stream_pool is not None:
+        print('Stream pool:', world.stream_pool)
+    if world.stream_store is not None:
+        world.stream_store.save()
+        print('Stream store:', world.stream_store)
+    report_candidate_statistics(world)
+    report_placement_statistics(world)
     # TODO: timed out flag
     # TODO: store current and peak memory usage
     data = {
@@ -34,6 +34,7 @@ from src.streams.pull import get_fixed_pull_gen_fn, get_pull_gen_fn
 from src.streams.pick import get_fixed_pick_gen_fn, get_pick_gen_fn
 from src.streams.pour import get_fixed_pour_gen_fn, get_pour_gen_fn
 from src.database import has_place_database
+from src.parallel import get_stream_fns, get_stream_map
 
 MAX_ERROR = np.pi / 6
 
@@ -119,6 +120,16 @@ def get_streams(world, debug=False, teleport_base=False, **kwargs):
         #'MoveCost': move_cost_fn,
         # 'Distance': base_cost_fn,
     }
+    if (world.stream_pool is not None) or (world.stream_store is not None):
+        stream_kwargs = dict(kwargs, teleport_base=teleport_base)
+        stream_fns = get_stream_fns(world, **stream_kwargs)
+        if world.stream_pool is not None:
+            # The expensive streams race across the replica worlds of the pool
+            stream_fns = world.stream_pool.wrap_stream_fns(stream_fns, stream_kwargs)
+        if world.stream_store is not None:
+            # Outputs stored by previous runs in the same world are reused first
+            stream_fns = world.stream_store.wrap_stream_fns(stream_fns, stream_kwargs)
+        stream_map.update(get_stream_map(stream_fns))
     return stream_pddl, stream_map
 
 ################################################################################
@@ -392,8 +403,8 @@ def pdddlstream_from_problem(belief, additional_init=[], fixed_base=True, **kwar
 
     # TODO: track poses over time to produce estimates
     for obj_name, pose_dist in belief.pose_dists.items():
-        dist_support = pose_dist.dist.support()
         localized = pose_dist.is_localized()
+        dist_support = pose_dist.dist.support() if localized else None
         graspable = True
         if localized:
             init.append(('Localized', obj_name))
@@ -0,0 +1,275 @@
+from __future__ import print_function
+
+import os
+import numpy as np
+
+from pybullet_tools.utils import grow_polygon
+from src.cache import LRUCache
+from src.database import DATABASE_DIRECTORY, POSE_LENGTH, get_database_mtimes, get_place_path, get_pull_path, \
+    load_place_array, load_inverse_placement_array, load_pull_base_array, get_joint_reference_pose, is_press, \
+    load_place_failure_array, row_from_pose
+from src.utils import ALL_SURFACES, GRASP_TYPES, rotate_points, multiply_pose_rows, invert_pose_rows
+
+# Rasterized grown convex hulls of the IR databases used by the test-near-* streams
+GRID_RESOLUTION = 0.01 # meters per cell
+GRID_FILENAME = '{robot_name}-{name}-grid.npz'
+MAX_GRIDS = 100
+
+GRID_CACHE = LRUCache(max_size=MAX_GRIDS)
+
+# Success rates of the place IR databases binned over the tool position and heading in the base frame
+MODEL_FILENAME = '{robot_name}-{surface_name}-{grasp_type}-model.npz'
+MODEL_RESOLUTION = 0.1 # meters per cell
+MODEL_HEADINGS = 8 # cells per revolution
+PRIOR_STRENGTH = 1.
+
+MODEL_CACHE = LRUCache(max_size=MAX_GRIDS)
+
+class OccupancyGrid(object):
+    def __init__(self, lower, resolution, mask):
+        self.lower = np.array(lower, dtype=np.float64)
+        self.resolution = resolution
+        self.mask = np.array(mask, dtype=bool)
+    @property
+    def shape(self):
+        return self.mask.shape
+    def contains(self, point):
+        if not self.mask.size:
+            return False
+        x, y = point[:2]
+        i = int(np.floor((x - self.lower[0]) / self.resolution))
+        j = int(np.floor((y - self.lower[1]) / self.resolution))
+        if not ((0 <= i < self.shape[0]) and (0 <= j < self.shape[1])):
+            return False
+        return bool(self.mask[i, j])
+    def contains_points(self, points):
+        # Vectorized contains over an (N, >=2) array
+        contained = np.zeros(len(points), dtype=bool)
+        if not (self.mask.size and len(points)):
+            return contained
+        indices = np.floor((np.array(points, dtype=np.float64)[:, :2] - self.lower) / self.resolution).astype(int)
+        inside = np.all((0 <= indices) & (indices < np.array(self.shape)), axis=1)
+        contained[inside] = self.mask[indices[inside, 0], indices[inside, 1]]
+        return contained
+    def __repr__(self):
+        return '{}(shape={}, resolution={}, occupied={})'.format(
+            self.__class__.__name__, self.shape, self.resolution, np.count_nonzero(self.mask))
+
+def rasterize_polygon(vertices, resolution=GRID_RESOLUTION):
+    # Same sign test as is_point_in_polygon, evaluated at every cell center
+    if not vertices:
+        return OccupancyGrid(np.zeros(2), resolution, np.zeros((0, 0), dtype=bool))
+    vertices = np.array([vertex[:2] for vertex in vertices], dtype=np.float64)
+    lower = np.min(vertices, axis=0) - resolution
+    upper = np.max(vertices, axis=0) + resolution
+    shape = np.ceil((upper - lower) / resolution).astype(int)
+    xs = lower[0] + resolution*(np.arange(shape[0]) + 0.5)
+    ys = lower[1] + resolution*(np.arange(shape[1]) + 0.5)
+    centers = np.stack(np.meshgrid(xs, ys, indexing='ij'), axis=-1).reshape(-1, 2)
+    mask = np.ones(len(centers), dtype=bool)
+    sign = None
+    for start, end in zip(np.roll(vertices, 1, axis=0), vertices):
+        delta = end - start
+        normal = np.array([-delta[1], delta[0]])
+        signs = np.sign((centers - start).dot(normal))
+        if sign is None:
+            sign = signs
+        else:
+            mask &= (signs == sign)
+    return OccupancyGrid(lower, resolution, mask.reshape(shape))
+
+################################################################################
+
+def get_grid_path(robot_name, name):
+    return os.path.abspath(os.path.join(DATABASE_DIRECTORY, GRID_FILENAME.format(
+        robot_name=robot_name, name=name)))
+
+def save_grid(path, grid, signature):
+    np.savez_compressed(path, lower=grid.lower, resolution=grid.resolution,
+                        mask=grid.mask, signature=signature)
+    return path
+
+def read_grid(path, signature):
+    # Returns None when the grid was built from different databases or parameters
+    if not os.path.exists(path):
+        return None
+    data = np.load(path)
+    if str(data['signature']) != signature:
+        return None
+    return OccupancyGrid(data['lower'], float(data['resolution']), data['mask'])
+
+def load_grid(robot_name, name, points_fn, sources, radius, resolution=GRID_RESOLUTION, frame=None):
+    signature = repr((sorted((path, get_database_mtimes(path)) for path in sources), radius, resolution, frame))
+    key = (robot_name, name)
+    cached = GRID_CACHE.get(key)
+    if (cached is not None) and (cached[0] == signature):
+        return cached[1]
+    path = get_grid_path(robot_name, name)
+    grid = read_grid(path, signature)
+    if grid is None:
+        points = points_fn()
+        grid = rasterize_polygon(grow_polygon(list(points), radius=radius), resolution=resolution)
+        save_grid(path, grid, signature)
+    GRID_CACHE.set(key, (signature, grid))
+    return grid
+
+################################################################################
+
+def load_forward_grid(world, surface_names=ALL_SURFACES, grasp_types=GRASP_TYPES, **kwargs):
+    # Object positions in the base frame
+    sources = [get_place_path(world.robot_name, surface_name, grasp_type)
+               for surface_name in surface_names for grasp_type in grasp_types]
+    def points_fn():
+        return np.concatenate([np.zeros((0, POSE_LENGTH))] + [
+            load_place_array(world.robot_name, surface_name, grasp_type, field='base_from_object')
+            for surface_name in surface_names for grasp_type in grasp_types])[:, :2]
+    name = 'forward-{}'.format('_'.join(grasp_types))
+    return load_grid(world.robot_name, name, points_fn, sources, **kwargs)
+
+def load_inverse_grid(world, surface_name, grasp_types=GRASP_TYPES, **kwargs):
+    # Base positions in the surface frame
+    sources = [get_place_path(world.robot_name, surface_name, grasp_type) for grasp_type in grasp_types]
+    def points_fn():
+        return load_inverse_placement_array(world, surface_name, grasp_types=grasp_types)[:, :2]
+    name = '{}-inverse-{}'.format(surface_name, '_'.join(grasp_types))
+    return load_grid(world.robot_name, name, points_fn, sources, **kwargs)
+
+def load_pull_grid(world, joint_name, **kwargs):
+    # Base positions in the world frame
+    sources = [get_pull_path(world.robot_name, joint_name)]
+    frame = np.round(np.concatenate(get_joint_reference_pose(world.kitchen, joint_name)), 6).tolist()
+    def points_fn():
+        return load_pull_base_array(world, joint_name)[:, :2]
+    name = '{}-{}'.format(joint_name, 'press' if is_press(joint_name) else 'pull')
+    return load_grid(world.robot_name, name, points_fn, sources, frame=frame, **kwargs)
+
+################################################################################
+
+def get_model_features(base_from_tool_rows, axis):
+    # The tool position in the base frame and the heading of one of its axes
+    rows = np.asarray(base_from_tool_rows, dtype=np.float64).reshape(-1, POSE_LENGTH)
+    direction = rotate_points(rows[:, 3:], np.eye(3)[axis])
+    return np.column_stack([rows[:, 0], rows[:, 1], np.arctan2(direction[:, 1], direction[:, 0])])
+
+def get_heading_axis(base_from_tool_rows):
+    # The tool axis that is the furthest from vertical
+    rows = np.asarray(base_from_tool_rows, dtype=np.float64).reshape(-1, POSE_LENGTH)
+    lengths = [np.mean(np.linalg.norm(rotate_points(rows[:, 3:], axis)[:, :2], axis=1)) for axis in np.eye(3)]
+    return int(np.argmax(lengths))
+
+class ReachabilityModel(object):
+    def __init__(self, lower, resolution, axis, successes, failures):
+        self.lower = np.array(lower, dtype=np.float64)
+        self.resolution = resolution
+        self.axis = int(axis)
+        self.successes = np.array(successes, dtype=np.int64)
+        self.failures = np.array(failures, dtype=np.int64)
+    @property
+    def shape(self):
+        return self.successes.shape
+    @property
+    def prior(self):
+        total = np.sum(self.successes) + np.sum(self.failures)
+        return float(np.sum(self.successes)) / total if total else 1.
+    def get_cells(self, base_from_tool_rows):
+        # Returns the cell indices and whether each falls within the model
+        features = get_model_features(base_from_tool_rows, self.axis)
+        positions = np.floor((features[:, :2] - self.lower) / self.resolution).astype(int)
+        headings = np.floor((features[:, 2] + np.pi) / (2*np.pi) * self.shape[2]).astype(int) % self.shape[2]
+        inside = np.all((0 <= positions) & (positions < np.array(self.shape[:2])), axis=1)
+        return np.column_stack([positions, headings]), inside
+    def count(self, base_from_tool_rows):
+        counts = np.zeros(self.shape, dtype=np.int64)
+        cells, inside = self.get_cells(base_from_tool_rows)
+        np.add.at(counts, tuple(cells[inside].T), 1)
+        return counts
+    def score(self, base_from_tool_rows):
+        # Posterior mean success rate under a Beta prior whose pseudo-failures also penalize unexplored cells
+        cells, inside = self.get_cells(base_from_tool_rows)
+        successes = np.zeros(len(cells))
+        failures = np.zeros(len(cells))
+        successes[inside] = self.successes[tuple(cells[inside].T)]
+        failures[inside] = self.failures[tuple(cells[inside].T)]
+        pseudo_successes = PRIOR_STRENGTH*self.prior
+        return (successes + pseudo_successes) / (successes + failures + pseudo_successes + PRIOR_STRENGTH)
+    def __repr__(self):
+        return '{}(shape={}, successes={}, failures={})'.format(
+            self.__class__.__name__, self.shape, np.sum(self.successes), np.sum(self.failures))
+
+def build_model(success_rows, failure_rows, resolution=MODEL_RESOLUTION, headings=MODEL_HEADINGS):
+    # Rows are base_from_tool poses
+    axis = get_heading_axis(success_rows)
+    points = np.concatenate([success_rows, failure_rows])[:, :2]
+    lower = np.min(points, axis=0) - resolution
+    upper = np.max(points, axis=0) + resolution
+    shape = tuple(np.ceil((upper - lower) / resolution).astype(int)) + (headings,)
+    model = ReachabilityModel(lower, resolution, axis, np.zeros(shape), np.zeros(shape))
+    model.successes = model.count(success_rows)
+    model.failures = model.count(failure_rows)
+    return model
+
+def get_model_path(robot_name, surface_name, grasp_type):
+    return os.path.abspath(os.path.join(DATABASE_DIRECTORY, MODEL_FILENAME.format(
+        robot_name=robot_name, surface_name=surface_name, grasp_type=grasp_type)))
+
+def save_model(path, model, signature):
+    np.savez_compressed(path, lower=model.lower, resolution=model.resolution, axis=model.axis,
+                        successes=model.successes, failures=model.failures, signature=signature)
+    return path
+
+def read_model(path, signature):
+    if not os.path.exists(path):
+        return None
+    data = np.load(path)
+    if str(data['signature']) != signature:
+        return None
+    return ReachabilityModel(data['lower'], float(data['resolution']), int(data['axis']),
+                             data['successes'], data['failures'])
+
+def load_place_model(robot_name, surface_name, grasp_type, resolution=MODEL_RESOLUTION, headings=MODEL_HEADINGS):
+    # Rebuilt and saved next to the database whenever the database changes
+    # Returns None without any successes
+    database_path = get_place_path(robot_name, surface_name, grasp_type)
+    signature = repr((get_database_mtimes(database_path), resolution, headings))
+    key = (robot_name, surface_name, grasp_type)
+    cached = MODEL_CACHE.get(key)
+    if (cached is not None) and (cached[0] == signature):
+        return cached[1]
+    path = get_model_path(robot_name, surface_name, grasp_type)
+    model = read_model(path, signature)
+    if model is None:
+        success_rows = invert_pose_rows(load_place_array(robot_name, surface_name, grasp_type, field='tool_from_base'))
+        if not len(success_rows):
+            return None
+        failure_rows = invert_pose_rows(load_place_failure_array(robot_name, surface_name, grasp_type))
+        model = build_model(success_rows, failure_rows, resolution=resolution, headings=headings)
+        save_model(path, model, signature)
+    MODEL_CACHE.set(key, (signature, model))
+    return model
+
+def load_place_weights(world, surface_name, grasp_type):
+    # Model scores of the database entries, aligned with load_place_array
+    tool_from_bases = load_place_array(world.robot_name, surface_name, grasp_type, field='tool_from_base')
+    model = load_place_model(world.robot_name, surface_name, grasp_type)
+    if model is None:
+        return np.ones(len(tool_from_bases))
+    return model.score(invert_pose_rows(tool_from_bases))
+
+def load_pour_weights(world, surface_name, grasp_types=GRASP_TYPES):
+    # Aligned with load_inverse_placement_array
+    return np.concatenate([np.zeros(0)] + [load_place_weights(world, surface_name, grasp_type)
+                                           for grasp_type in grasp_types])
+
+def get_base_rows(base_values):
+    x, y, theta = np.asarray(base_values, dtype=np.float64).reshape(-1, 3).T
+    zeros = np.zeros(len(x))
+    return np.column_stack([x, y, zeros, zeros, zeros, np.sin(theta / 2), np.cos(theta / 2)])
+
+def get_place_score_fn(world, tool_pose, surface_name, grasp_type):
+    # Scores world base values for reaching tool_pose, or None without a model
+    model = load_place_model(world.robot_name, surface_name, grasp_type)
+    if model is None:
+        return None
+    def score_fn(base_values):
+        return model.score(multiply_pose_rows(invert_pose_rows(get_base_rows(base_values)), row_from_pose(tool_pose)))
+    return score_fn
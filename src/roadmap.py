@@ -0,0 +1,296 @@
+from __future__ import print_function
+
+import heapq
+import numpy as np
+
+from pybullet_tools.utils import get_sample_fn, get_nonholonomic_extend_fn, get_extend_fn, get_joint_positions, \
+    set_joint_positions, pairwise_collision, get_collision_fn, get_moving_links
+from src.cache import LRUCache
+from src.collision import round_values, pose_key
+from src.utils import get_obstacle_aabb
+
+# Persistent roadmaps whose vertices and edges are collision checked lazily
+# Results are stored per obstacle (keyed on its AABB) so changing the fluent obstacles only checks the new ones
+BASE_ROADMAP_VERTICES = 250
+BASE_ROADMAP_NEIGHBORS = 8
+ARM_ROADMAP_VERTICES = 50 # Mostly grown from the paths of the fallback planner
+ARM_ROADMAP_NEIGHBORS = 6
+MAX_BASE_ROADMAP_VERTICES = 1000 # Fallback paths stop seeding the roadmap past these
+MAX_ARM_ROADMAP_VERTICES = 200
+ROTATION_WEIGHT = 0.5 # meters per radian
+MAX_LAZY_ITERATIONS = 100
+MAX_ROBOT_KEYS = 100 # Confs of the other joints and attachments with stored results
+PATH_STRIDE = 5
+SELF_KEY = 'self'
+
+def wrap_angles(angles):
+    return (np.array(angles) + np.pi) % (2 * np.pi) - np.pi
+
+def get_robot_key(world, joints, attachments):
+    # The results depend on the joints that are not planned and what the robot carries
+    return round_values(get_joint_positions(world.robot, joints)) + \
+           tuple((attachment.child, pose_key(attachment.grasp_pose)) for attachment in attachments)
+
+class Roadmap(object):
+    def __init__(self, robot, joints, sample_fn, extend_fn, num_vertices, num_neighbors, max_vertices,
+                 self_collisions=False, disabled_collisions=set(), custom_limits={}):
+        self.robot = robot
+        self.joints = joints
+        self.sample_fn = sample_fn
+        self.extend_fn = extend_fn
+        self.num_neighbors = num_neighbors
+        self.max_vertices = max_vertices
+        self.self_collisions = self_collisions
+        self.disabled_collisions = disabled_collisions
+        self.custom_limits = custom_limits
+        self.moving_links = frozenset(get_moving_links(robot, joints))
+        self.buffer = np.zeros((max(num_vertices, 1), len(self.joints))) # Grown by doubling
+        self.num_vertices = 0
+        self.edges = [] # Adjacency sets
+        self.paths = {} # (i, j) -> waypoints after vertex i
+        self.results = LRUCache(max_size=MAX_ROBOT_KEYS) # robot key -> {element: {obstacle key: collision}}
+        self.num_queries = 0
+        self.num_solved = 0
+        self.num_checks = 0
+        for _ in range(num_vertices):
+            self.add_vertex(self.sample_fn())
+    def __len__(self):
+        return self.num_vertices
+    @property
+    def vertices(self):
+        return self.buffer[:self.num_vertices]
+    @property
+    def num_edges(self):
+        return sum(map(len, self.edges)) // 2
+    def norms(self, deltas):
+        return np.linalg.norm(deltas, axis=1)
+    def distances(self, conf):
+        return self.norms(self.vertices - np.array(conf))
+    def add_vertex(self, conf):
+        if len(self):
+            distances = self.distances(conf)
+            index = int(np.argmin(distances))
+            if distances[index] < 1e-6:
+                return index
+            neighbors = np.argsort(distances)[:self.num_neighbors].tolist()
+        else:
+            neighbors = []
+        index = len(self)
+        if index == len(self.buffer):
+            self.buffer = np.vstack([self.buffer, np.zeros(self.buffer.shape)])
+        self.buffer[index] = conf
+        self.num_vertices += 1
+        self.edges.append(set())
+        for neighbor in neighbors:
+            self.add_edge(index, neighbor)
+        return index
+    def add_edge(self, index1, index2):
+        if index1 != index2:
+            self.edges[index1].add(index2)
+            self.edges[index2].add(index1)
+    def remove_vertices(self, num_vertices, elements):
+        # Drops the vertices past num_vertices along with the stored elements that refer to them
+        for index in range(num_vertices, len(self)):
+            for neighbor in self.edges[index]:
+                if neighbor < num_vertices:
+                    self.edges[neighbor].discard(index)
+        del self.edges[num_vertices:]
+        self.num_vertices = min(self.num_vertices, num_vertices)
+        for results in self.results.values():
+            for element in elements:
+                results.pop(element, None)
+        for element in elements:
+            self.paths.pop(element[1:], None)
+    def add_path(self, path):
+        # Seeds the roadmap with a path found by the fallback planner until it is full
+        indices = []
+        for conf in list(path)[::PATH_STRIDE] + [path[-1]]:
+            if self.max_vertices <= len(self):
+                break
+            indices.append(self.add_vertex(conf))
+        for index1, index2 in zip(indices[:-1], indices[1:]):
+            self.add_edge(index1, index2)
+    def get_path(self, index1, index2):
+        key = (index1, index2)
+        if key not in self.paths:
+            self.paths[key] = list(self.extend_fn(self.vertices[index1], self.vertices[index2]))
+        return self.paths[key]
+    def get_cost(self, index1, index2):
+        return self.norms((self.vertices[index2] - self.vertices[index1])[np.newaxis])[0]
+    def get_collision_fn(self, attachments):
+        # Self-collisions and joint limits
+        return get_collision_fn(self.robot, self.joints, [], attachments, self.self_collisions,
+                                self.disabled_collisions, custom_limits=self.custom_limits)
+    def collision(self, obstacle, attachments, collision_fn):
+        if obstacle is None:
+            return collision_fn(get_joint_positions(self.robot, self.joints))
+        return pairwise_collision((self.robot, self.moving_links), obstacle) or \
+               any(pairwise_collision(attachment.child, obstacle) for attachment in attachments)
+    def check(self, element, confs, obstacle_keys, attachments, results, collision_fn=None):
+        # Returns True if the confs are collision-free, only checking obstacles without a stored result
+        element_results = results.setdefault(element, {})
+        if any(element_results.get(key, False) for key in obstacle_keys.values()):
+            return False
+        unknown = [(obstacle, key) for obstacle, key in obstacle_keys.items() if key not in element_results]
+        for conf in confs:
+            if not unknown:
+                break
+            set_joint_positions(self.robot, self.joints, conf)
+            for attachment in attachments:
+                attachment.assign()
+            for obstacle, key in unknown:
+                self.num_checks += 1
+                if self.collision(obstacle, attachments, collision_fn):
+                    element_results[key] = True
+                    return False
+        for _, key in unknown:
+            element_results[key] = False
+        return True
+    def search(self, start, goal, is_blocked):
+        # Dijkstra over the vertices and edges not known to collide
+        costs = {start: 0.}
+        parents = {start: None}
+        queue = [(0., start)]
+        while queue:
+            cost, index = heapq.heappop(queue)
+            if index == goal:
+                indices = []
+                while index is not None:
+                    indices.append(index)
+                    index = parents[index]
+                return indices[::-1]
+            if costs[index] < cost:
+                continue
+            for neighbor in self.edges[index]:
+                if is_blocked(('v', neighbor)) or is_blocked(('e', index, neighbor)):
+                    continue
+                new_cost = cost + self.get_cost(index, neighbor)
+                if new_cost < costs.get(neighbor, np.inf):
+                    costs[neighbor] = new_cost
+                    parents[neighbor] = index
+                    heapq.heappush(queue, (new_cost, neighbor))
+        return None
+    def query(self, start_conf, goal_conf, obstacles, attachments, robot_key):
+        # The start and goal are only added for the search unless they already are vertices
+        self.num_queries += 1
+        num_vertices = len(self)
+        start, goal = self.add_vertex(start_conf), self.add_vertex(goal_conf)
+        temporary = set()
+        def visit_fn(element):
+            if num_vertices <= max(element[1:]):
+                temporary.add(element)
+        try:
+            return self.search_path(start_conf, start, goal, obstacles, attachments, robot_key, visit_fn)
+        finally:
+            self.remove_vertices(num_vertices, temporary)
+    def search_path(self, start_conf, start, goal, obstacles, attachments, robot_key, visit_fn):
+        results = self.results.get(robot_key)
+        if results is None:
+            results = self.results.set(robot_key, {})
+        obstacle_keys = {obstacle: (obstacle, round_values(get_obstacle_aabb(obstacle))) for obstacle in obstacles}
+        collision_fn = None
+        if self.self_collisions:
+            obstacle_keys[None] = SELF_KEY
+            collision_fn = self.get_collision_fn(attachments)
+        blocked = {}
+        def is_blocked(element):
+            if element not in blocked:
+                element_results = results.get(element, {})
+                blocked[element] = any(element_results.get(key, False) for key in obstacle_keys.values())
+            return blocked[element]
+        def is_free(index1, index2=None):
+            element, confs = (('v', index1), [self.vertices[index1]]) if index2 is None else \
+                (('e', index1, index2), self.get_path(index1, index2))
+            visit_fn(element)
+            if self.check(element, confs, obstacle_keys, attachments, results, collision_fn=collision_fn):
+                return True
+            blocked[element] = True
+            return False
+
+        for _ in range(MAX_LAZY_ITERATIONS):
+            indices = self.search(start, goal, is_blocked)
+            if indices is None:
+                return None
+            if all(is_free(index) for index in indices) and \
+                    all(is_free(index1, index2) for index1, index2 in zip(indices[:-1], indices[1:])):
+                break
+        else:
+            return None
+        # Greedily skips vertices when the direct motion is also free
+        shortcut = [indices[0]]
+        i = 0
+        while i < len(indices) - 1:
+            j = len(indices) - 1
+            while (i + 1 < j) and not is_free(indices[i], indices[j]):
+                j -= 1
+            shortcut.append(indices[j])
+            i = j
+        self.num_solved += 1
+        path = [tuple(start_conf)]
+        for index1, index2 in zip(shortcut[:-1], shortcut[1:]):
+            path.extend(self.get_path(index1, index2))
+        return path
+    def reset_statistics(self):
+        self.num_queries = self.num_solved = self.num_checks = 0
+    def __repr__(self):
+        return '{}(vertices={}, edges={}, queries={}, solved={}, checks={})'.format(
+            self.__class__.__name__, len(self), self.num_edges, self.num_queries, self.num_solved, self.num_checks)
+
+class BaseRoadmap(Roadmap):
+    def __init__(self, world, custom_limits, num_vertices=BASE_ROADMAP_VERTICES,
+                 num_neighbors=BASE_ROADMAP_NEIGHBORS):
+        super(BaseRoadmap, self).__init__(
+            world.robot, world.base_joints, get_sample_fn(world.robot, world.base_joints, custom_limits=custom_limits),
+            get_nonholonomic_extend_fn(world.robot, world.base_joints, reversible=True),
+            num_vertices, num_neighbors, MAX_BASE_ROADMAP_VERTICES, custom_limits=custom_limits)
+    def norms(self, deltas):
+        return np.linalg.norm(deltas[:, :2], axis=1) + ROTATION_WEIGHT * np.abs(wrap_angles(deltas[:, 2]))
+
+class ArmRoadmap(Roadmap):
+    def __init__(self, world, resolutions, self_collisions=True, num_vertices=ARM_ROADMAP_VERTICES,
+                 num_neighbors=ARM_ROADMAP_NEIGHBORS):
+        super(ArmRoadmap, self).__init__(
+            world.robot, world.arm_joints, get_sample_fn(world.robot, world.arm_joints),
+            get_extend_fn(world.robot, world.arm_joints, resolutions=resolutions),
+            num_vertices, num_neighbors, MAX_ARM_ROADMAP_VERTICES, self_collisions=self_collisions,
+            disabled_collisions=world.disabled_collisions, custom_limits=world.custom_limits)
+        for conf in world.special_confs:
+            self.add_vertex(conf.values)
+
+################################################################################
+
+def get_base_roadmap(world):
+    # One roadmap per set of base limits
+    key = tuple(sorted((joint, tuple(np.round(limits, 3).tolist()))
+                       for joint, limits in world.custom_limits.items()))
+    if key not in world.base_roadmaps:
+        world.base_roadmaps[key] = BaseRoadmap(world, world.custom_limits)
+    return world.base_roadmaps[key]
+
+def get_arm_roadmap(world, resolutions, self_collisions=True):
+    # One roadmap per base conf
+    key = round_values(get_joint_positions(world.robot, world.base_joints))
+    roadmap = world.arm_roadmaps.get(key)
+    if roadmap is None:
+        roadmap = world.arm_roadmaps.set(key, ArmRoadmap(world, resolutions, self_collisions=self_collisions))
+    return roadmap
+
+def plan_roadmap_motion(world, roadmap, end_conf, obstacles, attachments, other_joints):
+    # Plans from the current conf and restores it, returning None when the roadmap fails
+    start_conf = get_joint_positions(world.robot, roadmap.joints)
+    path = roadmap.query(start_conf, end_conf, obstacles, attachments,
+                         robot_key=get_robot_key(world, other_joints, attachments))
+    set_joint_positions(world.robot, roadmap.joints, start_conf)
+    return path
+
+def reset_roadmap_statistics(world):
+    for roadmap in list(world.base_roadmaps.values()) + world.arm_roadmaps.values():
+        roadmap.reset_statistics()
+
+def report_roadmaps(world):
+    for roadmap in world.base_roadmaps.values():
+        print('Base roadmap:', roadmap)
+    arm_roadmaps = world.arm_roadmaps.values()
+    print('Arm roadmaps: {} | queries={} | solved={} | checks={}'.format(
+        len(arm_roadmaps), sum(roadmap.num_queries for roadmap in arm_roadmaps),
+        sum(roadmap.num_solved for roadmap in arm_roadmaps), sum(roadmap.num_checks for roadmap in arm_roadmaps)))
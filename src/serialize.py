@@ -0,0 +1,135 @@
+from __future__ import print_function
+
+import numpy as np
+
+import src.command
+from pybullet_tools.utils import Attachment, BodySaver, WorldSaver, get_bodies, get_pose, set_pose, \
+    get_movable_joints, get_joint_positions, set_joint_positions
+from src.command import Sequence, State, Command
+from src.utils import FConf, RelPose, Grasp
+
+# Stream inputs and outputs as tagged tuples of plain data that can be pickled between a World and its replicas
+# Bodies are sent as ids, which agree across replicas that load the same task
+PRIMITIVES = (type(None), bool, int, float, str, np.number, np.ndarray)
+COLLECTIONS = {cls.__name__: cls for cls in [tuple, list, set, frozenset]}
+TRANSIENT_ATTRIBUTES = {'world', 'swept_volumes'} # Recomputed on demand
+
+def get_body_state(body):
+    joints = get_movable_joints(body)
+    return get_pose(body), tuple(joints), tuple(get_joint_positions(body, joints))
+
+def set_body_state(body, state):
+    pose, joints, positions = state
+    set_pose(body, pose)
+    set_joint_positions(body, joints, positions)
+
+def snapshot_bodies(bodies=None):
+    if bodies is None:
+        bodies = get_bodies()
+    return {body: get_body_state(body) for body in bodies}
+
+def restore_snapshot(snapshot):
+    for body, state in snapshot.items():
+        set_body_state(body, state)
+
+def get_shared_confs(world):
+    # Constant confs that streams and the domain compare by identity
+    return list(world.special_confs) + list(world.gripper_confs) + list(world.initial_confs)
+
+################################################################################
+
+def serialize_saver(saver):
+    # Captures the saved state by restoring it (only safe where the current state no longer matters)
+    saver.restore()
+    if hasattr(saver, 'body_savers'):
+        return ('WorldSaver', snapshot_bodies([body_saver.body for body_saver in saver.body_savers]))
+    return ('BodySaver', snapshot_bodies([saver.body]))
+
+def deserialize_saver(data):
+    tag, snapshot = data
+    current = snapshot_bodies(snapshot.keys())
+    restore_snapshot(snapshot)
+    if tag == 'WorldSaver':
+        saver = WorldSaver()
+    else:
+        [body] = snapshot.keys()
+        saver = BodySaver(body)
+    restore_snapshot(current)
+    return saver
+
+def serialize(world, value):
+    if isinstance(value, PRIMITIVES):
+        return value
+    if isinstance(value, FConf):
+        shared = [i for i, conf in enumerate(get_shared_confs(world)) if conf is value]
+        attributes = {'nearby_bq': serialize(world, value.nearby_bq)} if hasattr(value, 'nearby_bq') else {}
+        return ('FConf', value.body, tuple(value.joints), tuple(value.values),
+                shared[0] if shared else None, attributes)
+    if isinstance(value, Attachment):
+        return ('Attachment', value.parent, value.parent_link, value.grasp_pose, value.child)
+    if isinstance(value, RelPose):
+        return ('RelPose', value.body, value.reference_body, value.reference_link, serialize(world, value.confs),
+                value.support, value.init, value.observations)
+    if isinstance(value, Grasp):
+        return ('Grasp', value.body_name, value.grasp_type, value.index, value.grasp_pose,
+                value.pregrasp_pose, value.grasp_width)
+    if isinstance(value, State):
+        return ('State', tuple(map(serialize_saver, value.savers)),
+                serialize(world, tuple(value.attachments.values())))
+    if isinstance(value, Sequence):
+        return ('Sequence', serialize(world, value.context), serialize(world, value.commands), value.name)
+    if isinstance(value, Command):
+        attributes = {name: serialize(world, attribute) for name, attribute in vars(value).items()
+                      if name not in TRANSIENT_ATTRIBUTES}
+        return ('Command', value.__class__.__name__, attributes)
+    if isinstance(value, dict):
+        return ('dict', tuple((serialize(world, key), serialize(world, item)) for key, item in value.items()))
+    if value.__class__.__name__ in COLLECTIONS:
+        return (value.__class__.__name__, tuple(serialize(world, item) for item in value))
+    raise ValueError('Unable to serialize {}'.format(value.__class__.__name__))
+
+def deserialize(world, data):
+    if not isinstance(data, tuple):
+        return data
+    tag = data[0]
+    if tag in COLLECTIONS:
+        return COLLECTIONS[tag](deserialize(world, item) for item in data[1])
+    if tag == 'dict':
+        return {deserialize(world, key): deserialize(world, item) for key, item in data[1]}
+    if tag == 'FConf':
+        _, body, joints, values, shared, attributes = data
+        if shared is not None:
+            conf = get_shared_confs(world)[shared]
+            if (conf.body == body) and (tuple(conf.joints) == joints) and np.allclose(conf.values, values, atol=1e-8):
+                return conf
+        conf = FConf(body, list(joints), values)
+        for name, attribute in attributes.items():
+            setattr(conf, name, deserialize(world, attribute))
+        return conf
+    if tag == 'Attachment':
+        _, parent, parent_link, grasp_pose, child = data
+        return Attachment(parent, parent_link, grasp_pose, child)
+    if tag == 'RelPose':
+        _, body, reference_body, reference_link, confs, support, init, observations = data
+        pose = RelPose(body, reference_body=reference_body, reference_link=reference_link,
+                       confs=deserialize(world, confs), support=support, init=init)
+        pose.observations = observations
+        return pose
+    if tag == 'Grasp':
+        _, body_name, grasp_type, index, grasp_pose, pregrasp_pose, grasp_width = data
+        return Grasp(world, body_name, grasp_type, index, grasp_pose, pregrasp_pose, grasp_width=grasp_width)
+    if tag == 'State':
+        _, savers, attachments = data
+        return State(world, savers=list(map(deserialize_saver, savers)), attachments=deserialize(world, attachments))
+    if tag == 'Sequence':
+        _, context, commands, name = data
+        return Sequence(deserialize(world, context), commands=deserialize(world, commands), name=name)
+    if tag == 'Command':
+        _, class_name, attributes = data
+        cls = getattr(src.command, class_name)
+        command = cls.__new__(cls)
+        command.world = world
+        for name, attribute in attributes.items():
+            setattr(command, name, deserialize(world, attribute))
+        return command
+    raise ValueError('Unable to deserialize {}'.format(tag))
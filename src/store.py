@@ -0,0 +1,195 @@
+from __future__ import print_function
+
+import glob
+import hashlib
+import os
+import pickle
+import numpy as np
+
+from pybullet_tools.utils import BodySaver, get_pose, get_custom_limits, all_between, safe_remove
+from src.cache import LRUCache
+from src.collision import pose_key, DECIMALS
+from src.database import DATABASE_DIRECTORY
+from src.parallel import GENERATOR_STREAMS, FUNCTION_STREAMS
+from src.serialize import serialize, deserialize, snapshot_bodies, restore_snapshot
+from src.utils import FConf
+
+# Successful stream outputs persisted across runs, keyed on a fingerprint of the static world and the stream inputs
+# Outputs are stored with serialize and pass a fast validity check before they are reused
+STORE_DIRECTORY = os.path.join(DATABASE_DIRECTORY, 'streams/')
+STORE_VERSION = 1 # Invalidates every store when the serialization changes
+MAX_STORE_BYTES = 64 * 1024**2 # per world
+MAX_STORE_OUTPUTS = 5 # per stream input
+MAX_STORE_WORLDS = 10
+PICKLE_PROTOCOL = 2 # Readable from python2
+
+def get_database_signature():
+    paths = sorted(glob.glob(os.path.join(DATABASE_DIRECTORY, '*.json')) +
+                   glob.glob(os.path.join(DATABASE_DIRECTORY, '*.bin')))
+    return [(os.path.basename(path), os.path.getmtime(path)) for path in paths]
+
+def get_world_fingerprint(world):
+    # Everything the stored outputs depend on other than the stream inputs
+    # Body ids appear in the serialized values, so the bodies must also agree
+    custom_limits = sorted((joint, tuple(np.round(limits, DECIMALS).tolist()))
+                           for joint, limits in world.custom_limits.items())
+    static = (STORE_VERSION, world.robot_name, sorted(world.body_from_name.items()),
+              pose_key(get_pose(world.kitchen)),
+              sorted((name, pose_key(get_pose(body))) for name, body in world.environment_bodies.items()),
+              custom_limits, get_database_signature())
+    return hashlib.sha1(repr(static).encode('utf-8')).hexdigest()[:16]
+
+def get_data_key(data):
+    # Hashable serialized data with rounded floats
+    if isinstance(data, (float, np.floating)):
+        return round(float(data), DECIMALS)
+    if isinstance(data, np.integer):
+        return int(data)
+    if isinstance(data, np.ndarray):
+        return get_data_key(data.tolist())
+    if isinstance(data, (tuple, list)):
+        return tuple(map(get_data_key, data))
+    if isinstance(data, dict):
+        return tuple(sorted(((get_data_key(key), get_data_key(value)) for key, value in data.items()), key=repr))
+    return data
+
+def get_data_size(outputs):
+    return len(pickle.dumps(outputs, protocol=PICKLE_PROTOCOL))
+
+def is_valid_conf(world, conf):
+    lower, upper = get_custom_limits(conf.body, conf.joints, world.custom_limits)
+    if not all_between(lower, conf.values, upper):
+        return False
+    if (conf.body != world.robot) or (tuple(conf.joints) != tuple(world.base_joints)):
+        return True
+    with BodySaver(world.robot):
+        conf.assign()
+        world.carry_conf.assign()
+        return not world.any_collision(world.robot, world.static_obstacles)
+
+def is_valid_output(world, outputs):
+    # Limits for every conf and static collisions for base confs
+    confs = [output for output in outputs if isinstance(output, FConf)]
+    confs.extend(conf.nearby_bq for conf in list(confs) if hasattr(conf, 'nearby_bq'))
+    return all(is_valid_conf(world, conf) for conf in confs)
+
+################################################################################
+
+class StreamStore(object):
+    def __init__(self, world, directory=STORE_DIRECTORY, max_size=MAX_STORE_BYTES):
+        self.world = world
+        self.directory = directory
+        self.fingerprint = get_world_fingerprint(world)
+        self.path = os.path.join(directory, '{}.pkl'.format(self.fingerprint))
+        self.entries = LRUCache(max_size=max_size, size_fn=get_data_size) # key -> [serialized outputs]
+        self.load()
+        self.reset_statistics()
+    def reset_statistics(self):
+        self.num_reused = 0
+        self.num_invalid = 0
+        self.num_stored = 0
+        self.entries.reset_statistics()
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                items = pickle.load(f)
+        except Exception as e:
+            print('Unable to load {}: {}'.format(self.path, e))
+            return
+        for key, outputs in items:
+            self.entries.set(key, outputs)
+    def save(self):
+        # Written atomically, least recently used first so that loading preserves the order
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self.entries.items(), f, protocol=PICKLE_PROTOCOL)
+        os.rename(temp_path, self.path)
+        # Evicts the least recently saved worlds
+        paths = sorted(glob.glob(os.path.join(self.directory, '*.pkl')), key=os.path.getmtime)
+        for path in paths[:-MAX_STORE_WORLDS]:
+            safe_remove(path)
+        return self.path
+    def serialize(self, value):
+        # Serializing states restores their savers
+        snapshot = snapshot_bodies()
+        try:
+            return serialize(self.world, value)
+        except ValueError:
+            return None
+        finally:
+            restore_snapshot(snapshot)
+    def get_key(self, name, stream_kwargs, args, kwargs):
+        inputs = self.serialize((args, kwargs))
+        if inputs is None:
+            return None
+        return (name, get_data_key(stream_kwargs), get_data_key(inputs))
+    def reuse(self, key):
+        # Generates (outputs, data key) for the valid stored outputs and drops the rest
+        for data in list(self.entries.get(key, default=[])):
+            try:
+                outputs = deserialize(self.world, data)
+                valid = is_valid_output(self.world, outputs)
+            except Exception:
+                valid = False
+            if not valid:
+                self.num_invalid += 1
+                self.remove(key, data)
+                continue
+            self.num_reused += 1
+            yield outputs, get_data_key(data)
+    def add(self, key, outputs):
+        data = self.serialize(outputs)
+        if data is None:
+            return None
+        data_key = get_data_key(data)
+        stored = self.entries.peek(key, default=[])
+        if all(get_data_key(other) != data_key for other in stored):
+            self.num_stored += 1
+            self.entries.set(key, (stored + [data])[-MAX_STORE_OUTPUTS:])
+        return data_key
+    def remove(self, key, data):
+        stored = [other for other in self.entries.peek(key, default=[]) if other is not data]
+        if stored:
+            self.entries.set(key, stored)
+        else:
+            self.entries.pop(key)
+    def stored_gen_fn(self, name, gen_fn, stream_kwargs):
+        def gen(*args, **kwargs):
+            key = self.get_key(name, stream_kwargs, args, kwargs)
+            reused = set()
+            if key is not None:
+                for outputs, data_key in self.reuse(key):
+                    reused.add(data_key)
+                    yield outputs
+            for outputs in gen_fn(*args, **kwargs):
+                if (key is not None) and (outputs is not None):
+                    if self.add(key, outputs) in reused:
+                        continue
+                yield outputs
+        return gen
+    def stored_fn(self, name, fn, stream_kwargs):
+        def wrapped(*args, **kwargs):
+            key = self.get_key(name, stream_kwargs, args, kwargs)
+            if key is not None:
+                for outputs, _ in self.reuse(key):
+                    return outputs
+            outputs = fn(*args, **kwargs)
+            if (key is not None) and (outputs is not None):
+                self.add(key, outputs)
+            return outputs
+        return wrapped
+    def wrap_stream_fns(self, stream_fns, stream_kwargs):
+        wrapped_fns = dict(stream_fns)
+        for name in GENERATOR_STREAMS:
+            wrapped_fns[name] = self.stored_gen_fn(name, stream_fns[name], stream_kwargs)
+        for name in FUNCTION_STREAMS:
+            wrapped_fns[name] = self.stored_fn(name, stream_fns[name], stream_kwargs)
+        return wrapped_fns
+    def __repr__(self):
+        return '{}({}, entries={}, size={}, reused={}, invalid={}, stored={}, evictions={})'.format(
+            self.__class__.__name__, self.fingerprint, len(self.entries), self.entries.size,
+            self.num_reused, self.num_invalid, self.num_stored, self.entries.evictions)
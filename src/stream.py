@@ -4,7 +4,7 @@ import math
 from itertools import islice
 from collections import namedtuple
 
-from pybullet_tools.pr2_utils import is_visible_point, get_view_aabb, support_from_aabb
+from pybullet_tools.pr2_utils import get_view_aabb, support_from_aabb
 from pybullet_tools.utils import pairwise_collision, multiply, invert, get_joint_positions, BodySaver, get_distance, \
     set_joint_positions, plan_direct_joint_motion, plan_joint_motion, \
     get_custom_limits, all_between, link_from_name, get_link_pose, \
@@ -15,15 +15,23 @@ from pybullet_tools.utils import pairwise_collision, multiply, invert, get_joint
     get_extend_fn, wait_for_user, set_renderer, child_link_from_joint, unit_from_theta
 from pddlstream.algorithms.downward import MAX_FD_COST #, get_cost_scale
 
-from src.command import Sequence, State, Detect, DoorTrajectory
-from src.database import load_placements, get_surface_reference_pose, load_pull_base_poses, load_forward_placements, load_inverse_placements
+from src.command import Sequence, State, Detect, DoorTrajectory, Trajectory
+from src.database import load_placement_array, row_from_pose, get_surface_reference_pose, load_pull_base_poses, \
+    load_forward_placements, load_inverse_placements
 from src.utils import get_grasps, iterate_approach_path, ALL_SURFACES, \
     get_descendant_obstacles, surface_from_name, RelPose, compute_surface_aabb, create_relative_pose, Z_EPSILON, \
-    get_surface_obstacles, test_supported, \
+    get_surface_obstacles, test_supported, test_robust_supported, \
     get_link_obstacles, ENV_SURFACES, FConf, open_surface_joints, DRAWERS, STOVES, \
-    TOP_GRASP, KNOBS, APPROACH_DISTANCE, FINGER_EXTENT, set_tool_pose, translate_linearly
+    TOP_GRASP, KNOBS, APPROACH_DISTANCE, FINGER_EXTENT, set_tool_pose, translate_linearly, get_obstacle_aabb, \
+    multiply_pose_rows
 from src.visualization import GROW_INVERSE_BASE, GROW_FORWARD_RADIUS
+from src.reachability import GRID_RESOLUTION, load_forward_grid, load_inverse_grid, load_pull_grid
 from src.inference import SurfaceDist
+from src.collision import cache_collision_test, command_collision
+from src.placement import get_placement_sampler
+from src.roadmap import get_arm_roadmap, plan_roadmap_motion
+from src.candidates import TOP_K, filter_base_candidates
+from src.doors import DoorMotion, get_motion_key, get_nearby_waypoints
 from examples.discrete_belief.run import revisit_mdp_cost, clip_cost, DDist #, MAX_COST
 
 COST_SCALE = 1 # costs will always be greater than one
@@ -132,13 +140,7 @@ def get_compute_angle_kin(world):
 ################################################################################
 
 def is_visible_by_camera(world, point):
-    for camera_name in world.cameras:
-        camera_body, camera_matrix, camera_depth = world.cameras[camera_name]
-        camera_pose = get_pose(camera_body)
-        #camera_point = point_from_pose(camera_pose)
-        if is_visible_point(camera_matrix, camera_depth, point, camera_pose):
-            return True
-    return False
+    return bool(np.any(world.are_visible([point])))
 
 def get_compute_detect(world, ray_trace=True, **kwargs):
     obstacles = world.static_obstacles
@@ -151,7 +153,7 @@ def get_compute_detect(world, ray_trace=True, **kwargs):
         open_surface_joints(world, pose.support)
         for camera_name in world.cameras:
             camera_body, camera_matrix, camera_depth = world.cameras[camera_name]
-            camera_pose = get_pose(camera_body)
+            camera_pose = world.get_camera_pose(camera_name)
             camera_point = point_from_pose(camera_pose)
             obj_point = point_from_pose(pose.get_world_from_body())
 
@@ -162,8 +164,7 @@ def get_compute_detect(world, ray_trace=True, **kwargs):
             # print(is_visible_aabb(view_aabb, camera_matrix=camera_matrix))
             obj_points = apply_affine(camera_pose, support_from_aabb(view_aabb)) + [obj_point]
             # obj_points = [obj_point]
-            if not all(is_visible_point(camera_matrix, camera_depth, point, camera_pose)
-                       for point in obj_points):
+            if not np.all(world.are_visible(obj_points, camera_names=[camera_name])):
                 continue
             rays = [Ray(camera_point, point) for point in obj_points]
             detect = Detect(world, camera_name, obj_name, pose, rays)
@@ -204,7 +205,7 @@ def get_ofree_ray_pose_test(world, **kwargs):
         pose.assign()
         body = world.get_body(detect.name)
         obstacles = get_link_obstacles(world, obj_name)
-        if any(pairwise_collision(body, obst) for obst in obstacles):
+        if world.any_collision(body, obstacles):
             return False
         visible = not obstacles & detect.compute_occluding()
         #if not visible:
@@ -255,8 +256,17 @@ def get_sample_belief_gen(world, # min_prob=1. / NUM_PARTICLES,  # TODO: relativ
             yield (pose_dist,)
             return
         valid_samples = {}
-        for rp in pose_dist.dist.support():
-            if 1 <= rp.observations:
+        particles = pose_dist.particles
+        # The object center must be within a frustum for detect_fn to succeed
+        # detect_fn opens the supporting surface first, so the points are computed with the surfaces open
+        with BodySaver(world.kitchen):
+            for surface in particles.surfaces:
+                if surface is not None:
+                    open_surface_joints(world, surface)
+            points = particles.get_world_rows()[:, :3]
+        candidates = (particles.observations < 1) & world.are_visible(points)
+        for rp in particles.get_poses(world, obj_name, np.flatnonzero(candidates)):
+            if (1 <= rp.observations) or (rp in valid_samples):
                 continue
             prob = pose_dist.discrete_prob(rp)
             #cost = detect_cost_fn(obj_name, pose_dist, obs=None, rp_sample=rp)
@@ -298,59 +308,51 @@ def update_belief_fn(world, **kwargs):
 
 ################################################################################
 
-def get_test_near_pose(world, grow_entity=GROW_FORWARD_RADIUS, collisions=False, teleport=False, **kwargs):
-    base_from_objects = grow_polygon(map(point_from_pose, load_forward_placements(world, **kwargs)), radius=grow_entity)
-    vertices_from_surface = {}
+def get_test_near_pose(world, grow_entity=GROW_FORWARD_RADIUS, grow_base=GROW_INVERSE_BASE,
+                       resolution=GRID_RESOLUTION, collisions=False, teleport=False, **kwargs):
+    forward_grid = load_forward_grid(world, radius=grow_entity, resolution=resolution, **kwargs)
+    grid_from_surface = {}
     # TODO: alternatively, distance to hull
 
     def test(object_name, pose, base_conf):
         if object_name in ALL_SURFACES:
             surface_name = object_name
-            if surface_name not in vertices_from_surface:
-                vertices_from_surface[surface_name] = grow_polygon(
-                    map(point_from_pose, load_inverse_placements(world, surface_name)), radius=GROW_INVERSE_BASE)
-            if not vertices_from_surface[surface_name]:
-                return False
+            if surface_name not in grid_from_surface:
+                grid_from_surface[surface_name] = load_inverse_grid(
+                    world, surface_name, radius=grow_base, resolution=resolution)
             base_conf.assign()
             pose.assign()
             surface = surface_from_name(surface_name)
             world_from_surface = get_link_pose(world.kitchen, link_from_name(world.kitchen, surface.link))
             world_from_base = get_link_pose(world.robot, world.base_link)
             surface_from_base = multiply(invert(world_from_surface), world_from_base)
-            #result = is_point_in_polygon(point_from_pose(surface_from_base), vertices_from_surface[surface_name])
+            #result = grid_from_surface[surface_name].contains(point_from_pose(surface_from_base))
             #if not result:
             #    draw_pose(surface_from_base)
-            #    points = [Point(x, y, 0) for x, y, in vertices_from_surface[surface_name]]
-            #    add_segments(points, closed=True)
             #    wait_for_user()
-            return is_point_in_polygon(point_from_pose(surface_from_base), vertices_from_surface[surface_name])
+            return grid_from_surface[surface_name].contains(point_from_pose(surface_from_base))
         else:
-            if not base_from_objects:
-                return False
             base_conf.assign()
             pose.assign()
             world_from_base = get_link_pose(world.robot, world.base_link)
             world_from_object = pose.get_world_from_body()
             base_from_object = multiply(invert(world_from_base), world_from_object)
-            return is_point_in_polygon(point_from_pose(base_from_object), base_from_objects)
+            return forward_grid.contains(point_from_pose(base_from_object))
     return test
 
-def get_test_near_joint(world, **kwargs):
-    vertices_from_joint = {}
+def get_test_near_joint(world, grow_base=GROW_INVERSE_BASE, resolution=GRID_RESOLUTION, **kwargs):
+    grid_from_joint = {}
 
     def test(joint_name, base_conf):
         if not DOOR_PROXIMITY:
             return True
-        if joint_name not in vertices_from_joint:
-            base_confs = list(load_pull_base_poses(world, joint_name))
-            vertices_from_joint[joint_name] = grow_polygon(base_confs, radius=GROW_INVERSE_BASE)
-        if not vertices_from_joint[joint_name]:
-            return False
+        if joint_name not in grid_from_joint:
+            grid_from_joint[joint_name] = load_pull_grid(world, joint_name, radius=grow_base, resolution=resolution)
         # TODO: can't open hitman_drawer_top_joint any more
         # Likely due to conservative carter geometry
         base_conf.assign()
         base_point = point_from_pose(get_link_pose(world.robot, world.base_link))
-        return is_point_in_polygon(base_point[:2], vertices_from_joint[joint_name])
+        return grid_from_joint[joint_name].contains(base_point)
     return test
 
 ################################################################################
@@ -367,8 +369,8 @@ def get_stable_gen(world, max_attempts=100,
         surface_body = world.kitchen
         if surface_name in ENV_SURFACES:
             surface_body = world.environment_bodies[surface_name]
-        surface_aabb = compute_surface_aabb(world, surface_name)
-        learned_poses = load_placements(world, surface_name) if learned else [] # TODO: GROW_PLACEMENT
+        learned_rows = load_placement_array(world, surface_name) if learned else [] # TODO: GROW_PLACEMENT
+        sampler = get_placement_sampler(world, obj_name, surface_name)
 
         yaw_range = (-np.pi, np.pi)
         #if world.is_real():
@@ -376,53 +378,44 @@ def get_stable_gen(world, max_attempts=100,
         #    half_extent = np.pi / 16
         #    yaw_range = (center-half_extent, center+half_extent)
         while True:
+            # The doors might have moved since the last sample
+            surface_aabb = compute_surface_aabb(world, surface_name)
+            if learned and len(learned_rows) and (surface_name not in STOVES):
+                surface_pose_world = get_surface_reference_pose(surface_body, surface_name)
+                learned_points = multiply_pose_rows(row_from_pose(surface_pose_world), learned_rows)[:, :3]
             for _ in range(max_attempts):
                 if surface_name in STOVES:
                     surface_link = link_from_name(world.kitchen, surface_name)
                     world_from_surface = get_link_pose(world.kitchen, surface_link)
                     z = stable_z_on_aabb(obj_body, surface_aabb) - point_from_pose(world_from_surface)[2]
-                    yaw = random.uniform(*yaw_range)
+                    yaw = sampler.sample_yaw(yaw_range=yaw_range)
                     body_pose_surface = Pose(Point(z=z + z_offset), Euler(yaw=yaw))
                     body_pose_world = multiply(world_from_surface, body_pose_surface)
                 elif learned:
-                    if not learned_poses:
+                    if not len(learned_rows):
                         return
-                    surface_pose_world = get_surface_reference_pose(surface_body, surface_name)
-                    sampled_pose_surface = multiply(surface_pose_world, random.choice(learned_poses))
-                    [x, y, _] = point_from_pose(sampled_pose_surface)
-                    _, _, yaw = euler_from_quat(quat_from_pose(sampled_pose_surface))
+                    # Learned placements in regions that keep failing are chosen less often
+                    [x, y, _] = learned_points[sampler.sample_index(surface_aabb, learned_points)]
                     dx, dy = np.random.normal(scale=pos_scale, size=2) if pos_scale else np.zeros(2)
                     # TODO: avoid reloading
-                    z = stable_z_on_aabb(obj_body, surface_aabb)
-                    yaw = random.uniform(*yaw_range)
+                    yaw = sampler.sample_yaw(yaw_range=yaw_range)
                     #yaw = wrap_angle(yaw + np.random.normal(scale=rot_scale))
-                    quat = quat_from_euler(Euler(yaw=yaw))
-                    body_pose_world = ([x+dx, y+dy, z+z_offset], quat)
+                    body_pose_world = sampler.get_pose(surface_aabb, x+dx, y+dy, yaw, z_offset=z_offset)
                     # TODO: project onto the surface
                 else:
-                    # TODO: halton sequence
-                    # unit_generator(d, use_halton=True)
-                    body_pose_world = sample_placement_on_aabb(obj_body, surface_aabb,
-                                                               epsilon=z_offset, percent=2.0)
-                    if body_pose_world is None:
-                        continue # return?
+                    body_pose_world = sampler.sample(surface_aabb, z_offset=z_offset, yaw_range=yaw_range)
                 if visibility and not is_visible_by_camera(world, point_from_pose(body_pose_world)):
+                    sampler.record(surface_aabb, point_from_pose(body_pose_world), success=False)
                     continue
                 # TODO: make sure the surface is open when doing this
 
-                robust = True
-                if robust_radius != 0.:
-                    for theta in np.linspace(0, 5 * np.pi, num=8):
-                        x, y = robust_radius*unit_from_theta(theta)
-                        delta_body = Pose(Point(x, y))
-                        delta_world = multiply(body_pose_world, delta_body)
-                        set_pose(obj_body, delta_world)
-                        if not test_supported(world, obj_body, surface_name, collisions=collisions):
-                            robust = False
-                            break
-
                 set_pose(obj_body, body_pose_world)
-                if robust and test_supported(world, obj_body, surface_name, collisions=collisions):
+                # The nominal pose is cheaper to reject than the perturbation ring
+                success = test_supported(world, obj_body, surface_name, collisions=collisions) and \
+                          ((robust_radius == 0.) or test_robust_supported(
+                              world, obj_body, surface_name, robust_radius, collisions=collisions))
+                sampler.record(surface_aabb, point_from_pose(body_pose_world), success)
+                if success:
                     rp = create_relative_pose(world, obj_name, surface_name)
                     yield (rp,)
                     break
@@ -462,20 +455,9 @@ def get_grasp_gen(world, collisions=False, randomize=True, **kwargs): # teleport
 ################################################################################
 
 def is_robot_visible(world, links):
-    for link in links:
-        link_point = point_from_pose(get_link_pose(world.robot, link))
-        visible = False
-        for camera_body, camera_matrix, camera_depth in world.cameras.values():
-            camera_pose = get_pose(camera_body)
-            #camera_point = point_from_pose(camera_pose)
-            #add_line(link_point, camera_point)
-            if is_visible_point(camera_matrix, camera_depth, link_point, camera_pose):
-                visible = True
-                break
-        if not visible:
-            return False
+    link_points = [point_from_pose(get_link_pose(world.robot, link)) for link in links]
     #wait_for_user()
-    return True
+    return bool(np.all(world.are_visible(link_points)))
 
 def test_base_conf(world, bq, obstacles, min_distance=0.0):
     robot_links = [world.franka_link, world.gripper_link] if world.is_real() else []
@@ -483,26 +465,27 @@ def test_base_conf(world, bq, obstacles, min_distance=0.0):
     for conf in world.special_confs:
         # Could even sample a special visible conf for this base_conf
         conf.assign()
-        if not is_robot_visible(world, robot_links) or any(pairwise_collision(
-                world.robot, b, max_distance=min_distance) for b in obstacles):
+        if not is_robot_visible(world, robot_links) or world.any_collision(
+                world.robot, obstacles, max_distance=min_distance):
             return False
     return True
 
-def inverse_reachability(world, base_generator, obstacles=set(),
-                         max_attempts=25, **kwargs):
+def inverse_reachability(world, base_generator, obstacles=set(), max_attempts=25,
+                         tool_pose=None, score_fn=None, top_k=TOP_K, statistics=None, **kwargs):
+    # Each batch of max_attempts draws is filtered and ranked before the survivors are tested one at a time
+    # Unlike one draw per next(), a batch yields up to top_k confs, best first, and None only if none survives
     min_distance = 0.01 #if world.is_real() else 0.0
     min_nearby_distance = 0.1 # if world.is_real() else 0.0
-    lower_limits, upper_limits = get_custom_limits(
-        world.robot, world.base_joints, world.custom_limits)
     while True:
-        attempt = 0
-        for base_conf in islice(base_generator, max_attempts):
-            attempt += 1
-            if not all_between(lower_limits, base_conf, upper_limits):
-                continue
-            bq = FConf(world.robot, world.base_joints, base_conf)
+        batch = list(islice(base_generator, max_attempts))
+        candidates = filter_base_candidates(world, batch, obstacles, tool_pose=tool_pose, score_fn=score_fn,
+                                            top_k=top_k, statistics=statistics)
+        num_accepted = 0
+        for base_conf in candidates:
+            bq = FConf(world.robot, world.base_joints, tuple(base_conf.tolist()))
             #wait_for_user()
             if not test_base_conf(world, bq, obstacles, min_distance=min_distance):
+                if statistics is not None: statistics.reject('collision')
                 continue
             if world.is_real():
                 # TODO: could also rotate in place
@@ -510,15 +493,17 @@ def inverse_reachability(world, base_generator, obstacles=set(),
                 nearby_values = translate_linearly(world, distance=-REVERSE_DISTANCE)
                 bq.nearby_bq = FConf(world.robot, world.base_joints, nearby_values)
                 if not test_base_conf(world, bq.nearby_bq, obstacles, min_distance=min_nearby_distance):
+                    if statistics is not None: statistics.reject('collision')
                     continue
             #if PRINT_FAILURES: print('Success after {} IR attempts:'.format(attempt))
+            if statistics is not None: statistics.num_accepted += 1
+            num_accepted += 1
             bq.assign()
             #wait_for_user()
             yield bq
-            break
-        else:
-            if PRINT_FAILURES: print('Failed after {} IR attempts:'.format(attempt))
-            if attempt < max_attempts - 1:
+        if not num_accepted:
+            if PRINT_FAILURES: print('Failed after {} IR attempts:'.format(len(batch)))
+            if len(batch) < max_attempts - 1:
                 return
             yield None
 
@@ -542,7 +527,7 @@ def plan_approach(world, approach_pose, attachments=[], obstacles=set(),
     moving_links = get_moving_links(world.robot, world.arm_joints)
     robot_obstacle = (world.robot, frozenset(moving_links))
     #robot_obstacle = world.robot
-    if any(pairwise_collision(robot_obstacle, b) for b in obstacles): # TODO: | {obj}
+    if world.any_collision(robot_obstacle, obstacles): # TODO: | {obj}
         if PRINT_FAILURES: print('Pregrasp collision failure')
         return None
     approach_conf = get_joint_positions(world.robot, world.arm_joints)
@@ -567,49 +552,65 @@ def plan_approach(world, approach_pose, attachments=[], obstacles=set(),
     # TODO: plan one with attachment placed and one held
     # TODO: can still use this as a witness that the conf is reachable
     aq.assign()
-    approach_path = plan_joint_motion(world.robot, world.arm_joints, approach_conf,
-                                      attachments=attachments,
-                                      obstacles=obstacles,
-                                      self_collisions=SELF_COLLISIONS,
-                                      disabled_collisions=world.disabled_collisions,
-                                      custom_limits=world.custom_limits, resolutions=resolutions,
-                                      restarts=2, iterations=25, smooth=25)
+    # Most approaches start from the carry conf, so the arm roadmap of this base conf is usually warm
+    roadmap = get_arm_roadmap(world, resolutions, self_collisions=SELF_COLLISIONS)
+    approach_path = plan_roadmap_motion(world, roadmap, approach_conf, obstacles, attachments,
+                                        other_joints=world.gripper_joints)
+    if approach_path is None:
+        approach_path = plan_joint_motion(world.robot, world.arm_joints, approach_conf,
+                                          attachments=attachments,
+                                          obstacles=obstacles,
+                                          self_collisions=SELF_COLLISIONS,
+                                          disabled_collisions=world.disabled_collisions,
+                                          custom_limits=world.custom_limits, resolutions=resolutions,
+                                          restarts=2, iterations=25, smooth=25)
+        if approach_path is not None:
+            roadmap.add_path(approach_path)
     if approach_path is None:
         if PRINT_FAILURES: print('Approach path failure')
         return None
     return approach_path + grasp_path
 
-def plan_workspace(world, tool_path, obstacles, randomize=True, teleport=False):
+def get_workspace_test(world, obstacles, teleport=False):
     # Assuming that pairs of fixed things aren't in collision at this point
     moving_links = get_moving_links(world.robot, world.arm_joints)
     robot_obstacle = (world.robot, frozenset(moving_links))
     distance_fn = get_distance_fn(world.robot, world.arm_joints)
-    if randomize:
-        sample_fn = get_sample_fn(world.robot, world.arm_joints)
-        set_joint_positions(world.robot, world.arm_joints, sample_fn())
-    else:
-        world.carry_conf.assign()
-    arm_path = []
-    for i, tool_pose in enumerate(tool_path):
-        #set_joint_positions(world.kitchen, [door_joint], door_path[i])
-        tolerance = INF if i == 0 else NEARBY_PULL
-        full_arm_conf = world.solve_inverse_kinematics(tool_pose, nearby_tolerance=tolerance)
-        if full_arm_conf is None:
-            # TODO: this fails when teleport=True
-            if PRINT_FAILURES: print('Workspace kinematic failure')
-            return None
-        if any(pairwise_collision(robot_obstacle, b) for b in obstacles):
+    def test(arm_path):
+        if world.any_collision(robot_obstacle, obstacles):
             if PRINT_FAILURES: print('Workspace collision failure')
-            return None
-        arm_conf = get_joint_positions(world.robot, world.arm_joints)
-        if arm_path and not teleport:
-            distance = distance_fn(arm_path[-1], arm_conf)
+            return False
+        if (2 <= len(arm_path)) and not teleport:
+            distance = distance_fn(arm_path[-2], arm_path[-1])
             if MAX_CONF_DISTANCE < distance:
                 if PRINT_FAILURES: print('Workspace proximity failure (distance={:.5f})'.format(distance))
-                return None
-        arm_path.append(arm_conf)
-        # wait_for_user()
-    return arm_path
+                return False
+        return True
+    return test
+
+def get_workspace_start_fn(world, randomize=True):
+    sample_fn = get_sample_fn(world.robot, world.arm_joints)
+    def start_fn():
+        if randomize:
+            set_joint_positions(world.robot, world.arm_joints, sample_fn())
+        else:
+            world.carry_conf.assign()
+    return start_fn
+
+def plan_workspaces(world, tool_paths, obstacles, randomize=True, teleport=False, **kwargs):
+    # Generates (tool_path, arm_path) for the candidate tool paths that succeed
+    # A randomized first conf asks the solver for a new solution rather than a cached one
+    return world.solve_inverse_kinematics_paths(
+        tool_paths, start_fn=get_workspace_start_fn(world, randomize=randomize),
+        nearby_tolerance=NEARBY_PULL, initial_tolerance=INF, initial_cache=not randomize,
+        test_fn=get_workspace_test(world, obstacles, teleport=teleport), **kwargs)
+
+def plan_workspace(world, tool_path, obstacles, randomize=True, teleport=False):
+    for _, arm_path in plan_workspaces(world, [tool_path], obstacles, randomize=randomize, teleport=teleport):
+        return arm_path
+    # TODO: this fails when teleport=True
+    if PRINT_FAILURES: print('Workspace plan failure')
+    return None
 
 ################################################################################
 
@@ -639,50 +640,76 @@ def get_handle_grasps(world, joint, pull=True, pre_distance=APPROACH_DISTANCE):
                 grasps.append(HandleGrasp(link, handle_grasp, handle_pregrasp))
     return grasps
 
-def compute_door_paths(world, joint_name, door_conf1, door_conf2, obstacles=set(), teleport=False):
-    door_paths = []
-    if door_conf1 == door_conf2:
-        return door_paths
+def compute_door_motions(world, joint_name, door_values1, door_values2, teleport=False):
+    # Door paths for every handle grasp before any collision checking
     door_joint = joint_from_name(world.kitchen, joint_name)
     door_joints = [door_joint]
+    key = get_motion_key(world, door_joint, door_values1, door_values2, teleport=teleport)
+    door_motions = world.door_cache.motions.get(key)
+    if door_motions is not None:
+        return door_motions
     # TODO: could unify with grasp path
     door_extend_fn = get_extend_fn(world.kitchen, door_joints, resolutions=[DOOR_RESOLUTION])
-    door_path = [door_conf1.values] + list(door_extend_fn(door_conf1.values, door_conf2.values))
+    door_path = [door_values1] + list(door_extend_fn(door_values1, door_values2))
     if teleport:
-        door_path = [door_conf1.values, door_conf2.values]
+        door_path = [door_values1, door_values2]
     # TODO: open until collision for the drawers
 
     sign = world.get_door_sign(door_joint)
     pull = (sign*door_path[0][0] < sign*door_path[-1][0])
-    # door_obstacles = get_descendant_obstacles(world.kitchen, door_joint)
-    for handle_grasp in get_handle_grasps(world, door_joint, pull=pull):
-        link, grasp, pregrasp = handle_grasp
-        handle_path = []
-        for door_conf in door_path:
-            set_joint_positions(world.kitchen, door_joints, door_conf)
-            # if any(pairwise_collision(door_obst, obst)
-            #       for door_obst, obst in product(door_obstacles, obstacles)):
-            #    return
-            handle_path.append(get_link_pose(world.kitchen, link))
-            # Collide due to adjacency
+    door_motions = []
+    with BodySaver(world.kitchen):
+        set_configuration(world.gripper, world.open_gq.values)
+        for handle_grasp in get_handle_grasps(world, door_joint, pull=pull):
+            link, grasp, pregrasp = handle_grasp
+            handle_path = []
+            lowers, uppers = [], []
+            for door_conf in door_path:
+                set_joint_positions(world.kitchen, door_joints, door_conf)
+                handle_path.append(get_link_pose(world.kitchen, link))
+                # Collide due to adjacency
+                set_tool_pose(world, multiply(handle_path[-1], invert(grasp)))
+                lower, upper = get_obstacle_aabb(world.gripper)
+                lowers.append(lower)
+                uppers.append(upper)
+            # TODO: check pregrasp path as well
+            # TODO: check gripper self-collisions with the robot
+            tool_path = [multiply(handle_pose, invert(grasp)) for handle_pose in handle_path]
+            door_plan = DoorPath(door_path, handle_path, handle_grasp, tool_path)
+            door_motions.append(DoorMotion(door_plan, lowers, uppers))
+    return world.door_cache.motions.set(key, door_motions)
 
-        # TODO: check pregrasp path as well
-        # TODO: check gripper self-collisions with the robot
+def compute_door_paths(world, joint_name, door_conf1, door_conf2, obstacles=set(), teleport=False):
+    door_paths = []
+    if door_conf1 == door_conf2:
+        return door_paths
+    door_joint = joint_from_name(world.kitchen, joint_name)
+    door_joints = [door_joint]
+    obstacles = list(obstacles)
+    # door_obstacles = get_descendant_obstacles(world.kitchen, door_joint)
+    with BodySaver(world.kitchen):
         set_configuration(world.gripper, world.open_gq.values)
-        tool_path = [multiply(handle_pose, invert(grasp))
-                     for handle_pose in handle_path]
-        for i, tool_pose in enumerate(tool_path):
-            set_joint_positions(world.kitchen, door_joints, door_path[i])
-            set_tool_pose(world, tool_pose)
-            # handles = draw_pose(handle_path[i], length=0.25)
-            # handles.extend(draw_aabb(get_aabb(world.kitchen, link=link)))
-            # wait_for_user()
-            # for handle in handles:
-            #    remove_debug(handle)
-            if any(pairwise_collision(world.gripper, obst) for obst in obstacles):
-                break
-        else:
-            door_paths.append(DoorPath(door_path, handle_path, handle_grasp, tool_path))
+        for door_motion in compute_door_motions(world, joint_name, door_conf1.values, door_conf2.values,
+                                                teleport=teleport):
+            door_path, _, _, tool_path = door_motion.door_plan
+            world.door_cache.num_tests += 1
+            indices = get_nearby_waypoints(world, door_motion, door_joint, obstacles)
+            if indices is None:
+                indices = range(len(tool_path))
+            elif not indices:
+                world.door_cache.num_skipped += 1
+            for i in indices:
+                set_joint_positions(world.kitchen, door_joints, door_path[i])
+                set_tool_pose(world, tool_path[i])
+                # handles = draw_pose(handle_path[i], length=0.25)
+                # handles.extend(draw_aabb(get_aabb(world.kitchen, link=link)))
+                # wait_for_user()
+                # for handle in handles:
+                #    remove_debug(handle)
+                if world.any_collision(world.gripper, obstacles):
+                    break
+            else:
+                door_paths.append(door_motion.door_plan)
     return door_paths
 
 ################################################################################
@@ -752,7 +779,7 @@ def get_cfree_relpose_relpose_test(world, collisions=True, **kwargs):
         rp1.assign()
         rp2.assign()
         return not pairwise_collision(world.get_body(o1), world.get_body(o2))
-    return test
+    return cache_collision_test(world, 'test-cfree-pose-pose', test) if collisions else test
 
 def get_cfree_worldpose_test(world, collisions=True, **kwargs):
     def test(o1, wp1):
@@ -763,10 +790,10 @@ def get_cfree_worldpose_test(world, collisions=True, **kwargs):
         body = world.get_body(o1)
         wp1.assign()
         obstacles = world.static_obstacles
-        if any(pairwise_collision(body, obst) for obst in obstacles):
+        if world.any_collision(body, obstacles):
             return False
         return True
-    return test
+    return cache_collision_test(world, 'test-cfree-worldpose', test) if collisions else test
 
 def get_cfree_worldpose_worldpose_test(world, collisions=True, **kwargs):
     def test(o1, wp1, o2, wp2):
@@ -777,10 +804,10 @@ def get_cfree_worldpose_worldpose_test(world, collisions=True, **kwargs):
         body = world.get_body(o1)
         wp1.assign()
         wp2.assign()
-        if any(pairwise_collision(body, obst) for obst in get_surface_obstacles(world, o2)):
+        if world.any_collision(body, get_surface_obstacles(world, o2)):
             return False
         return True
-    return test
+    return cache_collision_test(world, 'test-cfree-worldpose-worldpose', test) if collisions else test
 
 def get_cfree_bconf_pose_test(world, collisions=True, **kwargs):
     def test(bq, o2, wp2):
@@ -792,8 +819,8 @@ def get_cfree_bconf_pose_test(world, collisions=True, **kwargs):
         world.carry_conf.assign()
         wp2.assign()
         obstacles = get_link_obstacles(world, o2)
-        return not any(pairwise_collision(world.robot, obst) for obst in obstacles)
-    return test
+        return not world.any_collision(world.robot, obstacles)
+    return cache_collision_test(world, 'test-cfree-bconf-pose', test) if collisions else test
 
 def get_cfree_approach_pose_test(world, collisions=True, **kwargs):
     def test(o1, wp1, g1, o2, wp2):
@@ -809,14 +836,13 @@ def get_cfree_approach_pose_test(world, collisions=True, **kwargs):
         if not obstacles:
             return True
         for _ in iterate_approach_path(world, wp1, g1, body=body):
-            if any(pairwise_collision(part, obst) for part in
-                   [world.gripper, body] for obst in obstacles):
+            if any(world.any_collision(part, obstacles) for part in [world.gripper, body]):
                 # TODO: some collisions the bottom drawer and the top drawer handle
                 #print(o1, wp1.support, o2, wp2.support)
                 #wait_for_user()
                 return False
         return True
-    return test
+    return cache_collision_test(world, 'test-cfree-approach-pose', test) if collisions else test
 
 def get_cfree_angle_angle_test(world, collisions=True, **kwargs):
     def test(j1, a1, a2, o2, wp):
@@ -835,10 +861,18 @@ def get_cfree_angle_angle_test(world, collisions=True, **kwargs):
         #        wait_for_user()
         #    set_renderer(enable=False)
         return status
-    return test
+    return cache_collision_test(world, 'test-cfree-angle-angle', test) if collisions else test
 
 ################################################################################
 
+def is_carried(world, state, name):
+    body = world.get_body(name)
+    while body in state.attachments:
+        body = state.attachments[body].parent
+        if body == world.robot:
+            return True
+    return False
+
 def get_cfree_traj_pose_test(world, collisions=True, **kwargs):
     def test(at, o, wp):
         if not collisions:
@@ -862,15 +896,20 @@ def get_cfree_traj_pose_test(world, collisions=True, **kwargs):
                 surface_name = get_link_name(world.kitchen, child_link_from_joint(door_joint))
                 if wp.support == surface_name:
                     return True
+            if isinstance(command, (Trajectory, DoorTrajectory)) and not is_carried(world, state, o):
+                # Only the moving links are checked at the waypoints where their swept bounds overlap
+                if command_collision(command, obstacles):
+                    return False
+                state.derive()
+                continue
             for _ in command.iterate(state):
                 state.derive()
                 #for attachment in state.attachments.values():
                 #    if any(pairwise_collision(attachment.child, obst) for obst in obstacles):
                 #        return False
-                # TODO: just check collisions with moving links
-                if any(pairwise_collision(world.robot, obst) for obst in obstacles):
+                if world.any_collision(world.robot, obstacles):
                     #print(at, o, p)
                     #wait_for_user()
                     return False
         return True
-    return test
+    return cache_collision_test(world, 'test-cfree-traj-pose', test) if collisions else test
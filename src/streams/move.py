@@ -4,6 +4,7 @@ from pybullet_tools.utils import BodySaver, plan_nonholonomic_motion, set_render
     get_extend_fn, child_link_from_joint
 from src.command import Sequence, State, Trajectory
 from src.inference import SurfaceDist
+from src.roadmap import get_base_roadmap, get_arm_roadmap, plan_roadmap_motion
 from src.stream import ARM_RESOLUTION, SELF_COLLISIONS, GRIPPER_RESOLUTION
 from src.utils import get_link_obstacles, FConf, get_descendant_obstacles
 
@@ -65,8 +66,8 @@ def parse_fluents(world, fluents):
 # TODO: more efficient collision checking
 
 def get_base_motion_fn(world, teleport_base=False, collisions=True, teleport=False,
-                       restarts=4, iterations=75, smooth=100):
-    # TODO: lazy planning on a common base roadmap
+                       restarts=4, iterations=75, smooth=100, use_roadmap=True):
+    # Queries the shared base roadmap first and falls back to (and seeds it with) a bidirectional RRT
 
     def fn(bq1, bq2, aq, fluents=[]):
         #if bq1 == bq2:
@@ -102,11 +103,19 @@ def get_base_motion_fn(world, teleport_base=False, collisions=True, teleport=Fal
         if (bq1 == bq2) or teleport_base or teleport:
             path = [bq1.values, bq2.values]
         else:
-            # It's important that the extend function is reversible to avoid getting trapped
-            path = plan_nonholonomic_motion(world.robot, bq2.joints, bq2.values, attachments=attachments,
-                                            obstacles=obstacles, custom_limits=world.custom_limits,
-                                            reversible=True, self_collisions=False,
-                                            restarts=restarts, iterations=iterations, smooth=smooth)
+            path = None
+            if use_roadmap:
+                roadmap = get_base_roadmap(world)
+                path = plan_roadmap_motion(world, roadmap, bq2.values, obstacles, attachments,
+                                           other_joints=world.arm_joints + world.gripper_joints)
+            if path is None:
+                # It's important that the extend function is reversible to avoid getting trapped
+                path = plan_nonholonomic_motion(world.robot, bq2.joints, bq2.values, attachments=attachments,
+                                                obstacles=obstacles, custom_limits=world.custom_limits,
+                                                reversible=True, self_collisions=False,
+                                                restarts=restarts, iterations=iterations, smooth=smooth)
+                if use_roadmap and (path is not None):
+                    roadmap.add_path(path)
             if path is None:
                 print('Failed to find an arm motion plan for {}->{}'.format(bq1, bq2))
                 if PAUSE_MOTION_FAILURES:
@@ -138,7 +147,8 @@ def get_reachability_test(world, **kwargs):
     return test
 
 
-def get_arm_motion_gen(world, collisions=True, teleport=False):
+def get_arm_motion_gen(world, collisions=True, teleport=False, use_roadmap=True):
+    # Queries the arm roadmap of the base conf first and falls back to (and seeds it with) a bidirectional RRT
     resolutions = ARM_RESOLUTION * np.ones(len(world.arm_joints))
 
     def fn(bq, aq1, aq2, fluents=[]):
@@ -154,12 +164,20 @@ def get_arm_motion_gen(world, collisions=True, teleport=False):
         if teleport:
             path = [aq1.values, aq2.values]
         else:
-            path = plan_joint_motion(world.robot, aq2.joints, aq2.values,
-                                     attachments=attachments, obstacles=obstacles,
-                                     self_collisions=SELF_COLLISIONS,
-                                     disabled_collisions=world.disabled_collisions,
-                                     custom_limits=world.custom_limits, resolutions=resolutions,
-                                     restarts=2, iterations=50, smooth=50)
+            path = None
+            if use_roadmap:
+                roadmap = get_arm_roadmap(world, resolutions, self_collisions=SELF_COLLISIONS)
+                path = plan_roadmap_motion(world, roadmap, aq2.values, obstacles, attachments,
+                                           other_joints=world.gripper_joints)
+            if path is None:
+                path = plan_joint_motion(world.robot, aq2.joints, aq2.values,
+                                         attachments=attachments, obstacles=obstacles,
+                                         self_collisions=SELF_COLLISIONS,
+                                         disabled_collisions=world.disabled_collisions,
+                                         custom_limits=world.custom_limits, resolutions=resolutions,
+                                         restarts=2, iterations=50, smooth=50)
+                if use_roadmap and (path is not None):
+                    roadmap.add_path(path)
             if path is None:
                 print('Failed to find an arm motion plan for {}->{}'.format(aq1, aq2))
                 if PAUSE_MOTION_FAILURES:
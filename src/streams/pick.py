@@ -4,7 +4,10 @@ from itertools import cycle
 from pybullet_tools.utils import BodySaver, get_sample_fn, set_joint_positions, multiply, invert, get_moving_links, \
     pairwise_collision, uniform_pose_generator, get_movable_joints, wait_for_user, INF
 from src.command import Sequence, State, ApproachTrajectory, Detach, AttachGripper
+from src.candidates import get_candidate_statistics
 from src.database import load_place_base_poses
+from src.ik import MIN_RANDOM_SOLUTIONS, SEED_NOISE
+from src.reachability import load_place_weights, get_place_score_fn
 from src.stream import PRINT_FAILURES, plan_approach, MOVE_ARM, P_RANDOMIZE_IK, inverse_reachability, FIXED_FAILURES
 from src.streams.move import get_gripper_motion_gen
 from src.utils import FConf, create_surface_attachment, get_surface_obstacles, iterate_approach_path
@@ -19,8 +22,7 @@ def is_approach_safe(world, obj_name, pose, grasp, obstacles):
         #for link in get_all_links(world.gripper):
         #    set_color(world.gripper, apply_alpha(np.zeros(3)), link)
         #wait_for_user()
-        if any(pairwise_collision(world.gripper, obst) # or pairwise_collision(obj_body, obst)
-               for obst in obstacles):
+        if world.any_collision(world.gripper, obstacles): # or pairwise_collision(obj_body, obst)
             print('Unsafe approach!')
             #wait_for_user()
             return False
@@ -44,7 +46,8 @@ def plan_pick(world, obj_name, pose, grasp, base_conf, obstacles, randomize=True
         world.carry_conf.assign()
     world_from_body = pose.get_world_from_body()
     gripper_pose = multiply(world_from_body, invert(grasp.grasp_pose))  # w_f_g = w_f_o * (g_f_o)^-1
-    full_grasp_conf = world.solve_inverse_kinematics(gripper_pose)
+    full_grasp_conf = world.solve_inverse_kinematics(
+        gripper_pose, min_solutions=MIN_RANDOM_SOLUTIONS if randomize else 1, seed_noise=SEED_NOISE if randomize else 0.)
     if full_grasp_conf is None:
         if PRINT_FAILURES: print('Grasp kinematic failure')
         return
@@ -52,7 +55,7 @@ def plan_pick(world, obj_name, pose, grasp, base_conf, obstacles, randomize=True
     robot_obstacle = (world.robot, frozenset(moving_links))
     #robot_obstacle = get_descendant_obstacles(world.robot, child_link_from_joint(world.arm_joints[0]))
     #robot_obstacle = world.robot
-    if any(pairwise_collision(robot_obstacle, b) for b in obstacles):
+    if world.any_collision(robot_obstacle, obstacles):
         if PRINT_FAILURES: print('Grasp collision failure')
         #set_renderer(enable=True)
         #wait_for_user()
@@ -94,7 +97,6 @@ def get_fixed_pick_gen_fn(world, max_attempts=25, collisions=True, **kwargs):
         if not is_approach_safe(world, obj_name, pose, grasp, obstacles):
             return
         # TODO: increase timeouts if a previously successful value
-        # TODO: seed IK using the previous solution
         max_failures = FIXED_FAILURES if world.task.movable_base else INF
         failures = 0
         while failures <= max_failures:
@@ -115,8 +117,9 @@ def get_fixed_pick_gen_fn(world, max_attempts=25, collisions=True, **kwargs):
     return gen
 
 
-def get_pick_gen_fn(world, max_attempts=25, collisions=True, learned=True, **kwargs):
+def get_pick_gen_fn(world, max_attempts=25, collisions=True, learned=True, failure_fn=None, **kwargs):
     # TODO: sample in the neighborhood of the base conf to ensure robust
+    # failure_fn(base_conf, tool_pose) is called for each base conf where plan_pick fails
 
     def gen(obj_name, pose, grasp, *args):
         obstacles = world.static_obstacles | get_surface_obstacles(world, pose.support)
@@ -127,11 +130,17 @@ def get_pick_gen_fn(world, max_attempts=25, collisions=True, learned=True, **kwa
 
         # TODO: check collisions with obj at pose
         gripper_pose = multiply(pose.get_world_from_body(), invert(grasp.grasp_pose)) # w_f_g = w_f_o * (g_f_o)^-1
+        score_fn = None
         if learned:
-            base_generator = cycle(load_place_base_poses(world, gripper_pose, pose.support, grasp.grasp_type))
+            weights = load_place_weights(world, pose.support, grasp.grasp_type)
+            base_generator = cycle(load_place_base_poses(world, gripper_pose, pose.support, grasp.grasp_type,
+                                                         weights=weights))
+            score_fn = get_place_score_fn(world, gripper_pose, pose.support, grasp.grasp_type)
         else:
             base_generator = uniform_pose_generator(world.robot, gripper_pose)
-        safe_base_generator = inverse_reachability(world, base_generator, obstacles=obstacles, **kwargs)
+        statistics = get_candidate_statistics(world, 'plan-pick')
+        safe_base_generator = inverse_reachability(world, base_generator, obstacles=obstacles, tool_pose=gripper_pose,
+                                                   score_fn=score_fn, statistics=statistics, **kwargs)
         while True:
             for i in range(max_attempts):
                 try:
@@ -144,7 +153,11 @@ def get_pick_gen_fn(world, max_attempts=25, collisions=True, learned=True, **kwa
                 randomize = (random.random() < P_RANDOMIZE_IK)
                 ik_outputs = next(plan_pick(world, obj_name, pose, grasp, base_conf, obstacles,
                                             randomize=randomize, **kwargs), None)
-                if ik_outputs is not None:
+                if ik_outputs is None:
+                    statistics.reject('plan')
+                    if failure_fn is not None:
+                        failure_fn(base_conf, gripper_pose)
+                else:
                     print('Pick succeeded after {} attempts'.format(i))
                     yield (base_conf,) + ik_outputs
                     break
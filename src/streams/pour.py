@@ -9,8 +9,9 @@ from pybullet_tools.utils import approximate_as_cylinder, approximate_as_prism,
 from pybullet_tools.pr2_utils import get_top_grasps
 from src.database import load_place_base_poses, load_inverse_placements, project_base_pose, load_pour_base_poses
 from src.stream import plan_approach, MOVE_ARM, inverse_reachability, P_RANDOMIZE_IK, PRINT_FAILURES
+from src.reachability import load_pour_weights
 from src.command import Sequence, ApproachTrajectory, State, Wait
-from src.stream import MOVE_ARM, plan_workspace
+from src.stream import MOVE_ARM, plan_workspaces
 from src.utils import FConf, type_from_name, MUSTARD, TOP_GRASP, TOOL_POSE, set_tool_pose
 
 Z_OFFSET = 0.03
@@ -88,26 +89,27 @@ def get_fixed_pour_gen_fn(world, max_attempts=50, collisions=True, teleport=Fals
         #cup_body = world.get_body(cup_name)
         obstacles = (world.static_obstacles | {bowl_body}) if collisions else set()
         cup_path_bowl = pour_path_from_parameter(world, bowl_name, cup_name)
+
+        def sample_tool_path():
+            bowl_pose = wp.get_world_from_body()
+            rotate_bowl = Pose(euler=Euler(yaw=random.uniform(-np.pi, np.pi)))
+            rotate_cup = Pose(euler=Euler(yaw=random.uniform(-np.pi, np.pi)))
+            cup_path = [multiply(bowl_pose, invert(rotate_bowl), cup_pose_bowl, rotate_cup)
+                        for cup_pose_bowl in cup_path_bowl]
+            #visualize_cartesian_path(cup_body, cup_path)
+            #if cartesian_path_collision(cup_body, cup_path, obstacles + [bowl_body]):
+            #    continue
+            # TODO: extra collision test for visibility
+            # TODO: orientation constraint while moving
+            return [multiply(p, invert(grasp.grasp_pose)) for p in cup_path]
+
         while True:
-            for _ in range(max_attempts):
-                bowl_pose = wp.get_world_from_body()
-                rotate_bowl = Pose(euler=Euler(yaw=random.uniform(-np.pi, np.pi)))
-                rotate_cup = Pose(euler=Euler(yaw=random.uniform(-np.pi, np.pi)))
-                cup_path = [multiply(bowl_pose, invert(rotate_bowl), cup_pose_bowl, rotate_cup)
-                            for cup_pose_bowl in cup_path_bowl]
-                #visualize_cartesian_path(cup_body, cup_path)
-                #if cartesian_path_collision(cup_body, cup_path, obstacles + [bowl_body]):
-                #    continue
-                tool_path = [multiply(p, invert(grasp.grasp_pose)) for p in cup_path]
-                # TODO: extra collision test for visibility
-                # TODO: orientation constraint while moving
-
-                bq.assign()
-                grasp.set_gripper()
-                world.carry_conf.assign()
-                arm_path = plan_workspace(world, tool_path, obstacles, randomize=True) # tilt to upright
-                if arm_path is None:
-                    continue
+            bq.assign()
+            grasp.set_gripper()
+            world.carry_conf.assign()
+            tool_paths = [sample_tool_path() for _ in range(max_attempts)]
+            # Candidates are solved from their final pose, so those out of reach fail on the first solve
+            for tool_path, arm_path in plan_workspaces(world, tool_paths, obstacles, randomize=True): # tilt to upright
                 assert MOVE_ARM
                 aq = FConf(world.robot, world.arm_joints, arm_path[-1])
                 robot_saver = BodySaver(world.robot)
@@ -142,7 +144,8 @@ def get_pour_gen_fn(world, max_attempts=50, learned=True, **kwargs):
             #gripper_pose = multiply(bowl_pose, invert(grasp_pose))  # w_f_g = w_f_o * (g_f_o)^-1
             #set_tool_pose(world, gripper_pose)
             #base_generator = cycle(load_place_base_poses(world, gripper_pose, pose.support, TOP_GRASP))
-            base_generator = cycle(load_pour_base_poses(world, pose.support))
+            weights = load_pour_weights(world, pose.support)
+            base_generator = cycle(load_pour_base_poses(world, pose.support, weights=weights))
         else:
             base_generator = uniform_pose_generator(world.robot, bowl_pose)
         safe_base_generator = inverse_reachability(world, base_generator, obstacles=obstacles, **kwargs)
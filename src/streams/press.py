@@ -6,6 +6,7 @@ from pybullet_tools.utils import BodySaver, get_sample_fn, set_joint_positions,
     pairwise_collision, link_from_name, get_unit_vector, unit_point, Pose, get_link_pose, \
     uniform_pose_generator, INF
 from src.command import Sequence, State, ApproachTrajectory, Wait
+from src.ik import MIN_RANDOM_SOLUTIONS, SEED_NOISE
 from src.stream import plan_approach, MOVE_ARM, inverse_reachability, P_RANDOMIZE_IK, PRINT_FAILURES, FIXED_FAILURES
 from src.utils import FConf, APPROACH_DISTANCE, TOOL_POSE, FINGER_EXTENT, Grasp, TOP_GRASP
 from src.database import load_pull_base_poses
@@ -34,13 +35,14 @@ def plan_press(world, knob_name, pose, grasp, base_conf, obstacles, randomize=Tr
     gripper_pose = multiply(pose, invert(grasp.grasp_pose))  # w_f_g = w_f_o * (g_f_o)^-1
     #set_joint_positions(world.gripper, get_movable_joints(world.gripper), world.closed_gq.values)
     #set_tool_pose(world, gripper_pose)
-    full_grasp_conf = world.solve_inverse_kinematics(gripper_pose)
+    full_grasp_conf = world.solve_inverse_kinematics(
+        gripper_pose, min_solutions=MIN_RANDOM_SOLUTIONS if randomize else 1, seed_noise=SEED_NOISE if randomize else 0.)
     #wait_for_user()
     if full_grasp_conf is None:
         # if PRINT_FAILURES: print('Grasp kinematic failure')
         return
     robot_obstacle = (world.robot, frozenset(get_moving_links(world.robot, world.arm_joints)))
-    if any(pairwise_collision(robot_obstacle, b) for b in obstacles):
+    if world.any_collision(robot_obstacle, obstacles):
         #if PRINT_FAILURES: print('Grasp collision failure')
         return
     approach_pose = multiply(pose, invert(grasp.pregrasp_pose))
@@ -7,8 +7,9 @@ from pybullet_tools.utils import multiply, joint_from_name, set_joint_positions,
 from src.command import ApproachTrajectory, DoorTrajectory, Sequence, State
 from src.database import load_pull_base_poses
 from src.stream import PRINT_FAILURES, plan_workspace, plan_approach, MOVE_ARM, \
-    P_RANDOMIZE_IK, inverse_reachability, compute_door_paths, FIXED_FAILURES
+    P_RANDOMIZE_IK, inverse_reachability, compute_door_paths, get_workspace_test, FIXED_FAILURES
 from src.streams.move import get_gripper_motion_gen
+from src.doors import get_door_key, get_base_bucket, follows_tool_path
 from src.utils import get_descendant_obstacles, FConf
 
 
@@ -19,7 +20,7 @@ def is_pull_safe(world, door_joint, door_plan):
         # TODO: check the whole door trajectory
         set_joint_positions(world.kitchen, [door_joint], door_conf)
         # TODO: just check collisions with the base of the robot
-        if any(pairwise_collision(world.robot, b) for b in obstacles):
+        if world.any_collision(world.robot, obstacles):
             if PRINT_FAILURES: print('Door start/end failure')
             return False
     return True
@@ -40,10 +41,19 @@ def plan_pull(world, door_joint, door_plan, base_conf,
     if not is_pull_safe(world, door_joint, door_plan):
         return
 
-    arm_path = plan_workspace(world, tool_path, world.static_obstacles,
-                              randomize=randomize, teleport=collisions)
+    # Only arm paths of successful pulls are stored because TracIK is stochastic
+    # A stored path is reused from any base conf in the same bucket that it still works for
+    key = get_door_key(door_joint, door_plan) + (get_base_bucket(base_conf.values), collisions)
+    arm_path = world.door_cache.arm_paths.get(key)
+    if (arm_path is not None) and not follows_tool_path(
+            world, tool_path, arm_path, get_workspace_test(world, world.static_obstacles, teleport=collisions)):
+        world.door_cache.num_invalid += 1
+        arm_path = None
     if arm_path is None:
-        return
+        arm_path = plan_workspace(world, tool_path, world.static_obstacles,
+                                  randomize=randomize, teleport=collisions)
+        if arm_path is None:
+            return
     approach_paths = []
     for index in [0, -1]:
         set_joint_positions(world.kitchen, [door_joint], door_path[index])
@@ -83,6 +93,7 @@ def plan_pull(world, door_joint, door_plan, base_conf,
         commands.insert(1, finger_cmd.commands[0])
         commands.insert(3, finger_cmd.commands[0].reverse())
     cmd = Sequence(State(world, savers=[robot_saver]), commands, name='pull')
+    world.door_cache.arm_paths.set(key, arm_path)
     yield (aq1, aq2, cmd,)
 
 ################################################################################
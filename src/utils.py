@@ -17,7 +17,7 @@ from pybullet_tools.utils import joints_from_names, joint_from_name, Attachment,
     get_aabb, get_collision_data, point_from_pose, get_data_pose, get_data_extents, AABB, \
     apply_affine, get_aabb_vertices, aabb_from_points, read_obj, tform_mesh, create_attachment, draw_point, \
     child_link_from_joint, is_placed_on_aabb, pairwise_collision, flatten_links, has_link, get_difference_fn, Euler, approximate_as_prism, \
-    get_joint_positions, implies, unit_from_theta
+    get_joint_positions, implies, unit_from_theta, batch_ray_collision, aabb_union, get_pose
 
 MODELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'models/')
 
@@ -164,6 +164,7 @@ RIGHT_CAMERA = CAMERA_TEMPLATE.format('right')
 CAMERAS = [LEFT_CAMERA, RIGHT_CAMERA]
 
 KINECT_DEPTH = 5.0
+MAX_RAY_BATCH = 16*1024 # pybullet's MAX_RAY_INTERSECTION_BATCH_SIZE_STREAMING
 CAMERA_MATRIX = np.array(
     [[ 532.569,    0.,     320.,   ],
      [   0.,     532.569,  240.,   ],
@@ -396,31 +397,53 @@ class RelPose(object):
             return 'wp{}'.format(id(self) % 1000)
         return 'rp{}'.format(id(self) % 1000)
 
+def get_surface_geometry(world, surface_name):
+    # The collision data and meshes in the link frame are independent of the joint positions
+    if surface_name not in world.surface_geometry:
+        link_name, shape_name, _ = surface_from_name(surface_name)
+        surface_link = link_from_name(world.kitchen, link_name)
+        data, mesh = None, None
+        if shape_name == SURFACE_BOTTOM:
+            data = sorted(get_collision_data(world.kitchen, surface_link),
+                          key=lambda d: point_from_pose(get_data_pose(d))[2])[0]
+        elif shape_name != SURFACE_TOP:
+            [data] = filter(lambda d: d.filename != '',
+                            get_collision_data(world.kitchen, surface_link))
+            meshes = read_obj(data.filename)
+            #colors = spaced_colors(len(meshes))
+            #set_color(surface_body, link=surface_link, color=np.zeros(4))
+            mesh = meshes[shape_name]
+        world.surface_geometry[surface_name] = (surface_link, shape_name, data, mesh)
+    return world.surface_geometry[surface_name]
+
 def compute_surface_aabb(world, surface_name):
+    # Cached on the positions of the kitchen joints that move the surface
+    if surface_name in ENV_SURFACES: # TODO: clean this up
+        key = (surface_name,)
+    else:
+        surface_link, _, _, _ = get_surface_geometry(world, surface_name)
+        key = (surface_name,) + tuple(get_joint_positions(world.kitchen, world.get_link_joints(surface_link)))
+    surface_aabb = world.surface_aabbs.get(key)
+    if surface_aabb is None:
+        surface_aabb = world.surface_aabbs.set(key, compute_surface_aabb_uncached(world, surface_name))
+    return surface_aabb
+
+def compute_surface_aabb_uncached(world, surface_name):
     if surface_name in ENV_SURFACES: # TODO: clean this up
         # TODO: the aabb for golf is off the table
         surface_body = world.environment_bodies[surface_name]
         return get_aabb(surface_body)
     surface_body = world.kitchen
-    surface_name, shape_name, _ = surface_from_name(surface_name)
-    surface_link = link_from_name(surface_body, surface_name)
+    surface_link, shape_name, data, mesh = get_surface_geometry(world, surface_name)
     surface_pose = get_link_pose(surface_body, surface_link)
     if shape_name == SURFACE_TOP:
         surface_aabb = get_aabb(surface_body, surface_link)
     elif shape_name == SURFACE_BOTTOM:
-        data = sorted(get_collision_data(surface_body, surface_link),
-                      key=lambda d: point_from_pose(get_data_pose(d))[2])[0]
         extent = np.array(get_data_extents(data))
         aabb = AABB(-extent/2., +extent/2.)
         vertices = apply_affine(multiply(surface_pose, get_data_pose(data)), get_aabb_vertices(aabb))
         surface_aabb = aabb_from_points(vertices)
     else:
-        [data] = filter(lambda d: d.filename != '',
-                        get_collision_data(surface_body, surface_link))
-        meshes = read_obj(data.filename)
-        #colors = spaced_colors(len(meshes))
-        #set_color(surface_body, link=surface_link, color=np.zeros(4))
-        mesh = meshes[shape_name]
         #for i, (name, mesh) in enumerate(meshes.items()):
         mesh = tform_mesh(multiply(surface_pose, get_data_pose(data)), mesh=mesh)
         surface_aabb = aabb_from_points(mesh.vertices)
@@ -588,8 +611,45 @@ def test_supported(world, body, surface_name, collisions=True):
         obstacles = set()
     #print([get_link_name(obst[0], list(obst[1])[0]) for obst in obstacles
     #       if pairwise_collision(body, obst)])
-    return not any(pairwise_collision(body, obst) for obst in obstacles)
-
+    return not world.any_collision(body, obstacles)
+
+def test_robust_supported(world, body, surface_name, radius, num=8, collisions=True):
+    # Equivalent to test_supported at each pose on a ring of offsets in the body frame
+    # The offsets translate the body AABB, so support is checked for the whole ring at once
+    pose = get_pose(body)
+    thetas = np.linspace(0, 5*np.pi, num=num)
+    offsets_body = np.column_stack([radius*np.cos(thetas), radius*np.sin(thetas), np.zeros(num)])
+    offsets = rotate_points(np.array(pose[1]), offsets_body)
+    lower, upper = map(np.array, get_aabb(body))
+    lowers, uppers = lower + offsets, upper + offsets
+    surface_lower, surface_upper = map(np.array, compute_surface_aabb(world, surface_name))
+    # is_placed_on_aabb with its default epsilons
+    above_epsilon, below_epsilon = 1e-2, 0.
+    placed = ((surface_upper[2] - below_epsilon) <= lowers[:, 2]) & (lowers[:, 2] <= (surface_upper[2] + above_epsilon)) & \
+             np.all(surface_lower[:2] <= lowers[:, :2], axis=1) & np.all(uppers[:, :2] <= surface_upper[:2], axis=1)
+    if not np.all(placed):
+        return False
+    if not collisions:
+        return True
+    obstacles = world.static_obstacles | get_surface_obstacles(world, surface_name)
+    robust = True
+    for offset in offsets:
+        set_pose(body, (np.array(pose[0]) + offset, pose[1]))
+        if world.any_collision(body, obstacles):
+            robust = False
+            break
+    set_pose(body, pose)
+    return robust
+
+
+def get_obstacle_aabb(obstacle):
+    # Obstacles are either bodies or (body, links) pairs where links=None is the whole body
+    if isinstance(obstacle, tuple):
+        body, links = obstacle
+        if links is not None:
+            return aabb_union([get_aabb(body, link) for link in links])
+        obstacle = body
+    return get_aabb(obstacle)
 
 def get_link_obstacles(world, link_name):
     if link_name in world.movable:
@@ -615,4 +675,75 @@ def translate_linearly(world, distance):
     pos = np.array([x, y])
     goal_pos = pos + distance * unit_from_theta(theta)
     goal_pose = np.append(goal_pos, [theta])
-    return goal_pose
\ No newline at end of file
+    return goal_pose
+################################################################################
+
+# Vectorized pose algebra on (N, 7) arrays of (x, y, z, qx, qy, qz, qw) rows
+# Matches multiply/invert/euler_from_quat from pybullet_tools for unit quaternions
+
+def multiply_quats(quats1, quats2):
+    x1, y1, z1, w1 = np.moveaxis(quats1, -1, 0)
+    x2, y2, z2, w2 = np.moveaxis(quats2, -1, 0)
+    return np.stack([
+        w1*x2 + x1*w2 + y1*z2 - z1*y2,
+        w1*y2 - x1*z2 + y1*w2 + z1*x2,
+        w1*z2 + x1*y2 - y1*x2 + z1*w2,
+        w1*w2 - x1*x2 - y1*y2 - z1*z2,
+    ], axis=-1)
+
+def rotate_points(quats, points):
+    vectors, scalars = quats[..., :3], quats[..., 3:]
+    cross = np.cross(vectors, points)
+    return points + 2*scalars*cross + 2*np.cross(vectors, cross)
+
+def multiply_pose_rows(*rows_list):
+    rows1 = np.asarray(rows_list[0], dtype=np.float64)
+    for rows2 in rows_list[1:]:
+        rows2 = np.asarray(rows2, dtype=np.float64)
+        points = rows1[..., :3] + rotate_points(rows1[..., 3:], rows2[..., :3])
+        quats = multiply_quats(rows1[..., 3:], rows2[..., 3:])
+        rows1 = np.concatenate([points, quats], axis=-1)
+    return rows1
+
+def invert_pose_rows(rows):
+    rows = np.asarray(rows, dtype=np.float64)
+    quats = rows[..., 3:] * np.array([-1, -1, -1, 1])
+    points = -rotate_points(quats, rows[..., :3])
+    return np.concatenate([points, quats], axis=-1)
+
+def base_values_from_pose_rows(rows):
+    # (x, y, yaw) as in project_base_pose
+    rows = np.asarray(rows, dtype=np.float64)
+    x, y, z, w = np.moveaxis(rows[..., 3:], -1, 0)
+    theta = np.arctan2(2*(w*z + x*y), 1 - 2*(y*y + z*z))
+    return np.stack([rows[..., 0], rows[..., 1], theta], axis=-1)
+
+################################################################################
+
+class CameraFrustum(object):
+    # Vectorized is_visible_point with the camera extrinsics and intrinsics computed once
+    def __init__(self, camera_pose, camera_matrix, max_depth):
+        self.camera_pose = camera_pose
+        self.camera_from_world = invert_pose_rows(np.concatenate(camera_pose))
+        self.camera_matrix = np.array(camera_matrix, dtype=np.float64)
+        self.max_depth = max_depth
+        self.dimensions = 2*self.camera_matrix[:2, 2] + 1 # dimensions_from_camera_matrix
+    def contains(self, points):
+        # Boolean mask over an (N, 3) array of world points
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        points_camera = self.camera_from_world[:3] + rotate_points(self.camera_from_world[3:], points)
+        depths = points_camera[:, 2]
+        mask = (0 < depths) & (depths < self.max_depth)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pixels = (points_camera / depths[:, np.newaxis]).dot(self.camera_matrix.T)[:, :2]
+        mask &= np.all((0 <= pixels) & (pixels < self.dimensions), axis=1)
+        return mask
+    def __repr__(self):
+        return '{}(depth={})'.format(self.__class__.__name__, self.max_depth)
+
+def chunked_ray_collision(rays, max_batch=MAX_RAY_BATCH):
+    # rayTestBatch rejects batches above the shared memory limit
+    results = []
+    for start in range(0, len(rays), max_batch):
+        results.extend(batch_ray_collision(rays[start:start + max_batch]))
+    return results
@@ -17,16 +17,22 @@ from pybullet_tools.utils import connect, add_data_path, load_pybullet, HideOutp
     is_center_on_aabb, Euler, euler_from_quat, quat_from_pose, point_from_pose, get_pose, set_pose, stable_z_on_aabb, \
     set_quat, quat_from_euler, INF, read_json, set_camera_pose, set_real_time, set_caching, draw_aabb, \
     disable_gravity, set_all_static, get_movable_joints, get_joint_names, wait_for_user, reset_simulation, \
-    get_all_links, sub_inverse_kinematics, get_distance, load_yaml
+    get_all_links, sub_inverse_kinematics, get_distance, load_yaml, pairwise_collision
 from pybullet_tools.ikfast.franka_panda.ik import ikfast_inverse_kinematics, PANDA_INFO, \
     closest_inverse_kinematics, is_ik_compiled
+from src.bvh import AABBTree, aabb_overlaps
+from src.cache import LRUCache
+from src.ik import IKCache
+from src.doors import DoorCache
 from src.utils import FRANKA_CARTER, FRANKA_CARTER_PATH, create_gripper, \
     KITCHEN_PATH, BASE_JOINTS, ALL_JOINTS, \
     get_tool_link, custom_limits_from_base_limits, CABINET_JOINTS, DRAWER_JOINTS, \
     get_obj_path, type_from_name, ALL_SURFACES, compute_surface_aabb, KINECT_DEPTH, KITCHEN_LEFT_PATH, \
-    FConf, are_confs_close, DEBUG # DEFAULT_ARM, ARMS, EVE, EVE_PATH, get_eve_arm_joints
+    FConf, are_confs_close, CameraFrustum, get_obstacle_aabb, DEBUG # DEFAULT_ARM, ARMS, EVE, EVE_PATH, get_eve_arm_joints
 
 USE_TRACK_IK = True
+MAX_SURFACE_AABBS = 1000
+MAX_ARM_ROADMAPS = 100 # Base confs with an arm roadmap
 try:
     import trac_ik_python
 except ImportError:
@@ -130,6 +136,18 @@ class World(object):
         self.custom_limits = {}
         self.base_limits_handles = []
         self.cameras = {}
+        self.camera_frustums = {} # Cameras are static once added
+        self.surface_geometry = {} # Collision data and meshes never change
+        self.surface_aabbs = LRUCache(max_size=MAX_SURFACE_AABBS)
+        self.placement_samplers = {}
+        self.candidate_statistics = {} # Per-stage rejections of base conf candidates
+        self.base_roadmaps = {}
+        self.arm_roadmaps = LRUCache(max_size=MAX_ARM_ROADMAPS)
+        self.stream_pool = None # Replica worlds for speculative stream evaluation
+        self.stream_store = None # Stream outputs persisted across runs
+        self.ik_cache = IKCache()
+        self.door_cache = DoorCache()
+        self.invalidate_scene()
 
         self.disabled_collisions = set()
         if self.robot_name == FRANKA_CARTER:
@@ -222,6 +240,8 @@ class World(object):
         self.goal_gq = FConf(self.robot, self.gripper_joints)
         self.initial_confs = [self.goal_bq, self.goal_aq, self.goal_gq]
         set_all_static()
+        self.invalidate_scene()
+        self.precompute_scene()
 
     def is_real(self):
         return (self.task is not None) and self.task.real
@@ -271,20 +291,68 @@ class World(object):
     @property
     def world_link(self): # for kitchen
         return BASE_LINK
+    def invalidate_scene(self):
+        # Called whenever bodies are added or removed
+        self.scene_cache = {}
+        self.obstacle_tree = None
+        self.surface_aabbs.clear()
+    def precompute_scene(self):
+        self.scene_cache['door_links'] = frozenset(
+            link for joint in self.kitchen_joints for link in get_link_subtree(self.kitchen, joint))
+        self.scene_cache['static_obstacles'] = frozenset(
+            {(self.kitchen, frozenset([link])) for link in set(get_links(self.kitchen)) - self.door_links} |
+            {(body, None) for body in self.environment_bodies.values()})
+        joints_from_link = {}
+        for joint in self.kitchen_joints:
+            for link in get_link_subtree(self.kitchen, joint):
+                joints_from_link.setdefault(link, []).append(joint)
+        self.scene_cache['joints_from_link'] = joints_from_link
+        return self.scene_cache
     @property
     def door_links(self):
-        door_links = set()
-        for joint in self.kitchen_joints:
-            door_links.update(get_link_subtree(self.kitchen, joint))
-        return door_links
+        if 'door_links' not in self.scene_cache:
+            self.precompute_scene()
+        return self.scene_cache['door_links']
     @property
     def static_obstacles(self):
         # link=None is fine
         # TODO: decompose obstacles
         #return [(self.kitchen, frozenset(get_links(self.kitchen)) - self.door_links)]
-        return {(self.kitchen, frozenset([link])) for link in
-                set(get_links(self.kitchen)) - self.door_links} | \
-               {(body, None) for body in self.environment_bodies.values()}
+        if 'static_obstacles' not in self.scene_cache:
+            self.precompute_scene()
+        return self.scene_cache['static_obstacles']
+    def get_link_joints(self, link):
+        # Kitchen joints that move the link
+        if 'joints_from_link' not in self.scene_cache:
+            self.precompute_scene()
+        return self.scene_cache['joints_from_link'].get(link, [])
+    def get_obstacle_tree(self):
+        # The static obstacles never move, so their AABBs are computed once
+        if self.obstacle_tree is None:
+            obstacles = sorted(self.static_obstacles, key=repr)
+            self.obstacle_tree = AABBTree(obstacles, [get_obstacle_aabb(obst) for obst in obstacles])
+        return self.obstacle_tree
+    def any_collision(self, body, obstacles, max_distance=0., **kwargs):
+        # Broad phase against the AABBs before the narrow phase pairwise_collision
+        tree = self.get_obstacle_tree()
+        obstacles = list(obstacles)
+        if not obstacles:
+            return False
+        lower, upper = get_obstacle_aabb(body)
+        lower, upper = np.array(lower) - max_distance, np.array(upper) + max_distance
+        nearby = tree.query((lower, upper))
+        for obst in obstacles:
+            if obst in tree:
+                overlap = obst in nearby
+            else:
+                overlap = aabb_overlaps(lower, upper, *map(np.array, get_obstacle_aabb(obst)))
+            if not overlap:
+                tree.num_culled += 1
+                continue
+            tree.num_narrow += 1
+            if pairwise_collision(body, obst, max_distance=max_distance, **kwargs):
+                return True
+        return False
     @property
     def movable(self): # movable base
         return set(self.body_from_name) # frozenset?
@@ -343,7 +411,7 @@ class World(object):
         self.custom_limits = custom_limits_from_base_limits(self.robot, base_limits)
         return self.custom_limits
 
-    def solve_trac_ik(self, world_from_tool, nearby_tolerance=INF):
+    def solve_trac_ik(self, world_from_tool, nearby_tolerance=INF, seed_state=None):
         assert self.ik_solver is not None
         init_lower, init_upper = self.ik_solver.get_joint_limits()
         base_link = link_from_name(self.robot, self.ik_solver.base_link)
@@ -354,14 +422,16 @@ class World(object):
         world_from_tip = multiply(world_from_tool, tool_from_tip)
         base_from_tip = multiply(invert(world_from_base), world_from_tip)
         joints = joints_from_names(self.robot, self.ik_solver.joint_names)  # self.ik_solver.link_names
-        seed_state = get_joint_positions(self.robot, joints)
+        current_state = get_joint_positions(self.robot, joints)
+        if seed_state is None:
+            seed_state = current_state
         # seed_state = [0.0] * self.ik_solver.number_of_joints
 
         lower, upper = init_lower, init_upper
         if nearby_tolerance < INF:
             tolerance = nearby_tolerance * np.ones(len(joints))
-            lower = np.maximum(lower, seed_state - tolerance)
-            upper = np.minimum(upper, seed_state + tolerance)
+            lower = np.maximum(lower, np.array(current_state) - tolerance)
+            upper = np.minimum(upper, np.array(current_state) + tolerance)
         self.ik_solver.set_joint_limits(lower, upper)
 
         (x, y, z), (rx, ry, rz, rw) = base_from_tip
@@ -392,7 +462,84 @@ class World(object):
         print('Nearby) time: {:.3f} | distance: {:.5f}'.format(elapsed_time(start_time), max_distance))
         return full_conf
 
-    def solve_inverse_kinematics(self, world_from_tool, nearby_tolerance=INF, **kwargs):
+    @property
+    def arm_base_link(self):
+        return parent_link_from_joint(self.robot, self.arm_joints[0])
+
+    def get_base_from_tool(self, world_from_tool):
+        return multiply(invert(get_link_pose(self.robot, self.arm_base_link)), world_from_tool)
+
+    def solve_inverse_kinematics(self, world_from_tool, nearby_tolerance=INF, use_cache=True, min_solutions=1,
+                                 seed_noise=0., **kwargs):
+        # use_cache=False skips the cached solutions and seeds but still adds the new solution to the cache
+        # (e.g. to obtain a different solution after randomizing the current conf)
+        # Otherwise the cached solution closest to the current conf is reused once there are min_solutions for the
+        # pose, and seed_noise perturbs the cached seed so that repeated queries keep finding new solutions
+        start_time = time.time()
+        base_from_tool = self.get_base_from_tool(world_from_tool)
+        current_conf = get_joint_positions(self.robot, self.arm_joints)
+        solutions = self.ik_cache.get_solutions(base_from_tool, current_conf, nearby_tolerance) if use_cache else []
+        if max(1, min_solutions) <= len(solutions):
+            set_joint_positions(self.robot, self.arm_joints, solutions[0])
+            self.ik_cache.record(elapsed_time(start_time), success=True, hit=True)
+            return get_configuration(self.robot)
+        seeded = False
+        if use_cache and (self.ik_solver is not None) and (kwargs.get('seed_state') is None):
+            seeds = self.ik_cache.get_seeds(base_from_tool, current_conf, nearby_tolerance)
+            if seeds:
+                seed_state = np.array(seeds[0]) + np.random.uniform(-seed_noise, seed_noise, len(seeds[0]))
+                kwargs['seed_state'] = seed_state.tolist()
+                seeded = True
+        full_conf = self.solve_uncached_ik(world_from_tool, nearby_tolerance=nearby_tolerance, **kwargs)
+        if full_conf is not None:
+            self.ik_cache.add(base_from_tool, get_joint_positions(self.robot, self.arm_joints))
+        self.ik_cache.record(elapsed_time(start_time), success=full_conf is not None, seeded=seeded)
+        return full_conf
+
+    def solve_inverse_kinematics_path(self, tool_path, nearby_tolerance=INF, initial_tolerance=INF,
+                                      test_fn=lambda arm_path: True, initial_cache=True, prune=True):
+        # Solves the waypoints in turn starting from the current arm conf, each seeded by the previous solution
+        # prune=True walks the path from its final pose, so paths whose final pose is out of reach fail on the first
+        # solve and that solution becomes part of the path
+        # test_fn(arm_path) is called with the arm at arm_path[-1] and can reject the path early
+        # Returns the arm path in the order of tool_path with the arm left at arm_path[-1]
+        # or None upon the first failure
+        tool_path = list(tool_path)
+        reverse = prune and (1 < len(tool_path))
+        if reverse:
+            tool_path.reverse()
+        arm_path = []
+        for i, tool_pose in enumerate(tool_path):
+            tolerance = initial_tolerance if i == 0 else nearby_tolerance
+            seed_state = arm_path[-1] if arm_path else None
+            full_conf = self.solve_inverse_kinematics(tool_pose, nearby_tolerance=tolerance,
+                                                      use_cache=initial_cache or (i != 0), seed_state=seed_state)
+            if full_conf is None:
+                if reverse and (i == 0):
+                    self.ik_cache.num_pruned += 1
+                return None
+            arm_path.append(get_joint_positions(self.robot, self.arm_joints))
+            if not test_fn(arm_path):
+                return None
+        if reverse:
+            arm_path.reverse()
+            set_joint_positions(self.robot, self.arm_joints, arm_path[-1])
+        return arm_path
+
+    def solve_inverse_kinematics_paths(self, tool_paths, start_fn=None, **kwargs):
+        # Generates (tool_path, arm_path) for the candidate tool paths that succeed
+        # start_fn() sets the initial arm conf of each candidate (the current arm conf by default)
+        arm_conf = get_joint_positions(self.robot, self.arm_joints)
+        for tool_path in tool_paths:
+            if start_fn is None:
+                set_joint_positions(self.robot, self.arm_joints, arm_conf)
+            else:
+                start_fn()
+            arm_path = self.solve_inverse_kinematics_path(tool_path, **kwargs)
+            if arm_path is not None:
+                yield tool_path, arm_path
+
+    def solve_uncached_ik(self, world_from_tool, nearby_tolerance=INF, **kwargs):
         if self.ik_solver is not None:
             return self.solve_trac_ik(world_from_tool, **kwargs)
         #if nearby_tolerance != INF:
@@ -481,10 +628,22 @@ class World(object):
             set_color(kinect, BLACK)
             self.add(name, kinect)
         self.cameras[name] = Camera(cone, camera_matrix, max_depth)
+        self.camera_frustums[name] = CameraFrustum(pose, camera_matrix, max_depth)
         if DEBUG:
             draw_pose(pose)
         step_simulation()
         return name
+    def get_camera_pose(self, name):
+        return self.camera_frustums[name].camera_pose
+    def are_visible(self, points, camera_names=None):
+        # Mask of the points within the frustum of at least one camera
+        if camera_names is None:
+            camera_names = self.cameras
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        mask = np.zeros(len(points), dtype=bool)
+        for name in camera_names:
+            mask |= self.camera_frustums[name].contains(points)
+        return mask
 
     def get_supporting(self, obj_name):
         # is_placed_on_aabb | is_center_on_aabb
@@ -551,6 +710,7 @@ class World(object):
         body = load_pybullet(path, **kwargs)
         assert body is not None
         self.add(name, body)
+        self.invalidate_scene()
     def get_body(self, name):
         return self.body_from_name[name]
 
@@ -566,14 +726,19 @@ class World(object):
         body = self.get_body(name)
         remove_body(body)
         del self.body_from_name[name]
+        self.invalidate_scene()
     def reset(self):
         #remove_all_debug()
         for camera in self.cameras.values():
             remove_body(camera.body)
             #remove_body(camera.kinect)
         self.cameras = {}
+        self.camera_frustums = {}
         for name in list(self.body_from_name):
             self.remove_body(name)
     def destroy(self):
+        if self.stream_pool is not None:
+            self.stream_pool.close()
+            self.stream_pool = None
         reset_simulation()
         disconnect()
@@ -0,0 +1,78 @@
+import unittest
+
+from src.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = LRUCache()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', default=0), 0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertAlmostEqual(cache.hit_rate, 1. / 3)
+
+    def test_peek_and_contains_skip_statistics(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        self.assertEqual(cache.peek('a'), 1)
+        self.assertIsNone(cache.peek('b'))
+        self.assertIn('a', cache)
+        self.assertEqual(cache.queries, 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual([key for key, _ in cache.items()], ['a', 'c'])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_byte_size_eviction(self):
+        cache = LRUCache(max_size=10, size_fn=len)
+        cache.set('a', b'xxxx')
+        cache.set('b', b'yyyy')
+        self.assertEqual(cache.size, 8)
+        cache.set('c', b'zzzz')
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('a', cache)
+        self.assertEqual((cache.size, cache.evictions), (8, 1))
+        # Replacing an entry updates its size rather than adding to it
+        cache.set('b', b'yy')
+        self.assertEqual(cache.size, 6)
+        # An oversized entry is still kept on its own
+        cache.set('d', b'w' * 20)
+        self.assertEqual([key for key, _ in cache.items()], ['d'])
+        self.assertEqual(cache.size, 20)
+
+    def test_pop(self):
+        cache = LRUCache(size_fn=len)
+        cache.set('a', b'xxx')
+        self.assertEqual(cache.pop('a'), b'xxx')
+        self.assertIsNone(cache.pop('a'))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_clear(self):
+        cache = LRUCache(max_size=1)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('b')
+        cache.get('a')
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (0, 0, 0))
+        self.assertEqual(cache.values(), [])
+
+    def test_reset_statistics_keeps_entries(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.get('a')
+        cache.reset_statistics()
+        self.assertEqual(cache.queries, 0)
+        self.assertEqual(cache.values(), [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+
+try:
+    from pybullet_tools.utils import multiply, invert, base_values_from_pose, quat_from_euler, Euler
+    from src.utils import multiply_pose_rows, invert_pose_rows, base_values_from_pose_rows
+except ImportError:
+    multiply = None
+
+
+def random_pose(random_state):
+    quat = random_state.normal(size=4)
+    return tuple(random_state.uniform(-2, 2, size=3)), tuple(quat / np.linalg.norm(quat))
+
+def row_from_pose(pose):
+    return np.concatenate(pose)
+
+def angle_difference(theta1, theta2):
+    return np.arctan2(np.sin(theta1 - theta2), np.cos(theta1 - theta2))
+
+
+@unittest.skipIf(multiply is None, 'requires pybullet_tools')
+class TestPoseRows(unittest.TestCase):
+    # The vectorized pose algebra must agree with the scalar pybullet versions
+    def setUp(self):
+        self.random_state = np.random.RandomState(0)
+        self.poses = [random_pose(self.random_state) for _ in range(100)]
+
+    def assertPoseRowEqual(self, row, pose):
+        point, quat = pose
+        np.testing.assert_allclose(row[:3], point, atol=1e-9)
+        # q and -q are the same rotation
+        self.assertAlmostEqual(abs(np.dot(row[3:], quat)), 1., places=9)
+
+    def test_multiply(self):
+        others = [random_pose(self.random_state) for _ in self.poses]
+        rows = multiply_pose_rows(list(map(row_from_pose, self.poses)), list(map(row_from_pose, others)))
+        for row, pose1, pose2 in zip(rows, self.poses, others):
+            self.assertPoseRowEqual(row, multiply(pose1, pose2))
+
+    def test_multiply_broadcasts_a_single_pose(self):
+        pose1 = self.poses[0]
+        rows = multiply_pose_rows(row_from_pose(pose1), list(map(row_from_pose, self.poses)))
+        for row, pose2 in zip(rows, self.poses):
+            self.assertPoseRowEqual(row, multiply(pose1, pose2))
+
+    def test_invert(self):
+        rows = invert_pose_rows(list(map(row_from_pose, self.poses)))
+        for row, pose in zip(rows, self.poses):
+            self.assertPoseRowEqual(row, invert(pose))
+
+    def test_base_values(self):
+        rows = base_values_from_pose_rows(list(map(row_from_pose, self.poses)))
+        for values, pose in zip(rows, self.poses):
+            x, y, theta = base_values_from_pose(pose, tolerance=np.inf)
+            np.testing.assert_allclose(values[:2], [x, y], atol=1e-9)
+            self.assertAlmostEqual(angle_difference(values[2], theta), 0., places=9)
+
+    def test_base_values_yaw_wraparound(self):
+        # Yaws on either side of +/-pi must not jump by 2*pi
+        for yaw in [np.pi - 1e-6, np.pi, -np.pi + 1e-6, 3*np.pi/2, -3*np.pi/2]:
+            pose = ((1., -1., 0.), quat_from_euler(Euler(yaw=yaw)))
+            [values] = base_values_from_pose_rows([row_from_pose(pose)])
+            _, _, theta = base_values_from_pose(pose)
+            self.assertTrue(-np.pi <= values[2] <= np.pi)
+            self.assertAlmostEqual(angle_difference(values[2], theta), 0., places=9)
+            self.assertAlmostEqual(angle_difference(values[2], yaw), 0., places=9)
+
+
+if __name__ == '__main__':
+    unittest.main()